@@ -0,0 +1,235 @@
+# encoding: utf-8
+""" asyncio版本的设备管理器
+
+有协程接口的设备(async_native()为True，如ceph)直接用asyncio连接读写、上传，不占用线程；
+会话记录和缓存的读写在本地I/O线程池中执行。服务器端复制、移动和预取仍在设备的线程池中执行。
+
+其他设备(如aliyun的oss2)的读写是阻塞调用，在按设备划分的有界线程池中执行：本地文件系统共用
+一个I/O线程池，每个对象存储设备一个线程池，大小和它的连接池相同，避免一个慢设备占满所有线程。
+写入事务用contextvars记录，commit、abort 只完结当前任务写入的文件。
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from . import connpool
+
+# 本地文件系统设备共用的I/O线程数
+LOCAL_IO_WORKERS = 8
+# 每个对象存储设备的线程数，默认和连接池大小相同
+REMOTE_IO_WORKERS = None
+
+
+def _pool_size(device):
+    """ 对象存储设备的连接池大小 """
+    pool = getattr(device, 'pool', None) or getattr(getattr(device, 'client', None), 'pool', None)
+    if pool is not None:
+        return pool.stats()['maxsize']
+    return connpool.POOL_SIZE
+
+
+class AsyncStorageDeviceManager:
+    """ 包装一个 StorageDeviceManager，提供协程接口 """
+
+    def __init__(self, manager, local_workers=LOCAL_IO_WORKERS, remote_workers=REMOTE_IO_WORKERS):
+        self.manager = manager
+        self.local_workers = local_workers
+        self.remote_workers = remote_workers
+        self._local_executor = None
+        # 设备名 -> 线程池
+        self._executors = {}
+
+    def _device(self, name):
+        device, cache_device = self.manager.devices[name]
+        return device
+
+    def _native(self, name):
+        """ 有协程接口的设备返回设备，否则返回None """
+        device = self._device(name)
+        if getattr(device, 'async_native', None) is not None and device.async_native():
+            return device
+        return None
+
+    def _get_local_executor(self):
+        if self._local_executor is None:
+            self._local_executor = ThreadPoolExecutor(
+                max_workers=self.local_workers, thread_name_prefix='mdfs-aio-local')
+        return self._local_executor
+
+    def _get_executor(self, name):
+        """ 设备的线程池：本地设备共用，对象存储设备各自一个 """
+        executor = self._executors.get(name)
+        if executor is None:
+            device = self._device(name)
+            if device.hierarchical:
+                executor = self._get_local_executor()
+            else:
+                workers = self.remote_workers or _pool_size(device)
+                executor = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix='mdfs-aio-%s' % name)
+            self._executors[name] = executor
+        return executor
+
+    async def _run(self, name, func, *args, **kwargs):
+        """ 在设备的线程池中执行阻塞调用；name为None时用本地线程池 """
+        executor = self._get_local_executor() if name is None else self._get_executor(name)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    async def exists(self, name, key):
+        device = self._native(name)
+        if device is not None:
+            with self.manager._timer(name, 'exists'):
+                return await device.aexists(key)
+        return await self._run(name, self.manager.exists, name, key)
+
+    async def stat(self, name, key):
+        device = self._native(name)
+        if device is not None:
+            with self.manager._timer(name, 'stat'):
+                return await device.astat(key)
+        return await self._run(name, self.manager.stat, name, key)
+
+    async def get_data(self, name, key, offset=0, size=-1):
+        """ 读取数据 """
+        device = self._native(name)
+        if device is not None:
+            with self.manager._timer(name, 'get_data') as timer:
+                data = await device.aget_data(key, offset, size)
+                timer.nbytes = len(data)
+            return data
+        return await self._run(name, self.manager.get_data, name, key, offset, size)
+
+    async def prefetch(self, name, keys, priority=0):
+        """ 在后台预取到本地Cache，不等下载完成 """
+        return await self._run(name, self.manager.prefetch, name, keys, priority)
+
+    async def iter_data(self, name, key, offset=0, size=-1, chunk_size=None):
+        """ 流式读取数据，每次在线程池中取一块 """
+        device = self._native(name)
+        if device is not None:
+            with self.manager._timer(name, 'iter_data') as timer:
+                async for data in device.aiter_data(key, offset, size, chunk_size):
+                    timer.nbytes += len(data)
+                    yield data
+            return
+        chunks = await self._run(name, self.manager.iter_data, name, key, offset, size, chunk_size)
+        try:
+            while True:
+                data = await self._run(name, next, chunks, None)
+                if data is None:
+                    break
+                yield data
+        finally:
+            await self._run(name, chunks.close)
+
+    async def remove(self, name, key):
+        """ 删除一个文件，同时删除缓存 """
+        device = self._native(name)
+        if device is None:
+            return await self._run(name, self.manager.remove, name, key)
+        with self.manager._timer(name, 'remove'):
+            await device.aremove(key)
+        cache_device = self.manager.get_cache_device(name)
+        if cache_device is not None:
+            await self._run(None, self.manager._remove_cache, name, cache_device, [key])
+
+    async def move(self, name, key, new_key):
+        return await self._run(name, self.manager.move, name, key, new_key)
+
+    async def copy_data(self, name, from_key, to_key, auto_commit=False):
+        await self._run(name, self.manager._copy_data, name, from_key, to_key, auto_commit)
+        if not auto_commit:
+            self.manager._t_add(name, to_key)
+
+    async def multiput_new(self, name, key, size=-1, mime_type=None):
+        """ 开始一个多次写入会话, 返回会话ID"""
+        device = self._native(name)
+        if device is None:
+            session = await self._run(name, self.manager._multiput_new, name, key, size)
+        else:
+            with self.manager._timer(name, 'multiput_new'):
+                session = await device.amultiput_new(key, size)
+            await self._run(None, self.manager._session, 'new', name, key, session_id=session)
+        self.manager._t_add(name, key)
+        return session
+
+    async def multiput_offset(self, name, session_id):
+        device = self._native(name)
+        if device is not None:
+            with self.manager._timer(name, 'multiput_offset'):
+                return await device.amultiput_offset(session_id)
+        return await self._run(name, self.manager.multiput_offset, name, session_id)
+
+    async def multiput(self, name, session_id, data, offset=None):
+        device = self._native(name)
+        if device is not None:
+            with self.manager._timer(name, 'multiput') as timer:
+                timer.nbytes = len(data)
+                return await device.amultiput(session_id, data, offset)
+        return await self._run(name, self.manager.multiput, name, session_id, data, offset)
+
+    async def multiput_delete(self, name, session_id):
+        device = self._native(name)
+        if device is not None:
+            with self.manager._timer(name, 'multiput_delete'):
+                return await device.amultiput_delete(session_id)
+        return await self._run(name, self.manager.multiput_delete, name, session_id)
+
+    async def multiput_save(self, name, session_id):
+        """ 保存、完结会话 """
+        device = self._native(name)
+        if device is None:
+            return await self._run(name, self.manager.multiput_save, name, session_id)
+        with self.manager._timer(name, 'multiput_save'):
+            key = await device.amultiput_save(session_id)
+        await self._run(None, self.manager._session, 'update', name, key, session_id='')
+        return key
+
+    async def put_data(self, name, key, data, mime_type=None):
+        session_id = await self.multiput_new(name, key, mime_type=mime_type)
+        await self.multiput(name, session_id, data)
+        return await self.multiput_save(name, session_id)
+
+    async def put_stream(self, name, key, stream, mime_type=None):
+        """ 存储数据，stream可以是异步迭代器或普通迭代器 """
+        session_id = await self.multiput_new(name, key, mime_type=mime_type)
+        if hasattr(stream, '__aiter__'):
+            async for data in stream:
+                await self.multiput(name, session_id, data)
+        else:
+            for data in stream:
+                await self.multiput(name, session_id, data)
+        return await self.multiput_save(name, session_id)
+
+    async def commit(self):
+        """ 完结当前任务的写入 """
+        await self._run(None, self.manager._commit, self.manager._t_pop())
+
+    async def abort(self):
+        """ 删除当前任务写入的文件 """
+        for name, key in self.manager._t_pop():
+            if self._native(name) is None:
+                await self._run(None, self.manager._abort, ((name, key),))
+            else:
+                await self.remove(name, key)
+                await self._run(None, self.manager._session, 'delete', name, key)
+
+    def close(self):
+        """ 关闭线程池 """
+        executors = set(self._executors.values())
+        if self._local_executor is not None:
+            executors.add(self._local_executor)
+        for executor in executors:
+            executor.shutdown(wait=False)
+        self._executors = {}
+        self._local_executor = None
+
+    async def aclose(self):
+        """ 关闭线程池和当前事件循环的连接 """
+        self.close()
+        for device, cache_device in self.manager.devices.values():
+            client = getattr(device, 'client', None)
+            if getattr(client, 'aclose', None) is not None:
+                await client.aclose()
@@ -1,190 +1,166 @@
 # encoding: utf-8
 
 # refer document: https://help.aliyun.com/document_detail/32030.html?spm=5176.doc32032.6.306.4N1U2T
-import os
-import mimetypes
-
 import oss2
-from oss2 import determine_part_size
 from oss2.models import PartInfo
 
-from .device import BaseDevice
+from .remote import RemoteDevice, KEEP_HEADERS
+from .buffer import BUFFER_POOL
+from .connpool import oss_pool
+from .metacache import META_TTL, NEGATIVE_TTL
+from .checksum import format_crc64
+from .prefetch import RANGE_READAHEAD
 
-# 存储每个文件上传的会话信息
-UPLOAD_SESSIONS = {}
-# 下载数据块的大小
+# 下载数据块的最小大小，实际大小根据文件大小调整
 PART_SIZE = 2* 1024 * 1024
 # 上传数据块的大小
 BUFFER_SIZE = 400 * 1024
-
-
-class AliyunDevice(BaseDevice):
+# 同时在途的上传分块数，1 表示逐块同步上传
+UPLOAD_CONCURRENCY = 4
+# 下载到本地Cache时的并发分段数
+DOWNLOAD_CONCURRENCY = 8
+# 流式读取时预读的数据块数
+READAHEAD = 2
+# 批量删除每次请求的最大key数
+DELETE_BATCH = 1000
+# 超过这个大小，复制时分块复制(OSS单次复制的上限是1G)
+COPY_THRESHOLD = 1024 * 1024 * 1024
+# 分块复制时每块的最小大小
+COPY_PART_SIZE = 128 * 1024 * 1024
+# 分块复制的并发数
+COPY_CONCURRENCY = 8
+# 保存校验和的自定义元数据
+CHECKSUM_HEADER = 'x-oss-meta-mdfs-checksum'
+
+
+class AliyunDevice(RemoteDevice):
     """aliyun device """
 
+    PART_SIZE = PART_SIZE
+    READAHEAD = READAHEAD
+    COPY_THRESHOLD = COPY_THRESHOLD
+    COPY_PART_SIZE = COPY_PART_SIZE
+    COPY_CONCURRENCY = COPY_CONCURRENCY
+    BACKEND_CRC64 = True
+    PUT_WITH_CHECKSUM = True
+
     def __init__(self, name, title='', local_device=None, access_key_id ='',
-                 access_key_secret='', endpoint='', bucket_name='', options={}):
+                 access_key_secret='', endpoint='', bucket_name='', options={},
+                 upload_concurrency=UPLOAD_CONCURRENCY,
+                 download_concurrency=DOWNLOAD_CONCURRENCY, cache=None,
+                 buffer_pool=BUFFER_POOL, part_size=BUFFER_SIZE, pool_size=None,
+                 meta_ttl=META_TTL, negative_ttl=NEGATIVE_TTL, checksum=None, write_back=None,
+                 range_readahead=RANGE_READAHEAD):
         self.name = name
         self.title = title
         self.options = options
-        self.local_device = local_device
         auth = oss2.Auth(access_key_id, access_key_secret)
-        self.bucket = oss2.Bucket(auth, endpoint, bucket_name)
-
-    def os_path(self, key):
-        """找到key在操作系统中的地址 """
-        os_path = self.local_device.os_path(key)
-        if not self.local_device.exists(key):
-            # 分段下载到本地Cache
-            if not self.exists(key):
-                raise Exception("File Not Found")
-            session_id = self.local_device.multiput_new(key)
-            # 获取下载文件的总大小
-            size = self.bucket.head_object(key).content_length
-            offset = 0
-            while offset < size:
-                self.local_device.multiput(session_id, self.get_data(key, offset, PART_SIZE))
-                offset += PART_SIZE
-            self.local_device.multiput_save(session_id)
-        return os_path
-
-    def _get_upload_session(self, session_id):
-        """获取upload_session"""
-        if not UPLOAD_SESSIONS.has_key(session_id):
-            upload_id, key, size = session_id.rsplit(':', 2)
-            parts = self.bucket.list_parts(key, upload_id).parts
-            part_number = len('parts') + 1
-            offset = 0
-            for part in parts:
-                offset += part.size
-            UPLOAD_SESSIONS[session_id] = {
-                'parts': parts, 'part_number': part_number,
-                'offset': offset, 'buffer': ''
-            }
-        return UPLOAD_SESSIONS[session_id]
-
-    def gen_key(self, prefix='', suffix=''):
-        """
-        使用uuid生成一个未使用的key, 生成随机的两级目录
-        :param prefix: 可选前缀
-        :param suffix: 可选后缀
-        :return: 设备唯一的key
-        """
-        return self.local_device.gen_key(prefix, suffix)
+        # 同一个endpoint的设备共享连接池
+        self.pool = oss_pool(endpoint, pool_size, bucket_name)
+        self.bucket = oss2.Bucket(auth, endpoint, bucket_name, session=self.pool.session)
+        self._init_remote(local_device, cache, upload_concurrency, download_concurrency,
+                          buffer_pool, part_size, meta_ttl, negative_ttl, checksum, write_back,
+                          range_readahead)
+
+    def _head_object(self, key):
+        try:
+            head_object = self.bucket.head_object(key)
+        except oss2.exceptions.NotFound:
+            return None
+        checksum = head_object.headers.get(CHECKSUM_HEADER)
+        if checksum is None and head_object.headers.get('x-oss-hash-crc64ecma'):
+            checksum = format_crc64(head_object.headers['x-oss-hash-crc64ecma'])
+        return {
+            "file_size": head_object.content_length,
+            "hash": checksum,
+            "mime_type": head_object.content_type,
+            "put_time": head_object.last_modified
+        }
 
-    def exists(self, key):
-        """ 判断key是否存在"""
-        return os.path.exists(self.local_device.os_path(key)) or \
-               self.bucket.object_exists(key)
+    def _init_upload(self, key):
+        return self.bucket.init_multipart_upload(key).upload_id
 
-    def get_data(self, key, offset=0, size=-1):
-        """ 根据key返回文件内容，适合小文件 """
-        data = self.bucket.get_object(key, byte_range=(offset, offset + size)).read()
-        return data
+    def _upload_part_data(self, key, upload_id, part_number, data):
+        return self.bucket.upload_part(key, upload_id, part_number, data).etag
+
+    def _complete_upload(self, key, upload_id, parts):
+        """ 返回OSS计算的CRC64 """
+        return self.bucket.complete_multipart_upload(
+            key, upload_id, [PartInfo(number, etag) for number, etag in parts]).crc
 
-    def multiput_new(self, key, size=-1):
-        """开始一个多次上传会话, 返回会话ID"""
-        session_id = ':'.join([self.bucket.init_multipart_upload(key).upload_id, key, str(size)])
-        UPLOAD_SESSIONS[session_id] = {'parts': [], 'offset': 0, 'part_number': 1, 'buffer': ''}
-        return session_id
-
-    def multiput_offset(self, session_id):
-        """ 某个文件当前上传位置 """
-        upload_id, key, size = session_id.rsplit(':', 2)
-        if not UPLOAD_SESSIONS.has_key(session_id):
-            UPLOAD_SESSIONS[upload_id] = self._get_upload_session(session_id)
-        return UPLOAD_SESSIONS[session_id].get('offset')
-
-    def multiput(self, session_id, data, offset=None):
-        """ 从offset处上传数据 """
-        upload_id, key, size = session_id.rsplit(':', 2)
-        upload_session = self._get_upload_session(session_id)
-        buffer_data = self._get_buffer_data(upload_session, data, size)
-        if buffer_data is not None:
-            if upload_session.get('offset') < int(size):
-                result = self.bucket.upload_part(key,
-                                                 upload_id,
-                                                 upload_session.get('part_number'),
-                                                 buffer_data
-                                                 )
-                upload_session['parts'].append(PartInfo(upload_session['part_number'], result.etag))
-
-                upload_session['offset'] += len(buffer_data)
-                upload_session['part_number'] += 1
-        return upload_session.get('offset')
-
-    def multiput_save(self, session_id):
-        """ 某个上传会话当前上传位置 """
-        upload_id, key, size = session_id.rsplit(':', 2)
-        upload_session = self._get_upload_session(session_id)
-        if int(size) != '-1' and upload_session.get('offset') != int(size):
-            raise Exception("File Size Check Failed")
-        self.bucket.complete_multipart_upload(key, upload_id, upload_session.get('parts'))
-        UPLOAD_SESSIONS.pop(session_id)
-        return key
-
-    def multiput_delete(self, session_id):
-        """ 删除一个上传会话 """
-        upload_id, key, size = session_id.rsplit(':', 2)
-        upload_session = self._get_upload_session(session_id)
+    def _put_object(self, key, data, checksum):
+        """ 返回OSS计算的CRC64 """
+        return self.bucket.put_object(key, data, headers={CHECKSUM_HEADER: checksum}).crc
+
+    def _save_checksum(self, key, value, size):
+        """ 分块上传的文件，CRC64由OSS保存；其他算法保存到自定义元数据
+
+        修改元数据是一次替换全部元数据的复制，要带上原有的Content-Type等头部；
+        超过单次复制上限的文件不保存
+        """
+        if value.startswith('crc64:'):
+            return
+        if size > self.COPY_THRESHOLD:
+            print('save checksum %s skipped: %d bytes exceeds the copy limit' % (key, size))
+            return
+        headers = oss2.CaseInsensitiveDict()
+        for name, header_value in self.bucket.head_object(key).headers.items():
+            if name.lower() in KEEP_HEADERS or name.lower().startswith('x-oss-meta-'):
+                headers[name] = header_value
+        headers[CHECKSUM_HEADER] = value
+        self.bucket.update_object_meta(key, headers)
+
+    def _abort_upload(self, key, upload_id):
         self.bucket.abort_multipart_upload(key, upload_id)
-        UPLOAD_SESSIONS.pop(session_id)
+
+    def _list_parts(self, key, upload_id):
+        return [(part.part_number, part.etag, part.size)
+                for part in self.bucket.list_parts(key, upload_id).parts]
+
+    def _get_range(self, key, offset=0, size=-1):
+        """ 读取云端文件的[offset, offset + size)，size为-1时读到结尾 """
+        if size == 0:
+            return b''
+        if size == -1:
+            byte_range = (offset, None) if offset else None
+        else:
+            # byte_range 的结束位置是包含在内的
+            byte_range = (offset, offset + size - 1)
+        data = self.bucket.get_object(key, byte_range=byte_range).read()
+        return data
 
     def remove(self, key):
         """ 删除key文件，本地缓存也删除 """
-        if self.local_device.exists(key):
-            self.local_device.remove(key)
+        self._remove_local(key)
         self.bucket.delete_object(key)
+        self._invalidate(key)
+
+    def _delete_objects(self, keys):
+        """ 每次最多删除DELETE_BATCH个，返回删除失败的 {key: 异常} """
+        failed = {}
+        for i in range(0, len(keys), DELETE_BATCH):
+            batch = keys[i:i + DELETE_BATCH]
+            try:
+                self.bucket.batch_delete_objects(batch)
+            except oss2.exceptions.OssError as e:
+                failed.update((key, e) for key in batch)
+        return failed
 
     def rmdir(self, key):
         """ 删除前缀为key的云端和本地Cache的文件夹"""
+        if self.write_back is not None:
+            self.write_back.discard_prefix(key)
         remove_file_list = [obj.key for obj in oss2.ObjectIterator(self.bucket, prefix=key)]
-        self.bucket.batch_delete_objects(remove_file_list)
+        failed = self._delete_objects(remove_file_list)
+        self._invalidate_prefix(key)
+        if failed:
+            raise next(iter(failed.values()))
 
         self.local_device.rmdir(key)
 
-    def copy_data(self, from_key, to_key):
-        """复制文件"""
-        total_size = self.bucket.head_object(from_key).content_length
-        part_size = determine_part_size(total_size, preferred_size=100 * 1024)
-
-        # 初始化分片
-        upload_id = self.bucket.init_multipart_upload(to_key).upload_id
-        parts = []
-
-        # 逐个分片拷贝
-        part_number = 1
-        offset = 0
-        while offset < total_size:
-            num_to_upload = min(part_size, total_size - offset)
-            byte_range = (offset, offset + num_to_upload - 1)
-
-            result = self.bucket.upload_part_copy(self.bucket.bucket_name, from_key
-                                                  , byte_range, to_key, upload_id, part_number)
-            parts.append(PartInfo(part_number, result.etag))
-            offset += num_to_upload
-            part_number += 1
-
-        # 完成分片上传
-        self.bucket.complete_multipart_upload(to_key, upload_id, parts)
-
-    def stat(self, key):
-        """ 得到云端文件状态 """
-        head_object = self.bucket.head_object(key)
-        return {
-            "file_size": head_object.content_length,
-            "hash": None,
-            "mime_type": head_object.content_type,
-            "put_time": head_object.last_modified
-        }
+    def _copy_object(self, from_key, to_key):
+        self.bucket.copy_object(self.bucket.bucket_name, from_key, to_key)
 
-    def _get_buffer_data(self, upload_session, data, size):
-        """进行数据累积 累积长度为BUFFER_SIZE"""
-        upload_session['buffer'] += data
-        if len(upload_session['buffer']) >= BUFFER_SIZE:
-            buffer_data = upload_session['buffer']
-            upload_session['buffer'] = ''
-            return buffer_data
-        elif upload_session['offset'] + len(upload_session['buffer']) >= size:
-            return upload_session['buffer']
-        else:
-            return None
+    def _upload_part_copy(self, from_key, byte_range, to_key, upload_id, part_number):
+        return self.bucket.upload_part_copy(self.bucket.bucket_name, from_key, byte_range,
+                                            to_key, upload_id, part_number).etag
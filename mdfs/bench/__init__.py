@@ -0,0 +1,33 @@
+# encoding: utf-8
+""" 性能测试工具 """
+
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def parse_size(value):
+    """ 解析 64K、100M 这样的大小 """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+
+def peak_rss():
+    """ 进程的峰值常驻内存(字节) """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def timed(fn, *args, **kwargs):
+    """ 返回(结果, 耗时秒数) """
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start
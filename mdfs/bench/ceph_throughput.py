@@ -0,0 +1,80 @@
+# encoding: utf-8
+""" CephDevice吞吐量: python -m mdfs.bench.ceph_throughput --size 64M --latency 0.02 """
+
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import threading
+
+from mdfs.ceph import CephDevice
+from mdfs.vfs import VfsDevice
+from mdfs.bench import parse_size, timed
+from mdfs.bench.fakes3 import FakeS3Server
+
+
+def run(size, latency, bandwidth, pool_size, concurrency, small_ops):
+    server = FakeS3Server(latency=latency, bandwidth=bandwidth).start()
+    workspace = tempfile.mkdtemp()
+    try:
+        device = CephDevice('bench', local_device=VfsDevice('cache', root_path=workspace),
+                            endpoint=server.endpoint, access_key_id='bench',
+                            access_key_secret='bench', bucket_name='bench',
+                            pool_size=pool_size, upload_concurrency=concurrency,
+                            download_concurrency=concurrency)
+        data = os.urandom(1024 * 1024)
+
+        def put():
+            session_id = device.multiput_new('bench/large')
+            for offset in range(0, size, len(data)):
+                device.multiput(session_id, data[:min(len(data), size - offset)])
+            device.multiput_save(session_id)
+
+        def small_reads():
+            def read():
+                for i in range(small_ops // concurrency):
+                    device.get_data('bench/small', 0, 100)
+            threads = [threading.Thread(target=read) for i in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        put_seconds = timed(put)[1]
+        get_seconds = timed(device.os_path, 'bench/large')[1]
+        server.objects['bench/small'] = (data[:100], 0)
+        small_seconds = timed(small_reads)[1]
+        return {
+            'benchmark': 'ceph_throughput',
+            'size': size,
+            'latency': latency,
+            'pool_size': pool_size,
+            'concurrency': concurrency,
+            'put_bytes_per_second': size / put_seconds,
+            'os_path_bytes_per_second': size / get_seconds,
+            'small_get_ops_per_second': small_ops / small_seconds,
+            'connections': server.requests.get('connections', 0),
+            'pool': device.client.pool.stats(),
+        }
+    finally:
+        server.stop()
+        shutil.rmtree(workspace)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=parse_size, default=parse_size('64M'))
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--bandwidth', type=parse_size, default=0)
+    parser.add_argument('--pool-size', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--small-ops', type=int, default=400)
+    args = parser.parse_args(argv)
+    for concurrency in args.concurrency:
+        print(json.dumps(run(args.size, args.latency, args.bandwidth, args.pool_size,
+                             concurrency, args.small_ops)))
+
+
+if __name__ == '__main__':
+    main()
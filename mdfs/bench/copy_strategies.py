@@ -0,0 +1,74 @@
+# encoding: utf-8
+""" 本地复制方式的速度: python -m mdfs.bench.copy_strategies --size 1G --dir /data/tmp
+
+--dir 指定测试的文件系统，reflink 需要 btrfs、xfs 等写时复制文件系统
+"""
+
+import os
+import json
+import errno
+import shutil
+import argparse
+import tempfile
+
+from mdfs import fastcopy
+from mdfs.bench import parse_size, timed
+
+
+def _write_file(path, size, chunk_size=8 * 1024 * 1024):
+    chunk = os.urandom(min(size, chunk_size))
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            written += f.write(chunk[:size - written])
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def run(size, rounds, directory=None):
+    workspace = tempfile.mkdtemp(dir=directory)
+    try:
+        src = os.path.join(workspace, 'src')
+        _write_file(src, size)
+        results = {}
+        for strategy in ('shutil',) + fastcopy.STRATEGIES:
+            times = []
+            for i in range(rounds):
+                dst = os.path.join(workspace, '%s.%d' % (strategy, i))
+                try:
+                    if strategy == 'shutil':
+                        elapsed = timed(shutil.copy, src, dst)[1]
+                    else:
+                        elapsed = timed(fastcopy.copy_file, src, dst, (strategy,))[1]
+                except OSError as e:
+                    results[strategy] = {'supported': False, 'error': errno.errorcode.get(e.errno, str(e))}
+                    break
+                assert os.path.getsize(dst) == size
+                os.remove(dst)
+                times.append(elapsed)
+            else:
+                best = min(times)
+                results[strategy] = {'supported': True, 'seconds': best,
+                                     'throughput': size / best if best else None}
+        return {
+            'benchmark': 'copy_strategies',
+            'size': size,
+            'rounds': rounds,
+            'directory': workspace,
+            'results': results,
+        }
+    finally:
+        shutil.rmtree(workspace)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=parse_size, default=parse_size('1G'))
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--dir', default=None)
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.size, args.rounds, args.dir)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+""" 内存中的假 OSS Bucket，每个请求可以注入延迟和带宽限制，用于测试和性能测试 """
+import threading
+import time
+import uuid
+from email.utils import formatdate
+
+from oss2.exceptions import NoSuchKey
+from oss2.models import PartInfo, SimplifiedObjectInfo
+from oss2.utils import make_crc_adapter, set_content_type
+
+from mdfs.aliyun import AliyunDevice
+from mdfs.checksum import Crc64
+
+
+class _Result(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _Reader(object):
+
+    def __init__(self, data):
+        self._data = data
+
+    def read(self, amt=None):
+        if amt is None:
+            data, self._data = self._data, b''
+        else:
+            data, self._data = self._data[:amt], self._data[amt:]
+        return data
+
+
+class _Blob(object):
+    """ 不保存数据时，只记录大小 """
+
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __add__(self, other):
+        return _Blob(self.size + len(other))
+
+    def __getitem__(self, item):
+        return b'\0' * len(range(*item.indices(self.size)))
+
+
+class FakeBucket(object):
+    """ 实现 AliyunDevice 用到的 oss2.Bucket 接口 """
+
+    def __init__(self, latency=0, bucket_name='fake', keep_data=True, bandwidth=0):
+        self.latency = latency
+        # 每秒传输的字节数，0不限制
+        self.bandwidth = bandwidth
+        self.bucket_name = bucket_name
+        # keep_data为False时只记录大小，用于大数据量的性能测试
+        self.keep_data = keep_data
+        self.objects = {}
+        # Content-Type和自定义元数据 {key: {header: value}}
+        self.metas = {}
+        self.uploads = {}
+        # 分块上传开始时带的元数据 {upload_id: {header: value}}
+        self.upload_metas = {}
+        self.requests = {}
+        # 同时进行(在延迟中)的请求数和它的最大值 {请求名: 数量}
+        self.running = {}
+        self.peak = {}
+        self._lock = threading.Lock()
+
+    def _request(self, name):
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            self.running[name] = self.running.get(name, 0) + 1
+            self.peak[name] = max(self.peak.get(name, 0), self.running[name])
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+        finally:
+            with self._lock:
+                self.running[name] -= 1
+
+    def _throttle(self, size):
+        if self.bandwidth:
+            time.sleep(float(size) / self.bandwidth)
+
+    def _data(self, data):
+        """ 上传的数据：和oss2一样经过make_crc_adapter，只接受bytes、str或文件对象 """
+        data = make_crc_adapter(data).read()
+        self._throttle(len(data))
+        return bytes(data) if self.keep_data else _Blob(len(data))
+
+    def _metas(self, key, headers):
+        """ 和oss2一样按key补上Content-Type；修改元数据是REPLACE，没有给的都丢掉 """
+        headers = set_content_type(dict(headers or {}), key)
+        headers.pop('x-oss-metadata-directive', None)
+        return headers
+
+    def _crc(self, data):
+        if isinstance(data, _Blob):
+            return None
+        crc = Crc64()
+        crc.update(data)
+        return crc.crc
+
+    def _get(self, key):
+        try:
+            return self.objects[key]
+        except KeyError:
+            raise NoSuchKey(404, {}, b'', {'Code': 'NoSuchKey', 'Message': key})
+
+    def put_object(self, key, data, headers=None):
+        self._request('put_object')
+        self.objects[key] = (self._data(data), time.time())
+        self.metas[key] = self._metas(key, headers)
+        return _Result(etag=uuid.uuid4().hex, crc=self._crc(self.objects[key][0]))
+
+    def init_multipart_upload(self, key, headers=None):
+        self._request('init_multipart_upload')
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = {}
+            self.upload_metas[upload_id] = self._metas(key, headers)
+        return _Result(upload_id=upload_id)
+
+    def upload_part(self, key, upload_id, part_number, data, progress_callback=None, headers=None):
+        self._request('upload_part')
+        etag = uuid.uuid4().hex
+        data = self._data(data)
+        with self._lock:
+            self.uploads[upload_id][part_number] = (data, etag)
+        return _Result(etag=etag)
+
+    def upload_part_copy(self, source_bucket_name, source_key, byte_range,
+                         target_key, target_upload_id, target_part_number, headers=None):
+        self._request('upload_part_copy')
+        data = self._get(source_key)[0][byte_range[0]:byte_range[1] + 1]
+        etag = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[target_upload_id][target_part_number] = (data, etag)
+        return _Result(etag=etag)
+
+    def list_parts(self, key, upload_id, marker='', max_parts=1000):
+        self._request('list_parts')
+        parts = [PartInfo(number, etag, size=len(data))
+                 for number, (data, etag) in sorted(self.uploads[upload_id].items())]
+        return _Result(parts=parts)
+
+    def complete_multipart_upload(self, key, upload_id, parts, headers=None):
+        self._request('complete_multipart_upload')
+        uploaded = self.uploads.pop(upload_id)
+        numbers = [part.part_number for part in parts]
+        assert numbers == sorted(numbers), 'parts must be in ascending order'
+        data = b'' if self.keep_data else _Blob(0)
+        for part in parts:
+            part_data, etag = uploaded[part.part_number]
+            assert etag == part.etag, 'etag mismatch'
+            data += part_data
+        self.objects[key] = (data, time.time())
+        self.metas[key] = self.upload_metas.pop(upload_id)
+        return _Result(etag=uuid.uuid4().hex, crc=self._crc(data))
+
+    def abort_multipart_upload(self, key, upload_id, headers=None):
+        self._request('abort_multipart_upload')
+        self.uploads.pop(upload_id, None)
+        self.upload_metas.pop(upload_id, None)
+
+    def get_object(self, key, byte_range=None, headers=None, progress_callback=None, process=None, params=None):
+        self._request('get_object')
+        data = self._get(key)[0]
+        if byte_range is not None:
+            start, end = byte_range
+            if start is None:
+                data = data[len(data) - end:]
+            elif end is None:
+                data = data[start:]
+            else:
+                data = data[start:end + 1]
+        self._throttle(len(data))
+        return _Reader(data[:])
+
+    def head_object(self, key, headers=None, params=None):
+        self._request('head_object')
+        data, mtime = self._get(key)
+        headers = {'last-modified': formatdate(mtime, usegmt=True)}
+        crc = self._crc(data)
+        if crc is not None:
+            headers['x-oss-hash-crc64ecma'] = str(crc)
+        headers.update(self.metas.get(key, {}))
+        content_type = headers.get('Content-Type', 'application/octet-stream')
+        return _Result(content_length=len(data), content_type=content_type,
+                       last_modified=int(mtime), etag=uuid.uuid4().hex, headers=headers)
+
+    def update_object_meta(self, key, headers):
+        self._request('update_object_meta')
+        self._get(key)
+        self.metas[key] = self._metas('', headers)
+        return _Result(etag=uuid.uuid4().hex)
+
+    def object_exists(self, key, headers=None):
+        self._request('object_exists')
+        return key in self.objects
+
+    def delete_object(self, key, params=None, headers=None):
+        self._request('delete_object')
+        self.objects.pop(key, None)
+        self.metas.pop(key, None)
+
+    def batch_delete_objects(self, key_list, headers=None):
+        self._request('batch_delete_objects')
+        assert len(key_list) <= 1000, 'at most 1000 keys per request'
+        deleted = [key for key in key_list if self.objects.pop(key, None) is not None]
+        for key in key_list:
+            self.metas.pop(key, None)
+        return _Result(deleted_keys=deleted)
+
+    def list_objects(self, prefix='', delimiter='', marker='', max_keys=100, headers=None):
+        self._request('list_objects')
+        keys = sorted(key for key in list(self.objects) if key.startswith(prefix) and key > marker)
+        objects = []
+        for key in keys[:max_keys]:
+            data, mtime = self.objects[key]
+            objects.append(SimplifiedObjectInfo(key, int(mtime), None, None, len(data), None))
+        truncated = len(keys) > max_keys
+        return _Result(object_list=objects, prefix_list=[], is_truncated=truncated,
+                       next_marker=objects[-1].key if truncated else '')
+
+    def copy_object(self, source_bucket_name, source_key, target_key, headers=None, params=None):
+        self._request('copy_object')
+        self.objects[target_key] = (self._get(source_key)[0], time.time())
+        self.metas[target_key] = dict(self.metas.get(source_key, {}))
+        return _Result(etag=uuid.uuid4().hex)
+
+
+def new_device(local_device, name='aliyun_fake', bucket=None, latency=0, **kwargs):
+    """ 使用假Bucket的AliyunDevice，kwargs传给AliyunDevice """
+    device = AliyunDevice(name, local_device=local_device, endpoint='oss-cn-qingdao.aliyuncs.com',
+                          bucket_name='fake', **kwargs)
+    device.bucket = bucket if bucket is not None else FakeBucket(latency=latency)
+    return device
+
+
+def put_stream(device, key, data, size=-1, chunk_size=100 * 1024):
+    """ 分多次写入data，返回保存的key """
+    session_id = device.multiput_new(key, size)
+    for i in range(0, len(data), chunk_size):
+        device.multiput(session_id, data[i:i + chunk_size])
+    return device.multiput_save(session_id)
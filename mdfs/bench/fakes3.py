@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+""" 本地的S3协议服务器(只实现CephDevice用到的部分)，可以注入延迟和带宽限制 """
+import hashlib
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def _parse(self):
+        url = urlparse(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        params = dict((name, values[0]) for name, values in
+                      parse_qs(url.query, keep_blank_values=True).items())
+        return bucket, unquote(key), params
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        self.server.throttle(len(data))
+        return data
+
+    def _send(self, status, data=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if data and self.command != 'HEAD':
+            self.server.throttle(len(data))
+            self.wfile.write(data)
+
+    def _error(self, status, code):
+        self._send(status, ('<Error><Code>%s</Code><Message>%s</Message></Error>' % (
+            code, escape(self.path))).encode('utf-8'))
+
+    def _handle(self):
+        if 'Authorization' not in self.headers:
+            return self._error(403, 'AccessDenied')
+        self.server.count(self.command)
+        self.server.delay()
+        bucket, key, params = self._parse()
+        body = self._body()
+        return getattr(self, '_%s' % self.command.lower())(key, params, body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _handle
+
+    def _object(self, key):
+        return self.server.objects.get(key)
+
+    def _metas(self):
+        """ 请求带的Content-Type和自定义元数据 """
+        return dict((name.lower(), value) for name, value in self.headers.items()
+                    if name.lower() == 'content-type' or name.lower().startswith('x-amz-meta-'))
+
+    def _head(self, key, params, body):
+        obj = self._object(key)
+        if obj is None:
+            return self._send(404)
+        data, mtime = obj
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        metas = self.server.metas.get(key, {})
+        self.send_header('Content-Type', metas.get('content-type', 'application/octet-stream'))
+        for name, value in metas.items():
+            if name != 'content-type':
+                self.send_header(name, value)
+        self.send_header('Last-Modified', formatdate(mtime, usegmt=True))
+        self.send_header('ETag', '"%s"' % hashlib.md5(data).hexdigest())
+        self.end_headers()
+
+    def _get(self, key, params, body):
+        if not key and 'list-type' in params:
+            prefix = params.get('prefix', '')
+            keys = sorted(k for k in self.server.objects if k.startswith(prefix))
+            return self._send(200, ('<ListBucketResult><IsTruncated>false</IsTruncated>%s'
+                                    '</ListBucketResult>' % ''.join(
+                                        '<Contents><Key>%s</Key></Contents>' % escape(k)
+                                        for k in keys)).encode('utf-8'))
+        if 'uploadId' in params:
+            upload = self.server.uploads.get(params['uploadId'])
+            if upload is None:
+                return self._error(404, 'NoSuchUpload')
+            return self._send(200, ('<ListPartsResult><IsTruncated>false</IsTruncated>%s'
+                                    '</ListPartsResult>' % ''.join(
+                '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag><Size>%d</Size></Part>' % (
+                    number, etag, len(data)) for number, (data, etag) in sorted(upload.items()))
+            ).encode('utf-8'))
+        obj = self._object(key)
+        if obj is None:
+            return self._error(404, 'NoSuchKey')
+        data = obj[0]
+        if 'Range' in self.headers:
+            start, end = self.headers['Range'].split('=', 1)[1].split('-')
+            end = int(end) if end else len(data) - 1
+            data = data[int(start):end + 1]
+            return self._send(206, data)
+        return self._send(200, data)
+
+    def _copy_source(self):
+        source = unquote(self.headers['x-amz-copy-source']).lstrip('/')
+        return self._object(source.partition('/')[2])
+
+    def _put(self, key, params, body):
+        if 'uploadId' in params:
+            upload = self.server.uploads.get(params['uploadId'])
+            if upload is None:
+                return self._error(404, 'NoSuchUpload')
+            if 'x-amz-copy-source' in self.headers:
+                source = self._copy_source()
+                if source is None:
+                    return self._error(404, 'NoSuchKey')
+                start, end = self.headers['x-amz-copy-source-range'].split('=')[1].split('-')
+                body = source[0][int(start):int(end) + 1]
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            upload[int(params['partNumber'])] = (body, etag)
+            if 'x-amz-copy-source' in self.headers:
+                return self._send(200, ('<CopyPartResult><ETag>%s</ETag></CopyPartResult>'
+                                        % escape(etag)).encode('utf-8'))
+            return self._send(200, headers={'ETag': etag})
+        metas = self._metas()
+        if 'x-amz-copy-source' in self.headers:
+            source = self._copy_source()
+            if source is None:
+                return self._error(404, 'NoSuchKey')
+            body = source[0]
+            if self.headers.get('x-amz-metadata-directive') != 'REPLACE':
+                source_key = unquote(self.headers['x-amz-copy-source']).lstrip('/')
+                metas = dict(self.server.metas.get(source_key.partition('/')[2], {}))
+        self.server.objects[key] = (body, time.time())
+        self.server.metas[key] = metas
+        return self._send(200, headers={'ETag': '"%s"' % hashlib.md5(body).hexdigest()})
+
+    def _post(self, key, params, body):
+        if 'uploads' in params:
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = {}
+            self.server.upload_metas[upload_id] = self._metas()
+            return self._send(200, ('<InitiateMultipartUploadResult><UploadId>%s</UploadId>'
+                                    '</InitiateMultipartUploadResult>' % upload_id).encode('utf-8'))
+        if 'uploadId' in params:
+            upload = self.server.uploads.pop(params['uploadId'], None)
+            if upload is None:
+                return self._error(404, 'NoSuchUpload')
+            data = []
+            numbers = []
+            for part in ElementTree.fromstring(body):
+                fields = dict((_local_name(child.tag), child.text) for child in part)
+                number = int(fields['PartNumber'])
+                if number not in upload or upload[number][1] != fields['ETag']:
+                    return self._error(400, 'InvalidPart')
+                numbers.append(number)
+                data.append(upload[number][0])
+            if numbers != sorted(numbers):
+                return self._error(400, 'InvalidPartOrder')
+            self.server.objects[key] = (b''.join(data), time.time())
+            self.server.metas[key] = self.server.upload_metas.pop(params['uploadId'], {})
+            return self._send(200, b'<CompleteMultipartUploadResult/>')
+        if 'delete' in params:
+            for obj in ElementTree.fromstring(body):
+                for child in obj:
+                    if _local_name(child.tag) == 'Key':
+                        self.server.objects.pop(child.text, None)
+                        self.server.metas.pop(child.text, None)
+            return self._send(200, b'<DeleteResult/>')
+        return self._error(400, 'InvalidRequest')
+
+    def _delete(self, key, params, body):
+        if 'uploadId' in params:
+            self.server.uploads.pop(params['uploadId'], None)
+            self.server.upload_metas.pop(params['uploadId'], None)
+        else:
+            self.server.objects.pop(key, None)
+            self.server.metas.pop(key, None)
+        return self._send(204)
+
+
+class FakeS3Server(ThreadingMixIn, HTTPServer):
+    """ 在后台线程运行的S3服务器，latency为每个请求的延迟，bandwidth为每秒字节数 """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, bandwidth=0):
+        HTTPServer.__init__(self, (host, port), _Handler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.objects = {}
+        # Content-Type和自定义元数据 {key: {header: value}}
+        self.metas = {}
+        self.uploads = {}
+        self.upload_metas = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def throttle(self, size):
+        if self.bandwidth:
+            time.sleep(float(size) / self.bandwidth)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
@@ -0,0 +1,257 @@
+# encoding: utf-8
+""" 性能测试套件: python -m mdfs.bench.suite --backend s3 --latency 0.01 --out run.json
+
+对象存储用本地的替身(s3: FakeS3Server，oss: FakeBucket)，可以注入延迟和带宽限制。
+结果是JSON；--baseline 指定以前的结果时，比较每个指标，变差超过 --tolerance 的列出并返回1。
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+from collections import OrderedDict
+
+from mdfs.device import StorageDeviceManager, Sessions
+from mdfs.mirror import MirrorDevice
+from mdfs.sessions import SqliteSessions
+from mdfs.vfs import VfsDevice
+from mdfs.bench import parse_size, timed
+
+# 每次写入的数据块大小
+CHUNK_SIZE = 1024 * 1024
+# 指标名的后缀：越大越好；其余的指标(秒)越小越好
+HIGHER_IS_BETTER = ('_per_second',)
+
+
+class _Backend:
+    """ 创建连到本地替身的对象存储设备，stop() 关闭所有替身 """
+
+    def __init__(self, kind, latency, bandwidth, workspace):
+        self.kind = kind
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.workspace = workspace
+        self._servers = []
+
+    def device(self, name):
+        local_device = VfsDevice(name + '_cache', root_path=os.path.join(self.workspace, name))
+        if self.kind == 's3':
+            from mdfs.ceph import CephDevice
+            from mdfs.bench.fakes3 import FakeS3Server
+            server = FakeS3Server(latency=self.latency, bandwidth=self.bandwidth).start()
+            self._servers.append(server)
+            return CephDevice(name, local_device=local_device, endpoint=server.endpoint,
+                              access_key_id='bench', access_key_secret='bench',
+                              bucket_name='bench')
+        from mdfs.aliyun import AliyunDevice
+        from mdfs.bench.fakeoss import FakeBucket
+        device = AliyunDevice(name, local_device=local_device,
+                              endpoint='oss-cn-qingdao.aliyuncs.com', bucket_name='bench')
+        device.bucket = FakeBucket(latency=self.latency, bandwidth=self.bandwidth)
+        return device
+
+    def stop(self):
+        for server in self._servers:
+            server.stop()
+        self._servers = []
+
+
+def _chunks(size):
+    chunk = os.urandom(min(size, CHUNK_SIZE))
+    for offset in range(0, size, len(chunk)):
+        yield chunk[:size - offset]
+
+
+def _run_threads(target, count):
+    threads = [threading.Thread(target=target, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def bench_transfer(args, backend, workspace):
+    """ put_stream、get_data的吞吐量，以及本地没有缓存时os_path下载的吞吐量 """
+    manager = StorageDeviceManager(session_dir=os.path.join(workspace, 'sessions'))
+    device = backend.device('transfer')
+    manager.add(device, None)
+    key = 'bench/large'
+    put_seconds = timed(manager.put_stream, 'transfer', key, _chunks(args.size))[1]
+    manager.commit()
+    device._remove_local(key)
+    get_seconds = timed(manager.get_data, 'transfer', key)[1]
+    cold_seconds = []
+    for i in range(args.rounds):
+        device._remove_local(key)
+        cold_seconds.append(timed(manager.os_path, 'transfer', key)[1])
+    return {
+        'put_stream_bytes_per_second': args.size / put_seconds,
+        'get_data_bytes_per_second': args.size / get_seconds,
+        'cold_os_path_bytes_per_second': args.size / min(cold_seconds),
+    }
+
+
+def bench_mirror(args, backend, workspace):
+    """ 写到多个镜像的吞吐量，write_quorum 为全部和多数时 """
+    devices = [backend.device('mirror%d' % index) for index in range(args.mirrors)]
+    results = {}
+    for label, quorum in (('all', args.mirrors), ('majority', args.mirrors // 2 + 1)):
+        device = MirrorDevice('mirror', mirror_devices=devices, write_quorum=quorum)
+
+        def put():
+            session_id = device.multiput_new('bench/%s' % label)
+            for data in _chunks(args.size):
+                device.multiput(session_id, data)
+            device.multiput_save(session_id)
+
+        results['mirror_%s_put_bytes_per_second' % label] = args.size / timed(put)[1]
+    return results
+
+
+def bench_sessions(args, backend, workspace):
+    """ 大量会话时 query 和 cleanup 的耗时，文件和SQLite两种会话存储 """
+    results = {}
+    for label, sessions in (
+            ('file', Sessions(session_dir=os.path.join(workspace, 'file-sessions'))),
+            ('sqlite', SqliteSessions(os.path.join(workspace, 'sessions.db')))):
+        manager = StorageDeviceManager(sessions=sessions)
+        manager.add(VfsDevice('local', root_path=os.path.join(workspace, 'sessions-' + label)),
+                    None)
+        # 一半的写入提交；另一半不提交，留下会话，cleanup 删除它们和对应的文件
+        for index in range(args.sessions):
+            manager.put_data('local', 'bench/%d' % index, b'x')
+            if index == args.sessions // 2:
+                manager.commit()
+        manager._t_pop()
+        results['sessions_%s_query_seconds' % label] = timed(
+            lambda: list(sessions.query(expire=0)))[1]
+        results['sessions_%s_cleanup_seconds' % label] = timed(manager.cleanup, 0)[1]
+        assert not list(sessions.query()), 'cleanup left sessions'
+    return results
+
+
+def bench_small_files(args, backend, workspace):
+    """ 小文件的写入、stat、读取、删除，每秒操作数 """
+    manager = StorageDeviceManager(session_dir=os.path.join(workspace, 'small-sessions'))
+    device = backend.device('small')
+    manager.add(device, None)
+    data = os.urandom(args.small_size)
+    count = args.small_files // args.concurrency * args.concurrency
+
+    def keys(index):
+        return ['bench/small/%d-%d' % (index, i) for i in range(count // args.concurrency)]
+
+    def put(index):
+        for key in keys(index):
+            manager.put_data('small', key, data)
+        manager.commit()
+
+    def stat(index):
+        for key in keys(index):
+            manager.stat('small', key)
+
+    def get(index):
+        for key in keys(index):
+            device._remove_local(key)
+            manager.get_data('small', key)
+
+    def remove(index):
+        for key in keys(index):
+            manager.remove('small', key)
+
+    results = {}
+    for name, target in (('put', put), ('stat', stat), ('get', get), ('remove', remove)):
+        seconds = timed(_run_threads, target, args.concurrency)[1]
+        results['small_%s_ops_per_second' % name] = count / seconds
+    return results
+
+
+BENCHMARKS = OrderedDict([
+    ('transfer', bench_transfer),
+    ('mirror', bench_mirror),
+    ('sessions', bench_sessions),
+    ('small_files', bench_small_files),
+])
+
+
+def run(args):
+    workspace = tempfile.mkdtemp(dir=args.dir)
+    backend = _Backend(args.backend, args.latency, args.bandwidth, workspace)
+    results = OrderedDict()
+    try:
+        for name in args.only or BENCHMARKS:
+            path = os.path.join(workspace, name)
+            os.makedirs(path)
+            results[name] = BENCHMARKS[name](args, backend, path)
+    finally:
+        backend.stop()
+        shutil.rmtree(workspace)
+    return {
+        'benchmark': 'suite',
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': dict((name, value) for name, value in vars(args).items()
+                       if name not in ('out', 'baseline', 'dir')),
+        'results': results,
+    }
+
+
+def compare(baseline, current, tolerance):
+    """ 返回变差超过tolerance(比例)的指标 [{benchmark, metric, baseline, current, change}] """
+    regressions = []
+    for name, metrics in current['results'].items():
+        for metric, value in metrics.items():
+            old = baseline.get('results', {}).get(name, {}).get(metric)
+            if not old or value is None:
+                continue
+            change = (value - old) / old
+            if not metric.endswith(HIGHER_IS_BETTER):
+                change = -change
+            if change < -tolerance:
+                regressions.append({'benchmark': name, 'metric': metric, 'baseline': old,
+                                    'current': value, 'change': change})
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backend', choices=('s3', 'oss'), default='s3')
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--bandwidth', type=parse_size, default=0)
+    parser.add_argument('--size', type=parse_size, default=parse_size('32M'))
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--mirrors', type=int, default=3)
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--small-files', type=int, default=400)
+    parser.add_argument('--small-size', type=parse_size, default=parse_size('4K'))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS))
+    parser.add_argument('--dir', default=None)
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run(args)
+    if args.baseline:
+        with open(args.baseline) as f:
+            result['regressions'] = compare(json.load(f), result, args.tolerance)
+    output = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output)
+    print(output)
+    return 1 if result.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+# encoding: utf-8
+""" 并发上传的内存占用: python -m mdfs.bench.upload_memory --uploads 200 --size 100M """
+
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+from mdfs.aliyun import AliyunDevice
+from mdfs.buffer import BufferPool, MEMORY_LIMIT
+from mdfs.vfs import VfsDevice
+from mdfs.bench import parse_size, peak_rss
+from mdfs.bench.fakeoss import FakeBucket
+
+
+def run(uploads, size, chunk_size, memory_limit, latency):
+    workspace = tempfile.mkdtemp()
+    try:
+        device = AliyunDevice('bench', local_device=VfsDevice('cache', root_path=workspace),
+                              endpoint='oss-cn-qingdao.aliyuncs.com', bucket_name='bench',
+                              buffer_pool=BufferPool(memory_limit, spill_dir=workspace))
+        device.bucket = FakeBucket(latency=latency, keep_data=False)
+        chunk = b'x' * chunk_size
+        rss_before = peak_rss()
+
+        def upload(index):
+            session_id = device.multiput_new('bench/%d' % index)
+            sent = 0
+            while sent < size:
+                data = chunk if size - sent >= chunk_size else chunk[:size - sent]
+                device.multiput(session_id, data)
+                sent += len(data)
+            device.multiput_save(session_id)
+
+        threads = [threading.Thread(target=upload, args=(i,)) for i in range(uploads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        for index in range(uploads):
+            assert len(device.bucket.objects['bench/%d' % index][0]) == size
+        return {
+            'benchmark': 'upload_memory',
+            'uploads': uploads,
+            'size': size,
+            'seconds': elapsed,
+            'throughput': uploads * size / elapsed,
+            'peak_rss': peak_rss(),
+            'peak_rss_before': rss_before,
+            'buffer': device.buffer_pool.stats(),
+        }
+    finally:
+        shutil.rmtree(workspace)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--uploads', type=int, default=200)
+    parser.add_argument('--size', type=parse_size, default=parse_size('100M'))
+    parser.add_argument('--chunk-size', type=parse_size, default=parse_size('64K'))
+    parser.add_argument('--memory-limit', type=parse_size, default=MEMORY_LIMIT)
+    parser.add_argument('--latency', type=float, default=0.005)
+    args = parser.parse_args(argv)
+    result = run(args.uploads, args.size, args.chunk_size, args.memory_limit, args.latency)
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# encoding: utf-8
+""" 上传会话的分块缓冲：进程内存有上限，超出后写入临时文件 """
+
+import io
+import tempfile
+import threading
+
+# 每个进程用于上传缓冲的内存上限
+MEMORY_LIMIT = 64 * 1024 * 1024
+
+
+class BufferPool:
+    """ 统计所有分块缓冲占用的内存 """
+
+    def __init__(self, limit=MEMORY_LIMIT, spill_dir=None):
+        self.limit = limit
+        self.spill_dir = spill_dir
+        self.in_memory = 0
+        self.peak = 0
+        self.spilled = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        """ 申请size字节内存，超出上限返回False """
+        with self._lock:
+            if self.in_memory + size > self.limit:
+                self.spilled += 1
+                return False
+            self.in_memory += size
+            self.peak = max(self.peak, self.in_memory)
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.in_memory -= size
+
+    def stats(self):
+        with self._lock:
+            return {'in_memory': self.in_memory, 'peak': self.peak,
+                    'spilled': self.spilled, 'limit': self.limit}
+
+
+class MemoryReader(io.RawIOBase):
+    """ 内存分块的只读文件对象，读的时候才按块复制，不用先把整个分块复制成bytes
+
+    oss2 的 make_crc_adapter 只接受bytes或有read()的对象，不接受bytearray、memoryview
+    """
+
+    def __init__(self, view):
+        self._view = view
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), len(self._view) - self._position))
+        buffer[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+class PartBuffer:
+    """ 累积一个分块的数据，预分配part_size字节；内存不足时写入临时文件 """
+
+    def __init__(self, pool, part_size):
+        self.pool = pool
+        self.part_size = part_size
+        self.length = 0
+        self._file = None
+        self._data = None
+        if pool.acquire(part_size):
+            self._data = bytearray(part_size)
+        else:
+            self._file = tempfile.TemporaryFile(dir=pool.spill_dir)
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def full(self):
+        return self.length >= self.part_size
+
+    def write(self, data, start=0):
+        """ 写入data[start:]，写满为止，返回写入的字节数 """
+        count = min(self.part_size - self.length, len(data) - start)
+        if self._data is not None:
+            self._data[self.length:self.length + count] = data[start:start + count]
+        else:
+            self._file.write(data[start:start + count])
+        self.length += count
+        return count
+
+    def getvalue(self):
+        """ 分块的数据，不复制：返回从头读的文件对象，内存中的是MemoryReader """
+        if self._data is not None:
+            return MemoryReader(memoryview(self._data)[:self.length])
+        self._file.flush()
+        self._file.seek(0)
+        return self._file
+
+    def close(self):
+        if self._data is not None:
+            self._data = None
+            self.pool.release(self.part_size)
+        elif self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+BUFFER_POOL = BufferPool()
@@ -0,0 +1,200 @@
+# encoding: utf-8
+""" 远程设备本地Cache(local_device)的容量管理，超出容量时按LRU或LFU淘汰 """
+
+import os
+import time
+import threading
+
+from .vfs import OPEN_FILES
+
+# 淘汰到容量的这个比例，避免频繁淘汰
+LOW_WATERMARK = 0.9
+# 后台检查间隔（秒）
+EVICT_INTERVAL = 60
+# 下载过程中的临时文件和锁文件，不归Cache管理
+IGNORE_SUFFIXES = ('.lock', '.download')
+
+
+class _Entry:
+
+    __slots__ = ('size', 'access_time', 'hits')
+
+    def __init__(self, size, access_time, hits=0):
+        self.size = size
+        self.access_time = access_time
+        self.hits = hits
+
+
+class CacheManager:
+    """ 管理一个VfsDevice做为远程设备的本地Cache
+
+    max_bytes / max_files 为0表示不限制；policy 为 'lru' 或 'lfu'
+    """
+
+    def __init__(self, local_device, max_bytes=0, max_files=0, policy='lru',
+                 interval=EVICT_INTERVAL):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError('Unknown cache policy: %s' % policy)
+        self.local_device = local_device
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.policy = policy
+        self.interval = interval
+        self.hits = self.misses = self.evictions = self.evicted_bytes = 0
+        self.total_bytes = 0
+        self._entries = {}
+        # 不能淘汰的文件(写回模式下还没有上传的)
+        self._pinned = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._scan()
+
+    def _scan(self):
+        """ 启动时扫描已经存在的Cache文件 """
+        root_path = self.local_device.root_path
+        for dir_path, dir_names, file_names in os.walk(root_path):
+            for file_name in file_names:
+                if file_name.endswith(IGNORE_SUFFIXES):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                self._entries[path] = _Entry(st.st_size, max(st.st_atime, st.st_mtime))
+                self.total_bytes += st.st_size
+
+    def hit(self, key):
+        """ 命中Cache """
+        path = self.local_device.os_path(key)
+        with self._lock:
+            self.hits += 1
+            entry = self._entries.get(path)
+            if entry is not None:
+                entry.access_time = time.time()
+                entry.hits += 1
+                return
+        self.add(key)
+
+    def miss(self, key):
+        """ 未命中Cache，随后会下载 """
+        with self._lock:
+            self.misses += 1
+
+    def add(self, key):
+        """ 新下载到Cache的文件 """
+        path = self.local_device.os_path(key)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            old = self._entries.get(path)
+            if old is not None:
+                self.total_bytes -= old.size
+            self._entries[path] = _Entry(size, time.time(), old.hits if old else 0)
+            self.total_bytes += size
+
+    def discard(self, key):
+        """ 文件已经被删除 """
+        path = self.local_device.os_path(key)
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self.total_bytes -= entry.size
+
+    def pin(self, key):
+        """ 文件还没有上传到云端，不能淘汰 """
+        with self._lock:
+            self._pinned.add(self.local_device.os_path(key))
+
+    def unpin(self, key):
+        with self._lock:
+            self._pinned.discard(self.local_device.os_path(key))
+
+    def over_capacity(self):
+        return (self.max_bytes and self.total_bytes > self.max_bytes) or \
+               (self.max_files and len(self._entries) > self.max_files)
+
+    def _victims(self):
+        """ 选出需要淘汰的文件，正在上传写入的、还没有上传到云端的文件不淘汰 """
+        if self.policy == 'lru':
+            order = lambda item: item[1].access_time
+        else:
+            order = lambda item: (item[1].hits, item[1].access_time)
+        max_bytes = int(self.max_bytes * LOW_WATERMARK)
+        max_files = max(int(self.max_files * LOW_WATERMARK), 1)
+        total_bytes, total_files = self.total_bytes, len(self._entries)
+        victims = []
+        for path, entry in sorted(self._entries.items(), key=order):
+            if not ((self.max_bytes and total_bytes > max_bytes) or
+                    (self.max_files and total_files > max_files)):
+                break
+            if OPEN_FILES.is_open(path) or path in self._pinned:
+                continue
+            victims.append(path)
+            total_bytes -= entry.size
+            total_files -= 1
+        return victims
+
+    def evict(self):
+        """ 超出容量时淘汰文件，返回淘汰的文件数 """
+        with self._lock:
+            if not self.over_capacity():
+                return 0
+            victims = [(path, self._entries.pop(path)) for path in self._victims()]
+            for path, entry in victims:
+                self.total_bytes -= entry.size
+            self.evictions += len(victims)
+            self.evicted_bytes += sum(entry.size for path, entry in victims)
+
+        root_path = self.local_device.root_path
+        for path, entry in victims:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            # 删除空的上级文件夹
+            dir_name = os.path.dirname(path)
+            while len(dir_name) > len(root_path):
+                try:
+                    os.rmdir(dir_name)
+                except OSError:
+                    break
+                dir_name = os.path.dirname(dir_name)
+        return len(victims)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes,
+                'files': len(self._entries),
+                'bytes': self.total_bytes,
+            }
+
+    def start(self):
+        """ 启动后台淘汰线程 """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='mdfs-cache-evict')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.evict()
+            except Exception as e:
+                print('cache evict error:' + str(e))
@@ -1,78 +1,198 @@
 # encoding: utf-8
-import os
-from .device import BaseDevice
+import calendar
 import mimetypes
+from email.utils import parsedate
 
-class CephDevice(BaseDevice):
-    """ ceph device """
+from .remote import RemoteDevice, KEEP_HEADERS
+from .buffer import BUFFER_POOL
+from .s3 import S3Client
+from .metacache import META_TTL, NEGATIVE_TTL
+from .prefetch import RANGE_READAHEAD
+from . import errors
 
-    def __init__(self, name, title='', local_device=None, options={}):
+# 下载数据块的最小大小，实际大小根据文件大小调整
+PART_SIZE = 4 * 1024 * 1024
+# 上传数据块的大小，S3协议要求除最后一块外不小于5M
+BUFFER_SIZE = 5 * 1024 * 1024
+# 同时在途的上传分块数，1 表示逐块同步上传
+UPLOAD_CONCURRENCY = 4
+# 下载到本地Cache时的并发分段数
+DOWNLOAD_CONCURRENCY = 8
+# 超过这个大小，复制时分块复制(S3单次复制的上限是5G)
+COPY_THRESHOLD = 5 * 1024 * 1024 * 1024
+# 分块复制时每块的最小大小
+COPY_PART_SIZE = 512 * 1024 * 1024
+# 分块复制的并发数
+COPY_CONCURRENCY = 8
+# 保存校验和的自定义元数据
+CHECKSUM_HEADER = 'x-amz-meta-mdfs-checksum'
+
+
+class CephDevice(RemoteDevice):
+    """ ceph device，通过S3协议访问ceph rgw """
+
+    PART_SIZE = PART_SIZE
+    COPY_THRESHOLD = COPY_THRESHOLD
+    COPY_PART_SIZE = COPY_PART_SIZE
+    COPY_CONCURRENCY = COPY_CONCURRENCY
+    PUT_WITH_CHECKSUM = True
+    ASYNC_NATIVE = True
+
+    def __init__(self, name, title='', local_device=None, options={}, endpoint='',
+                 access_key_id='', access_key_secret='', bucket_name='', region='us-east-1',
+                 pool_size=None, upload_concurrency=UPLOAD_CONCURRENCY,
+                 download_concurrency=DOWNLOAD_CONCURRENCY, cache=None,
+                 buffer_pool=BUFFER_POOL, part_size=BUFFER_SIZE,
+                 meta_ttl=META_TTL, negative_ttl=NEGATIVE_TTL, checksum=None, write_back=None,
+                 range_readahead=RANGE_READAHEAD):
         self.name = name
         self.title = title
-        self.local_device = local_device
+        self.options = options
+        self.client = S3Client(endpoint, access_key_id, access_key_secret, bucket_name,
+                               region=region, pool_size=pool_size)
+        self._init_remote(local_device, cache, upload_concurrency, download_concurrency,
+                          buffer_pool, part_size, meta_ttl, negative_ttl, checksum, write_back,
+                          range_readahead)
 
-    def os_path(self, key):
-        """ 找到key在操作系统中的地址 """
-        os_path = self.local_device.os_path(key)
-        if self.local_device.exists(key):
-            return os_path
-        else:
-            # download to os_path
-            pass
-
-    def gen_key(self, prefix='', suffix=''):
-        """
-        使用uuid生成一个未使用的key, 生成随机的两级目录
-        :param prefix: 可选前缀
-        :param suffix: 可选后缀
-        :return: 设备唯一的key
-        """
-        return self.local_device.gen_key(prefix, suffix)
-
-    def exists(self, key):
-        """ 判断key是否存在"""
-
-    def get_data(self, key, offset=0, size=-1):
-        """ 根据key返回文件内容，适合小文件 """
-        if self.local_device.exists(key):
-            return self.local_device.get_data(key, offset=offset, size=size)
-        else:
-            pass # download and cache
+    def _head_object(self, key):
+        try:
+            headers = self.client.head_object(key)
+        except errors.S3Error as e:
+            if e.status == 404:
+                return None
+            raise
+        return _stat(key, headers)
+
+    async def _ahead_object(self, key):
+        try:
+            headers = await self.client.ahead_object(key)
+        except errors.S3Error as e:
+            if e.status == 404:
+                return None
+            raise
+        return _stat(key, headers)
+
+    def _init_upload(self, key):
+        return self.client.create_multipart_upload(key)
+
+    async def _ainit_upload(self, key):
+        return await self.client.acreate_multipart_upload(key)
+
+    def _upload_part_data(self, key, upload_id, part_number, data):
+        return self.client.upload_part(key, upload_id, part_number, data)
+
+    async def _aupload_part_data(self, key, upload_id, part_number, data):
+        return await self.client.aupload_part(key, upload_id, part_number, data)
+
+    def _complete_upload(self, key, upload_id, parts):
+        self.client.complete_multipart_upload(key, upload_id, parts)
+
+    async def _acomplete_upload(self, key, upload_id, parts):
+        await self.client.acomplete_multipart_upload(key, upload_id, parts)
+
+    def _put_object(self, key, data, checksum):
+        """ S3不返回CRC64 """
+        self.client.put_object(key, data, {CHECKSUM_HEADER: checksum})
+
+    async def _aput_object(self, key, data, checksum):
+        await self.client.aput_object(key, data, {CHECKSUM_HEADER: checksum})
+
+    def _save_checksum(self, key, value, size):
+        """ 保存到自定义元数据：复制到自己并替换元数据，带上原有的Content-Type等头部；
+        超过单次复制上限的文件不保存 """
+        if self._skip_checksum(key, size):
+            return
+        self.client.copy_object(key, key, _checksum_headers(self.client.head_object(key), value))
 
-    def multiput_new(self, key, size=-1):
-        """ 开始一个多次写入会话, 返回会话ID"""
+    async def _asave_checksum(self, key, value, size):
+        if self._skip_checksum(key, size):
+            return
+        headers = await self.client.ahead_object(key)
+        await self.client.acopy_object(key, key, _checksum_headers(headers, value))
 
-    def multiput_offset(self, session_id):
-        """ 某个文件当前上传位置 """
+    def _skip_checksum(self, key, size):
+        if size > self.COPY_THRESHOLD:
+            print('save checksum %s skipped: %d bytes exceeds the copy limit' % (key, size))
+            return True
+        return False
 
-    def multiput(self, session_id, data, offset=None):
-        """ 从offset处写入数据 """
+    def _abort_upload(self, key, upload_id):
+        self.client.abort_multipart_upload(key, upload_id)
 
-    def multiput_save(self, session_id):
-        """ 某个文件当前上传位置 """
+    async def _aabort_upload(self, key, upload_id):
+        await self.client.aabort_multipart_upload(key, upload_id)
 
-    def multiput_delete(self, session_id):
-        """ 删除一个写入会话 """
+    def _list_parts(self, key, upload_id):
+        return self.client.list_parts(key, upload_id)
+
+    async def _alist_parts(self, key, upload_id):
+        return await self.client.alist_parts(key, upload_id)
+
+    def _get_range(self, key, offset=0, size=-1):
+        """ 读取[offset, offset + size)，size为-1时读到结尾 """
+        if size == 0:
+            return b''
+        return self.client.get_object(key, byte_range=_byte_range(offset, size))
+
+    async def _aget_range(self, key, offset=0, size=-1):
+        if size == 0:
+            return b''
+        return await self.client.aget_object(key, byte_range=_byte_range(offset, size))
 
     def remove(self, key):
         """ 删除key文件，本地缓存也删除 """
+        self._remove_local(key)
+        self.client.delete_object(key)
+        self._invalidate(key)
+
+    async def _adelete_object(self, key):
+        await self.client.adelete_object(key)
+
+    def _delete_objects(self, keys):
+        return self.client.delete_objects(keys)
 
     def rmdir(self, key):
         """ 删除key文件夹"""
-        results = []
-        for device in self.mirror_devices:
-            results.append(device.rmdir(key))
-        return results[0]
-
-    def copy_data(self, from_key, to_key):
-        """ 复制 """
-
-    def stat(self, key):
-        """ 得到状态 """
-        os_path = self.os_path(key)
-        return {
-            "file_size": os.path.getsize(os_path),
-            "hash": None,
-            "mime_type": mimetypes.guess_type(key)[0],
-            "put_time": os.path.getctime(os_path)
-        }
+        if self.write_back is not None:
+            self.write_back.discard_prefix(key)
+        failed = self._delete_objects(list(self.client.list_objects(prefix=key)))
+        self._invalidate_prefix(key)
+        if failed:
+            raise next(iter(failed.values()))
+
+        if self.local_device.exists(key):
+            self.local_device.rmdir(key)
+
+    def _copy_object(self, from_key, to_key):
+        self.client.copy_object(from_key, to_key)
+
+    def _upload_part_copy(self, from_key, byte_range, to_key, upload_id, part_number):
+        return self.client.upload_part_copy(from_key, byte_range, to_key, upload_id, part_number)
+
+
+def _stat(key, headers):
+    """ HEAD的响应头转换为文件状态 """
+    last_modified = parsedate(headers.get('last-modified', ''))
+    return {
+        "file_size": int(headers['content-length']),
+        "hash": headers.get(CHECKSUM_HEADER),
+        "mime_type": headers.get('content-type') or mimetypes.guess_type(key)[0],
+        "put_time": calendar.timegm(last_modified) if last_modified else None
+    }
+
+
+def _byte_range(offset, size):
+    """ 读取[offset, offset + size)的范围，size为-1时读到结尾 """
+    if size == -1:
+        return (offset, None) if offset else None
+    # byte_range 的结束位置是包含在内的
+    return (offset, offset + size - 1)
+
+
+def _checksum_headers(headers, value):
+    """ 替换元数据的复制请求头，带上原有的Content-Type等头部和自定义元数据 """
+    headers = dict((name, header_value) for name, header_value in headers.items()
+                   if name in KEEP_HEADERS or name.startswith('x-amz-meta-'))
+    headers[CHECKSUM_HEADER] = value
+    headers['x-amz-metadata-directive'] = 'REPLACE'
+    return headers
@@ -0,0 +1,130 @@
+# encoding: utf-8
+""" 写入时流式计算的校验和，格式为 "算法:十六进制值"，如 "md5:9e10..." """
+
+import os
+import hashlib
+
+try:
+    import crcmod
+except ImportError:
+    crcmod = None
+
+# 支持的算法
+ALGORITHMS = ('md5', 'crc64', 'blake2b')
+# 本地文件的校验和保存在扩展属性中，同时记录大小和修改时间，文件被其他程序修改后失效
+XATTR_NAME = 'user.mdfs.checksum'
+
+# 阿里云OSS使用的CRC-64/XZ(ECMA-182)
+_crc64 = crcmod.mkCrcFun(0x142F0E1EBA9EA3693, initCrc=0, xorOut=0xffffffffffffffff,
+                         rev=True) if crcmod is not None else None
+
+
+class Crc64:
+    """ 和hashlib相同接口的CRC64 """
+
+    name = 'crc64'
+
+    def __init__(self):
+        if _crc64 is None:
+            raise ValueError('crc64 needs the crcmod package')
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = _crc64(bytes(data) if isinstance(data, memoryview) else data, self.crc)
+
+    def hexdigest(self):
+        return '%016x' % self.crc
+
+
+def new_hasher(algorithm):
+    if algorithm == 'crc64':
+        return Crc64()
+    if algorithm not in ALGORITHMS:
+        raise ValueError('unsupported checksum algorithm: %s' % algorithm)
+    return hashlib.new(algorithm)
+
+
+def format_crc64(crc):
+    """ 对象存储返回的CRC64(整数)转为校验和字符串 """
+    return 'crc64:%016x' % int(crc)
+
+
+class Checksum:
+    """ 随写入更新的校验和，记录已经计算到的位置
+
+    写入位置和已计算的位置不连续时(断点续传、重写)，校验和失效，value()返回None；
+    从0开始重写时重新计算。verify_crc64 为True时同时计算CRC64，用于和对象存储返回的CRC比较。
+    """
+
+    def __init__(self, algorithm, verify_crc64=False):
+        self.algorithm = algorithm
+        self.verify_crc64 = verify_crc64 and _crc64 is not None
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.valid = True
+        self._hasher = new_hasher(self.algorithm)
+        if self.algorithm == 'crc64':
+            self._crc64 = self._hasher
+        else:
+            self._crc64 = Crc64() if self.verify_crc64 else None
+
+    def update(self, data, offset=None):
+        if offset is not None and offset != self.offset:
+            if offset != 0:
+                self.valid = False
+                return
+            self.reset()
+        if not self.valid:
+            return
+        self._hasher.update(data)
+        if self._crc64 is not None and self._crc64 is not self._hasher:
+            self._crc64.update(data)
+        self.offset += len(data)
+
+    def update_chunks(self, chunks):
+        """ 从头重新计算 """
+        self.reset()
+        for data in chunks:
+            self.update(data)
+
+    @property
+    def crc64(self):
+        """ 已计算的CRC64(整数)，没有计算时为None """
+        if not self.valid or self._crc64 is None:
+            return None
+        return self._crc64.crc
+
+    def value(self):
+        if not self.valid:
+            return None
+        return '%s:%s' % (self.algorithm, self._hasher.hexdigest())
+
+
+def save_file_checksum(path, value):
+    """ 保存到文件的扩展属性，文件系统不支持时返回False """
+    if not hasattr(os, 'setxattr'):
+        return False
+    stat = os.stat(path)
+    value = '%s:%d:%d' % (value, stat.st_size, stat.st_mtime_ns)
+    try:
+        os.setxattr(path, XATTR_NAME, value.encode('ascii'))
+    except OSError:
+        return False
+    return True
+
+
+def load_file_checksum(path):
+    """ 读取文件的校验和，没有或已过期时返回None """
+    if not hasattr(os, 'getxattr'):
+        return None
+    try:
+        value = os.getxattr(path, XATTR_NAME).decode('ascii')
+    except OSError:
+        return None
+    value, size, mtime_ns = value.rsplit(':', 2)
+    stat = os.stat(path)
+    if int(size) != stat.st_size or int(mtime_ns) != stat.st_mtime_ns:
+        return None
+    return value
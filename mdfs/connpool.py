@@ -0,0 +1,243 @@
+# encoding: utf-8
+""" 按服务器(endpoint)共享的连接池：同一个endpoint的设备共用连接，后台关闭空闲连接 """
+
+import time
+import weakref
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# 每个endpoint默认的最大连接数
+POOL_SIZE = 16
+# 单独设置某个endpoint的最大连接数 {endpoint: pool_size}
+POOL_SIZES = {}
+# 空闲超过这个时间的连接被关闭（秒）
+IDLE_TIMEOUT = 60
+# 后台检查空闲连接的间隔（秒）
+REAP_INTERVAL = 30
+
+_pools = {}
+_lock = threading.Lock()
+_reaper = None
+
+
+def normalize_endpoint(endpoint):
+    endpoint = endpoint.strip().rstrip('/').lower()
+    if '://' not in endpoint:
+        endpoint = 'http://' + endpoint
+    return endpoint
+
+
+def pool_size_for(endpoint, pool_size=None):
+    return pool_size or POOL_SIZES.get(endpoint) or POOL_SIZE
+
+
+def shared(endpoint, factory):
+    """ 取endpoint的共享连接池，没有时调用factory()创建 """
+    with _lock:
+        pool = _pools.get(endpoint)
+        if pool is None:
+            pool = _pools[endpoint] = factory()
+        _start_reaper()
+    return pool
+
+
+def stats():
+    """ 所有连接池的统计 {endpoint: {in_use, idle, created, reaped, wait_time, ...}} """
+    with _lock:
+        pools = list(_pools.items())
+    return dict((endpoint, pool.stats()) for endpoint, pool in pools)
+
+
+def reap(idle_timeout=None):
+    """ 关闭所有连接池中空闲超时的连接，返回关闭的连接数 """
+    with _lock:
+        pools = list(_pools.values())
+    return sum(pool.reap(IDLE_TIMEOUT if idle_timeout is None else idle_timeout)
+               for pool in pools)
+
+
+def _start_reaper():
+    global _reaper
+    if _reaper is None:
+        _reaper = threading.Thread(target=_reap_forever, name='mdfs-connpool-reaper')
+        _reaper.daemon = True
+        _reaper.start()
+
+
+def _reap_forever():
+    while True:
+        time.sleep(REAP_INTERVAL)
+        try:
+            reap()
+        except Exception as e:
+            print('reap connections error:' + str(e))
+
+
+class PoolStats:
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.in_use = 0
+        self.peak = 0
+        self.created = 0
+        self.reaped = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self._lock = threading.Lock()
+
+    def checkout(self, wait):
+        with self._lock:
+            self.in_use += 1
+            self.peak = max(self.peak, self.in_use)
+            self.waits += 1
+            self.wait_time += wait
+
+    def checkin(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def add(self, name, count=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + count)
+
+    def snapshot(self, idle):
+        with self._lock:
+            return {'in_use': self.in_use, 'peak': self.peak, 'idle': idle,
+                    'created': self.created, 'reaped': self.reaped, 'wait_time': self.wait_time,
+                    'avg_wait': self.wait_time / self.waits if self.waits else 0.0,
+                    'maxsize': self.maxsize}
+
+
+class OssPool:
+    """ oss2的Session(requests)，整个endpoint同时在用的连接数有上限，记录等待时间
+
+    OSS每个bucket是一个单独的虚拟主机，requests按主机分别建连接池；上限用信号量在
+    请求外面限制，连接归还(响应读完或关闭)时释放。
+    """
+
+    def __init__(self, maxsize):
+        import oss2
+        from requests.adapters import HTTPAdapter
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+        self.maxsize = maxsize
+        pool_stats = self.pool_stats = PoolStats(maxsize)
+        slots = threading.BoundedSemaphore(maxsize)
+        self._lock = threading.Lock()
+        # 用这个endpoint的bucket，每个bucket一个主机连接池
+        self.buckets = set()
+
+        class _Counting(object):
+            """ 统计新建的连接 """
+
+            def connect(self):
+                pool_stats.add('created')
+                return super(_Counting, self).connect()
+
+        pool_classes = {
+            'http': type('OssHTTPPool', (HTTPConnectionPool,), {
+                'ConnectionCls': type('OssHTTPConnection', (_Counting, HTTPConnection), {})}),
+            'https': type('OssHTTPSPool', (HTTPSConnectionPool,), {
+                'ConnectionCls': type('OssHTTPSConnection', (_Counting, HTTPSConnection), {})}),
+        }
+
+        class _Adapter(HTTPAdapter):
+
+            def init_poolmanager(self, *args, **kwargs):
+                HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+                self.poolmanager.pool_classes_by_scheme = pool_classes
+
+            def send(self, request, **kwargs):
+                start = time.time()
+                slots.acquire()
+                pool_stats.checkout(time.time() - start)
+                try:
+                    response = HTTPAdapter.send(self, request, **kwargs)
+                except BaseException:
+                    pool_stats.checkin()
+                    slots.release()
+                    raise
+                _release_on_return(response.raw, slots, pool_stats)
+                return response
+
+        self.adapter = _Adapter(pool_connections=1, pool_maxsize=maxsize, pool_block=True)
+        self.session = oss2.Session(adapter=self.adapter)
+
+    def add_bucket(self, bucket_name):
+        """ 每个bucket一个主机连接池，保留的主机连接池数等于bucket数，不会反复关闭、新建 """
+        with self._lock:
+            if bucket_name in self.buckets:
+                return
+            self.buckets.add(bucket_name)
+            self.adapter.init_poolmanager(len(self.buckets), self.maxsize, block=True)
+
+    def _url_pools(self):
+        pools = self.adapter.poolmanager.pools
+        return [pools[key] for key in list(pools.keys())]
+
+    def stats(self):
+        idle = 0
+        for pool in self._url_pools():
+            if pool.pool is not None:
+                idle += sum(1 for conn in list(pool.pool.queue)
+                            if conn is not None and conn.sock is not None)
+        return self.pool_stats.snapshot(idle)
+
+    def reap(self, idle_timeout):
+        now = time.time()
+        reaped = 0
+        for pool in self._url_pools():
+            if pool.pool is None:
+                continue
+            conns = []
+            while True:
+                try:
+                    conns.append(pool.pool.get_nowait())
+                except queue.Empty:
+                    break
+            for conn in reversed(conns):
+                if conn is not None and conn.sock is not None and \
+                        now - getattr(conn, '_mdfs_idle_since', now) > idle_timeout:
+                    conn.close()
+                    reaped += 1
+                pool.pool.put_nowait(conn)
+        self.pool_stats.add('reaped', reaped)
+        return reaped
+
+
+def _release_on_return(raw, slots, pool_stats):
+    """ 连接归还到连接池时(响应读完或关闭)释放名额；响应被丢弃时也释放 """
+    state = {'released': False}
+    connection = raw.connection
+    # 用弱引用，不和响应形成循环引用，响应不用的时候能马上回收
+    raw_ref = weakref.ref(raw)
+
+    def release():
+        if not state['released']:
+            state['released'] = True
+            pool_stats.checkin()
+            slots.release()
+
+    def release_and_count():
+        response = raw_ref()
+        if response is not None:
+            type(response).release_conn(response)
+        if connection is not None:
+            connection._mdfs_idle_since = time.time()
+        release()
+
+    raw.release_conn = release_and_count
+    weakref.finalize(raw, release)
+
+
+def oss_pool(endpoint, pool_size=None, bucket_name=''):
+    """ endpoint共享的OssPool，oss2.Bucket使用它的session """
+    endpoint = normalize_endpoint(endpoint)
+    pool = shared(endpoint, lambda: OssPool(pool_size_for(endpoint, pool_size)))
+    pool.add_bucket(bucket_name)
+    return pool
@@ -0,0 +1,375 @@
+# encoding: utf-8
+""" 内容寻址的去重存储：相同内容只存一份blob，key是带引用计数的指针
+
+blob存在底层设备的 blobs/ 下，key到内容哈希的映射和引用计数存在SQLite中。
+"""
+
+import os
+import time
+import uuid
+import sqlite3
+import hashlib
+import mimetypes
+import threading
+from contextlib import contextmanager
+
+from .device import BaseDevice
+from .singleflight import file_lock
+from . import errors
+
+# 内容哈希算法
+HASH_NAME = 'sha256'
+# 上传中的临时文件的前缀
+TMP_PREFIX = '.dedup/tmp/'
+# blob的前缀
+BLOB_PREFIX = 'blobs/'
+
+
+def blob_key(digest):
+    """ 内容哈希对应的blob的key，两级目录 """
+    return '%s%s/%s/%s' % (BLOB_PREFIX, digest[:2], digest[2:4], digest)
+
+
+class DedupIndex:
+    """ key到内容哈希的映射，以及每个blob的引用计数，存在一个SQLite数据库(WAL模式)中 """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        dir_name = os.path.dirname(db_path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS refs ('
+                         'key TEXT PRIMARY KEY, hash TEXT NOT NULL, mtime REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS refs_hash ON refs (hash)')
+            conn.execute('CREATE TABLE IF NOT EXISTS blobs ('
+                         'hash TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                         'refcount INTEGER NOT NULL)')
+
+    def _conn(self):
+        """ 每个线程一个连接，事务由 transaction() 显式开始 """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def transaction(self):
+        """ 写事务，进程间互斥 """
+        return _Transaction(self._conn())
+
+    def lookup(self, key):
+        """ 返回 (hash, size, mtime)，不存在时返回None """
+        return self._conn().execute(
+            'SELECT refs.hash, blobs.size, refs.mtime FROM refs '
+            'JOIN blobs ON blobs.hash = refs.hash WHERE refs.key = ?', (key,)).fetchone()
+
+    def blob_size(self, digest):
+        row = self._conn().execute('SELECT size FROM blobs WHERE hash = ?', (digest,)).fetchone()
+        return row[0] if row else None
+
+    def keys(self, prefix):
+        return [row[0] for row in self._conn().execute(
+            'SELECT key FROM refs WHERE substr(key, 1, ?) = ?', (len(prefix), prefix))]
+
+    def stats(self):
+        conn = self._conn()
+        blobs, stored = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+        refs, logical = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(blobs.size), 0) FROM refs '
+            'JOIN blobs ON blobs.hash = refs.hash').fetchone()
+        return {'keys': refs, 'blobs': blobs, 'stored_bytes': stored, 'logical_bytes': logical}
+
+
+class _Transaction:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+    def blob_size(self, digest):
+        row = self.conn.execute('SELECT size FROM blobs WHERE hash = ?', (digest,)).fetchone()
+        return row[0] if row else None
+
+    def add_blob(self, digest, size):
+        self.conn.execute('INSERT INTO blobs (hash, size, refcount) VALUES (?, ?, 0)',
+                          (digest, size))
+
+    def get_ref(self, key):
+        row = self.conn.execute('SELECT hash FROM refs WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_ref(self, key, digest):
+        """ key指向digest，返回原来指向的、引用计数变为0的哈希 """
+        old = self.get_ref(key)
+        if old == digest:
+            self.conn.execute('UPDATE refs SET mtime = ? WHERE key = ?', (time.time(), key))
+            return None
+        self.conn.execute('INSERT OR REPLACE INTO refs (key, hash, mtime) VALUES (?, ?, ?)',
+                          (key, digest, time.time()))
+        self.conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?', (digest,))
+        return self._release(old) if old is not None else None
+
+    def delete_ref(self, key):
+        """ 删除key，返回引用计数变为0的哈希；key不存在时抛出KeyError """
+        old = self.get_ref(key)
+        if old is None:
+            raise KeyError(key)
+        self.conn.execute('DELETE FROM refs WHERE key = ?', (key,))
+        return self._release(old)
+
+    def _release(self, digest):
+        self.conn.execute('UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?', (digest,))
+        row = self.conn.execute('SELECT refcount FROM blobs WHERE hash = ?', (digest,)).fetchone()
+        if row is not None and row[0] <= 0:
+            self.conn.execute('DELETE FROM blobs WHERE hash = ?', (digest,))
+            return digest
+        return None
+
+
+class DedupDevice(BaseDevice):
+    """ 在任意设备上提供去重存储：写入时流式计算哈希，相同内容只存一次
+
+    copy_data 只增加引用；remove 在最后一个引用删除时才删除blob。
+    os_path 返回的是共享的blob，不能直接修改。
+    """
+
+    def __init__(self, name, device, db_path, title='', options={}):
+        self.name = name
+        self.title = title
+        self.options = options
+        self.device = device
+        self.index = DedupIndex(db_path)
+        self.lock_dir = os.path.join(os.path.dirname(db_path), '.dedup-locks')
+        # 本进程中的上传状态缓存 {session_id: {hasher, offset, lock}}，丢失时从临时文件重算
+        self._sessions = {}
+        # 正在读写的blob {digest: [lock, 使用数]}
+        self._blob_locks = {}
+        self._lock = threading.Lock()
+
+    def _blob(self, key):
+        row = self.index.lookup(key)
+        if row is None:
+            raise errors.FileNotFound(key)
+        return blob_key(row[0])
+
+    @contextmanager
+    def _blob_lock(self, digest):
+        """ 改名、删除blob文件时加锁，进程内用线程锁，进程间用锁文件
+
+        数据库事务中只改索引，文件操作都在这个锁里、事务之外做
+        """
+        with self._lock:
+            entry = self._blob_locks.setdefault(digest, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0], file_lock(os.path.join(self.lock_dir, digest)):
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    self._blob_locks.pop(digest, None)
+
+    def _free(self, digest):
+        """ 事务提交后删除引用计数为0的blob；加锁后再确认没有同样内容的新上传又用上它 """
+        if digest is None:
+            return
+        with self._blob_lock(digest):
+            if self.index.blob_size(digest) is not None:
+                return
+            try:
+                self.device.remove(blob_key(digest))
+            except (OSError, errors.FileNotFound):
+                pass
+
+    def gen_key(self, prefix='', suffix=''):
+        return self.device.gen_key(prefix, suffix)
+
+    def os_path(self, key):
+        return self.device.os_path(self._blob(key))
+
+    def exists(self, key):
+        return self.index.lookup(key) is not None
+
+    def stat(self, key):
+        row = self.index.lookup(key)
+        if row is None:
+            raise errors.FileNotFound(key)
+        digest, size, mtime = row
+        return {
+            "file_size": size,
+            "hash": '%s:%s' % (HASH_NAME, digest),
+            "mime_type": mimetypes.guess_type(key)[0],
+            "put_time": mtime
+        }
+
+    def get_data(self, key, offset=0, size=-1):
+        return self.device.get_data(self._blob(key), offset, size)
+
+    def iter_data(self, key, offset=0, size=-1, chunk_size=None):
+        return self.device.iter_data(self._blob(key), offset, size, chunk_size)
+
+    def multiput_new(self, key, size=-1):
+        """ 开始一个多次写入会话，数据先写到底层设备的临时文件
+
+        会话ID是 临时文件名:key长度:key底层会话ID，其他进程或重启后也能继续
+        """
+        tmp_name = uuid.uuid4().hex
+        session_id = '%s:%d:%s%s' % (tmp_name, len(key), key,
+                                     self.device.multiput_new(TMP_PREFIX + tmp_name, size))
+        with self._lock:
+            self._sessions[session_id] = self._new_state(hashlib.new(HASH_NAME), 0)
+        return session_id
+
+    def _new_state(self, hasher, offset):
+        return {'hasher': hasher, 'offset': offset, 'lock': threading.Lock()}
+
+    def _parse(self, session_id):
+        """ 返回 (key, 临时文件的key, 底层会话ID) """
+        try:
+            tmp_name, length, rest = session_id.split(':', 2)
+            length = int(length)
+        except ValueError:
+            raise errors.FileNotFound('upload session %s' % session_id)
+        return rest[:length], TMP_PREFIX + tmp_name, rest[length:]
+
+    def _state(self, session_id):
+        """ 本进程中的上传状态；没有时(其他进程开始的会话)哈希要在保存时重算 """
+        state = self._sessions.get(session_id)
+        if state is None:
+            offset = self.device.multiput_offset(self._parse(session_id)[2])
+            with self._lock:
+                state = self._sessions.setdefault(session_id, self._new_state(None, offset))
+        return state
+
+    def multiput_offset(self, session_id):
+        return self._state(session_id)['offset']
+
+    def multiput(self, session_id, data, offset=None):
+        """ 顺序写入，同时计算哈希；不能跳过或重写已写入的数据 """
+        inner = self._parse(session_id)[2]
+        state = self._state(session_id)
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = data.encode('utf-8')
+        with state['lock']:
+            if offset is not None and offset != state['offset']:
+                raise Exception('dedup upload must be sequential: offset %s, expected %s' % (
+                    offset, state['offset']))
+            self.device.multiput(inner, data, None)
+            if state['hasher'] is not None:
+                state['hasher'].update(data)
+            state['offset'] += len(data)
+            return state['offset']
+
+    def multiput_save(self, session_id):
+        """ 已有相同内容时删除临时文件，只增加引用 """
+        key, tmp_key, inner = self._parse(session_id)
+        state = self._state(session_id)
+        with state['lock']:
+            self.device.multiput_save(inner)
+            hasher = state['hasher']
+            if hasher is None:
+                hasher = hashlib.new(HASH_NAME)
+                for chunk in self.device.iter_data(tmp_key):
+                    hasher.update(chunk)
+            self._link(key, hasher.hexdigest(), state['offset'], tmp_key)
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        return key
+
+    def _link(self, key, digest, size, tmp_key):
+        """ key指向内容为digest的blob，blob还不存在时把临时文件改名为blob """
+        with self._blob_lock(digest):
+            with self.index.transaction() as transaction:
+                exists = transaction.blob_size(digest) is not None
+                freed = transaction.set_ref(key, digest) if exists else None
+            if not exists:
+                self.device.move(tmp_key, blob_key(digest))
+                with self.index.transaction() as transaction:
+                    transaction.add_blob(digest, size)
+                    freed = transaction.set_ref(key, digest)
+        if exists:
+            self.device.remove(tmp_key)
+        self._free(freed)
+
+    def multiput_delete(self, session_id):
+        inner = self._parse(session_id)[2]
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        self.device.multiput_delete(inner)
+
+    def cleanup(self, expire):
+        """ 删除超过expire秒没有写入的上传临时文件，返回删除的个数
+
+        只有底层设备是真实文件夹时才能列出临时文件
+        """
+        if not self.device.hierarchical:
+            return 0
+        tmp_dir = self.device.os_path(TMP_PREFIX.rstrip('/'))
+        try:
+            names = os.listdir(tmp_dir)
+        except OSError:
+            return 0
+        removed = 0
+        for name in names:
+            try:
+                if time.time() - os.path.getmtime(os.path.join(tmp_dir, name)) < expire:
+                    continue
+                self.device.remove(TMP_PREFIX + name)
+            except (OSError, errors.FileNotFound):
+                continue
+            removed += 1
+        return removed
+
+    def copy_data(self, from_key, to_key):
+        """ 只增加引用，不复制数据 """
+        with self.index.transaction() as transaction:
+            digest = transaction.get_ref(from_key)
+            if digest is None:
+                raise errors.FileNotFound(from_key)
+            freed = transaction.set_ref(to_key, digest)
+        self._free(freed)
+
+    def move(self, key, new_key):
+        if key == new_key:
+            return
+        with self.index.transaction() as transaction:
+            digest = transaction.get_ref(key)
+            if digest is None:
+                raise errors.FileNotFound(key)
+            freed = [transaction.set_ref(new_key, digest), transaction.delete_ref(key)]
+        for digest in freed:
+            self._free(digest)
+
+    def remove(self, key):
+        """ 删除key，最后一个引用删除时才删除blob """
+        with self.index.transaction() as transaction:
+            try:
+                digest = transaction.delete_ref(key)
+            except KeyError:
+                raise errors.FileNotFound(key)
+        self._free(digest)
+
+    def rmdir(self, key):
+        """ 删除前缀为key的所有key """
+        for sub_key in self.index.keys(key):
+            try:
+                self.remove(sub_key)
+            except errors.FileNotFound:
+                pass
+
+    def stats(self):
+        """ key数、blob数、实际存储的字节数和去重前的字节数 """
+        return self.index.stats()
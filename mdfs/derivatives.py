@@ -0,0 +1,99 @@
+# encoding: utf-8
+""" 衍生文件(缓存)索引：记录每个源文件生成的所有缓存，删除、改名时不用遍历缓存文件夹 """
+
+import os
+import time
+import sqlite3
+import threading
+
+
+class DerivativeIndex:
+    """ 所有设备的衍生文件索引存在一个SQLite数据库(WAL模式)中，按(device, key)查询 """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        dir_name = os.path.dirname(db_path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS derivatives ('
+                         'device TEXT NOT NULL, key TEXT NOT NULL, '
+                         'mime TEXT NOT NULL, subpath TEXT NOT NULL, '
+                         'size INTEGER NOT NULL, mtime REAL NOT NULL, '
+                         'PRIMARY KEY (device, key, mime, subpath))')
+
+    def _conn(self):
+        """ 每个线程一个连接 """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _rows(cursor):
+        return [{'mime': mime, 'subpath': subpath, 'size': size, 'mtime': mtime}
+                for mime, subpath, size, mtime in cursor.fetchall()]
+
+    def add(self, device, key, mime='', subpath='', size=0):
+        """ 记录一个缓存，已有的覆盖 """
+        with self._conn() as conn:
+            conn.execute('INSERT OR REPLACE INTO derivatives '
+                         '(device, key, mime, subpath, size, mtime) VALUES (?, ?, ?, ?, ?, ?)',
+                         (device, key, mime, subpath, size, time.time()))
+
+    def discard(self, device, key, mime='', subpath=''):
+        """ 删除一个缓存的记录，不存在的忽略 """
+        with self._conn() as conn:
+            conn.execute('DELETE FROM derivatives '
+                         'WHERE device = ? AND key = ? AND mime = ? AND subpath = ?',
+                         (device, key, mime, subpath))
+
+    def list(self, device, key):
+        """ 源文件的所有缓存 [{'mime', 'subpath', 'size', 'mtime'}, ...] """
+        return self._rows(self._conn().execute(
+            'SELECT mime, subpath, size, mtime FROM derivatives '
+            'WHERE device = ? AND key = ? ORDER BY mime, subpath', (device, key)))
+
+    def pop(self, device, key):
+        """ 删除源文件的所有缓存记录，返回删除的记录 """
+        return self.pop_many(device, [key])[key]
+
+    def pop_many(self, device, keys):
+        """ 批量删除源文件的缓存记录，返回 {key: 删除的记录} """
+        results = dict((key, []) for key in keys)
+        with self._conn() as conn:
+            for key in results:
+                results[key] = self._rows(conn.execute(
+                    'SELECT mime, subpath, size, mtime FROM derivatives '
+                    'WHERE device = ? AND key = ? ORDER BY mime, subpath', (device, key)))
+            conn.executemany('DELETE FROM derivatives WHERE device = ? AND key = ?',
+                             [(device, key) for key in results])
+        return results
+
+    def move(self, device, key, new_key):
+        """ 源文件改名，new_key原有的记录被覆盖；返回移动的记录 """
+        with self._conn() as conn:
+            rows = self._rows(conn.execute(
+                'SELECT mime, subpath, size, mtime FROM derivatives '
+                'WHERE device = ? AND key = ? ORDER BY mime, subpath', (device, key)))
+            if rows:
+                conn.execute('DELETE FROM derivatives WHERE device = ? AND key = ?',
+                             (device, new_key))
+                conn.execute('UPDATE derivatives SET key = ? WHERE device = ? AND key = ?',
+                             (new_key, device, key))
+        return rows
+
+    def total_size(self, device, key=None):
+        """ 源文件所有缓存的总字节数，key为None时统计整个设备 """
+        if key is None:
+            row = self._conn().execute('SELECT SUM(size) FROM derivatives WHERE device = ?',
+                                       (device,)).fetchone()
+        else:
+            row = self._conn().execute('SELECT SUM(size) FROM derivatives '
+                                       'WHERE device = ? AND key = ?', (device, key)).fetchone()
+        return row[0] or 0
@@ -4,13 +4,57 @@ import os
 import json
 import time
 import threading
+import contextvars
 from os.path import expanduser
+from concurrent.futures import ThreadPoolExecutor
 
-_local = threading.local()
+from . import errors
+from .metrics import Metrics
+
+# 当前线程或asyncio任务写入的文件 ((name, key), ...)，由 commit、abort 完结
+_put_files = contextvars.ContextVar('mdfs_put_files', default=())
 
 SESSION_DIR = os.path.join(expanduser("~") + ".mdfs-sessions")
+# 流式读取默认的数据块大小
+CHUNK_SIZE = 1024 * 1024
+# 批量操作没有原生接口时，并发逐个调用的线程数
+BATCH_WORKERS = 16
+
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+
+def get_batch_executor():
+    """ 批量操作共享的线程池 """
+    global _batch_executor
+    if _batch_executor is None:
+        with _batch_executor_lock:
+            if _batch_executor is None:
+                _batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+    return _batch_executor
+
+
+def _call(method, key):
+    """ 返回 (结果, 异常) """
+    try:
+        return method(key), None
+    except Exception as e:
+        return None, e
+
+def _cache_stats(device):
+    """ 设备自带缓存的命中统计：元数据缓存、本地文件缓存、顺序读预读 """
+    caches = {}
+    for cache_name, attr in (('meta', 'meta_cache'), ('local', 'cache'),
+                             ('readahead', 'readahead')):
+        cache = getattr(device, attr, None)
+        if cache is not None and hasattr(cache, 'stats'):
+            caches[cache_name] = cache.stats()
+    return caches
+
 
 class BaseDevice:
+    # key中的/是真实的文件夹，文件夹可以整体删除、改名
+    hierarchical = False
 
     def __init__(self, name, title='', options={}):
         self.name = name
@@ -31,6 +75,21 @@ class BaseDevice:
     def copy_data(self, from_key, to_key):
         """ 直接存储一个数据，适合小文件 """
 
+    def iter_data(self, key, offset=0, size=-1, chunk_size=None):
+        """ 从offset开始，按块返回数据，最多size字节 """
+        chunk_size = chunk_size or CHUNK_SIZE
+        while size != 0:
+            length = chunk_size if size == -1 else min(chunk_size, size)
+            data = self.get_data(key, offset, length)
+            if not data:
+                break
+            yield data
+            offset += len(data)
+            if size != -1:
+                size -= len(data)
+            if len(data) < length:
+                break
+
     def multiput_new(self, key, size):
         """ 开始一个多次写入会话, 返回会话ID"""
 
@@ -49,14 +108,62 @@ class BaseDevice:
     def remove(self, key):
         """ 删除key文件 """
 
+    def prefetch(self, keys, priority=0):
+        """ 在后台把keys下载到本地，返回加入队列的key数；本地设备不需要预取 """
+        return 0
+
+    def _map_keys(self, method, keys):
+        """ 在共享线程池中并发调用method(key)，返回 {key: (结果, 异常)} """
+        keys = list(dict.fromkeys(keys))
+        if len(keys) <= 1:
+            return dict((key, _call(method, key)) for key in keys)
+        results = get_batch_executor().map(lambda key: _call(method, key), keys)
+        return dict(zip(keys, results))
+
+    def exists_many(self, keys):
+        """ 批量判断是否存在，返回 {key: bool} """
+        results = {}
+        for key, (result, error) in self._map_keys(self.exists, keys).items():
+            if error is not None:
+                raise error
+            results[key] = result
+        return results
+
+    def stat_many(self, keys):
+        """ 批量得到状态，返回 {key: stat}，不存在的key为None """
+        results = {}
+        for key, (result, error) in self._map_keys(self.stat, keys).items():
+            if isinstance(error, (errors.FileNotFound, OSError)):
+                result = None
+            elif error is not None:
+                raise error
+            results[key] = result
+        return results
+
+    def remove_many(self, keys):
+        """ 批量删除，返回 {key: None或删除失败的异常}；一个key失败不影响其他key """
+        return dict((key, error) for key, (result, error)
+                    in self._map_keys(self.remove, keys).items())
+
+    def copy_many(self, pairs):
+        """ 并发复制 [(from_key, to_key), ...]，返回 {to_key: None或复制失败的异常} """
+        sources = dict((to_key, from_key) for from_key, to_key in pairs)
+        return dict((to_key, error) for to_key, (result, error) in self._map_keys(
+            lambda to_key: self.copy_data(sources[to_key], to_key), sources).items())
+
 
 class StorageDeviceManager:
     """ 支持缓存多设备的文件存储管理器 """
 
-    def __init__(self, session_dir=SESSION_DIR):
-
+    def __init__(self, session_dir=SESSION_DIR, sessions=None, derivatives=None, metrics=None):
+        """ sessions: 会话存储，默认每个会话一个文件存在session_dir
+        derivatives: 缓存索引(derivatives.DerivativeIndex)，可选；没有时按缓存文件夹删除、移动
+        metrics: 操作统计(metrics.Metrics)，默认新建一个
+        """
         self.devices = dict()
-        self.sessions = Sessions(session_dir=session_dir)
+        self.sessions = sessions if sessions is not None else Sessions(session_dir=session_dir)
+        self.derivatives = derivatives
+        self.metrics = metrics if metrics is not None else Metrics()
 
     def add(self, device, cache_device):
         self.devices[device.name] = (device, cache_device)
@@ -65,6 +172,30 @@ class StorageDeviceManager:
         device, cache_device = self.devices[name]
         return cache_device
 
+    def _timer(self, name, operation):
+        return self.metrics.timer(name, operation)
+
+    def _session(self, operation, name, key, **kwargs):
+        """ 会话记录的读写，单独统计为 session_new、session_update、session_delete """
+        with self._timer(name, 'session_' + operation):
+            return getattr(self.sessions, operation)(name, key, **kwargs)
+
+    def stats(self):
+        """ 各设备各操作的统计，以及设备自带的缓存命中率、写回模式的上传队列、预取队列
+        {设备名: {'operations': {操作: {count, errors, bytes, latency}}, 'caches': {...}}}
+        """
+        operations = self.metrics.snapshot()
+        result = {}
+        for name, (device, cache_device) in self.devices.items():
+            result[name] = {'operations': operations.pop(name, {}), 'caches': _cache_stats(device)}
+            if getattr(device, 'write_back', None) is not None:
+                result[name]['write_back'] = device.write_back.stats()
+            if getattr(device, 'prefetcher', None) is not None:
+                result[name]['prefetch'] = device.prefetcher.stats()
+        for name, ops in operations.items():
+            result[name] = {'operations': ops, 'caches': {}}
+        return result
+
     def gen_key(self, name, prefix='', suffix=''):
         """ 生成一个未用的key """
         device, cache_device = self.devices[name]
@@ -79,9 +210,43 @@ class StorageDeviceManager:
         else:
             return key + '___'
 
+    def put_cache(self, name, key, data, mime='', subpath=''):
+        """ 存储一个缓存，并记录到缓存索引，返回缓存的key """
+        cache_device = self.get_cache_device(name)
+        cache_key = self.get_cache_key(key, mime, subpath)
+        with self._timer(name, 'put_cache') as timer:
+            session_id = cache_device.multiput_new(cache_key, len(data))
+            cache_device.multiput(session_id, data, None)
+            cache_device.multiput_save(session_id)
+            timer.nbytes = len(data)
+        self.add_cache(name, key, mime, subpath, len(data))
+        return cache_key
+
+    def add_cache(self, name, key, mime='', subpath='', size=None):
+        """ 记录一个已经写到缓存设备的缓存，size为None时从缓存设备读取 """
+        if self.derivatives is None:
+            return
+        if size is None:
+            cache_key = self.get_cache_key(key, mime, subpath)
+            size = self.get_cache_device(name).stat(cache_key)['file_size']
+        self.derivatives.add(name, key, mime, subpath, size)
+
+    def list_cache(self, name, key):
+        """ 源文件的所有缓存 [{'mime', 'subpath', 'size', 'mtime'}, ...] """
+        if self.derivatives is None:
+            return []
+        return self.derivatives.list(name, key)
+
+    def cache_size(self, name, key=None):
+        """ 源文件所有缓存的总字节数，key为None时统计整个设备 """
+        if self.derivatives is None:
+            return 0
+        return self.derivatives.total_size(name, key)
+
     def os_path(self, name, key):
         device, cache_device = self.devices[name]
-        return device.os_path(key)
+        with self._timer(name, 'os_path'):
+            return device.os_path(key)
 
     #def cache_os_path(self, name, key):
     #    device, cache_device = self.devices[name]
@@ -89,63 +254,160 @@ class StorageDeviceManager:
 
     def exists(self, name, key):
         device, cache_device = self.devices[name]
-        return device.exists(key)
+        with self._timer(name, 'exists'):
+            return device.exists(key)
 
     def stat(self, name, key):
         device, cache_device = self.devices[name]
-        return device.stat(key)
+        with self._timer(name, 'stat'):
+            return device.stat(key)
+
+    def exists_many(self, name, keys):
+        """ 批量判断是否存在，返回 {key: bool} """
+        device, cache_device = self.devices[name]
+        with self._timer(name, 'exists_many'):
+            return device.exists_many(keys)
+
+    def stat_many(self, name, keys):
+        """ 批量得到状态，返回 {key: stat}，不存在的key为None """
+        device, cache_device = self.devices[name]
+        with self._timer(name, 'stat_many'):
+            return device.stat_many(keys)
 
     def remove(self, name, key):
         """ 删除一个文件，同时删除缓存 """
         device, cache_device = self.devices[name]
-        device.remove(key)
-        # TODO 需要删除所有的缓存
-        cache_key = self.get_cache_key(key)
-        if cache_device.exists(cache_key):
-            cache_device.rmdir(cache_key)
+        with self._timer(name, 'remove'):
+            device.remove(key)
+        if cache_device is not None:
+            self._remove_cache(name, cache_device, [key])
+
+    def remove_many(self, name, keys):
+        """ 批量删除文件和缓存，返回 {key: None或删除失败的异常} """
+        device, cache_device = self.devices[name]
+        with self._timer(name, 'remove_many'):
+            results = device.remove_many(keys)
+        if cache_device is not None:
+            self._remove_cache(name, cache_device,
+                               [key for key, error in results.items() if error is None])
+        return results
 
     def move(self, name, key, new_key):
         """ 更换key """
         device, cache_device = self.devices[name]
-        device.move(key, new_key)
-        # TODO 需要移动所有的缓存
-        cache_key = self.get_cache_key(key)
-        if cache_device.exists(cache_key):
-            cache_device.move(cache_key, self.get_cache_key(new_key))
+        with self._timer(name, 'move'):
+            device.move(key, new_key)
+        if cache_device is not None:
+            self._move_cache(name, cache_device, key, new_key)
+
+    def _remove_cache(self, name, cache_device, keys):
+        """ 批量删除索引记录的所有缓存；本地缓存或没有索引记录时，再删除整个缓存文件夹 """
+        if not keys:
+            return
+        with self._timer(name, 'remove_cache'):
+            self._remove_cache_entries(name, cache_device, keys)
+
+    def _remove_cache_entries(self, name, cache_device, keys):
+        entries = self.derivatives.pop_many(name, keys) if self.derivatives is not None else {}
+        cache_keys = [self.get_cache_key(key, entry['mime'], entry['subpath'])
+                      for key in keys for entry in entries.get(key, [])]
+        if cache_keys:
+            cache_device.remove_many(cache_keys)
+        folders = [self.get_cache_key(key) for key in keys
+                   if cache_device.hierarchical or not entries.get(key)]
+        for cache_key, exists in cache_device.exists_many(folders).items():
+            if exists:
+                cache_device.rmdir(cache_key)
+
+    def _move_cache(self, name, cache_device, key, new_key):
+        """ 本地缓存整个文件夹改名；对象存储逐个移动索引记录的缓存 """
+        with self._timer(name, 'move_cache'):
+            self._move_cache_entries(name, cache_device, key, new_key)
+
+    def _move_cache_entries(self, name, cache_device, key, new_key):
+        entries = self.derivatives.move(name, key, new_key) if self.derivatives is not None else []
+        if cache_device.hierarchical or not entries:
+            cache_key = self.get_cache_key(key)
+            if cache_device.exists(cache_key):
+                cache_device.move(cache_key, self.get_cache_key(new_key))
+            return
+        for entry in entries:
+            cache_device.move(self.get_cache_key(key, entry['mime'], entry['subpath']),
+                              self.get_cache_key(new_key, entry['mime'], entry['subpath']))
 
     def get_data(self, name, key, offset=0, size=-1):
         """ 读取数据 """
         device, cache_device = self.devices[name]
-        return device.get_data(key, offset, size)
+        with self._timer(name, 'get_data') as timer:
+            data = device.get_data(key, offset, size)
+            timer.nbytes = len(data)
+        return data
+
+    def prefetch(self, name, keys, priority=0):
+        """ 在后台把keys下载到设备的本地Cache，priority越大越先；返回加入队列的key数
+
+        例如用户打开文件夹时预取其中的文件，之后的os_path不用再等下载
+        """
+        device, cache_device = self.devices[name]
+        with self._timer(name, 'prefetch'):
+            return device.prefetch(keys, priority)
+
+    def iter_data(self, name, key, offset=0, size=-1, chunk_size=None):
+        """ 流式读取数据，内存占用有限 """
+        device, cache_device = self.devices[name]
+        return self.metrics.iter_bytes(name, 'iter_data',
+                                       device.iter_data(key, offset, size, chunk_size))
 
     def _t_add(self, name, key):
-        if getattr(_local, 'put_files', None) is None:
-            _local.put_files = [(name, key)]
-        else:
-            _local.put_files.append((name, key))
+        _put_files.set(_put_files.get() + ((name, key),))
+
+    def _t_pop(self):
+        """ 取出并清空当前线程或任务写入的文件 """
+        put_files = _put_files.get()
+        _put_files.set(())
+        return put_files
 
     def commit(self):
         """ 完结一个写入线程 """
-        #print 'commit mdfs', getattr(_local, 'put_files', [])
-        for (name, key) in getattr(_local, 'put_files', []):
-            self.sessions.delete(name, key)
-        _local.put_files = []
+        self._commit(self._t_pop())
+
+    def _commit(self, put_files):
+        for (name, key) in put_files:
+            self._session('delete', name, key)
 
     def abort(self):
         """ 删除一个写入会话 """
-        for (name, key) in getattr(_local, 'put_files', []):
+        self._abort(self._t_pop())
+
+    def _abort(self, put_files):
+        for (name, key) in put_files:
              self.remove(name, key)
-             self.sessions.delete(name, key)
-        _local.put_files = []
+             self._session('delete', name, key)
 
     def cleanup(self, expire):
-        """ 删除超时没有保存文件的中间文件 """
+        """ 删除超时没有保存文件的中间文件
+
+        删除成功的会话才删除记录；一个会话失败时记下错误继续，失败的留到下次再删
+        """
+        cleaned = []
         for session in self.sessions.query(expire=expire):
-            self.sessions.delete(session['device'], session['key'])
-            if session.get('session_id'):
-                self.multiput_delete(session['device'], session['session_id'])
-            else:
-                self.remove(session['device'], session['key'])
+            try:
+                if session.get('session_id'):
+                    self.multiput_delete(session['device'], session['session_id'])
+                else:
+                    self.remove(session['device'], session['key'])
+            except Exception as e:
+                print('cleanup session %s:%s error:%s' % (session['device'], session['key'], e))
+                continue
+            cleaned.append((session['device'], session['key']))
+        self.sessions.delete_many(cleaned)
+        # 设备自己的中间文件，如去重存储上传中的临时文件
+        for name, (device, cache_device) in self.devices.items():
+            if getattr(device, 'cleanup', None) is not None:
+                try:
+                    device.cleanup(expire)
+                except Exception as e:
+                    print('cleanup device %s error:%s' % (name, e))
 
     def put_data(self, name, key, data, mime_type=None):
         """ 存储数据 """
@@ -162,40 +424,67 @@ class StorageDeviceManager:
 
     def copy_data(self, name, from_key, to_key, auto_commit=False):
         """ 直接存储一个数据，适合小文件 """
-        device, cache_device = self.devices[name]
-        device.copy_data(from_key, to_key)
+        self._copy_data(name, from_key, to_key, auto_commit)
         if not auto_commit:
-            self.sessions.new(name, to_key)
             self._t_add(name, to_key)
 
+    def _copy_data(self, name, from_key, to_key, auto_commit):
+        device, cache_device = self.devices[name]
+        with self._timer(name, 'copy_data'):
+            device.copy_data(from_key, to_key)
+        if not auto_commit:
+            self._session('new', name, to_key)
+
+    def copy_many(self, name, pairs, auto_commit=False):
+        """ 并发复制 [(from_key, to_key), ...]，返回 {to_key: None或复制失败的异常} """
+        device, cache_device = self.devices[name]
+        with self._timer(name, 'copy_many'):
+            results = device.copy_many(pairs)
+        if not auto_commit:
+            for to_key, error in results.items():
+                if error is None:
+                    self._session('new', name, to_key)
+                    self._t_add(name, to_key)
+        return results
+
     def multiput_new(self, name, key, size=-1, mime_type=None):
         """ 开始一个多次写入会话, 返回会话ID"""
-        device, cache_device = self.devices[name]
-        session = device.multiput_new(key, size)
-        self.sessions.new(name, key, session_id=session)
+        session = self._multiput_new(name, key, size)
         self._t_add(name, key)
         return session
 
+    def _multiput_new(self, name, key, size):
+        device, cache_device = self.devices[name]
+        with self._timer(name, 'multiput_new'):
+            session = device.multiput_new(key, size)
+        self._session('new', name, key, session_id=session)
+        return session
+
     def multiput_offset(self, name, session_id):
         """ 会话写入位置 """
         device, cache_device = self.devices[name]
-        return device.multiput_offset(session_id)
+        with self._timer(name, 'multiput_offset'):
+            return device.multiput_offset(session_id)
 
     def multiput(self, name, session_id, data, offset=None):
         """ 多次写入会话 """
         device, cache_device = self.devices[name]
-        return device.multiput(session_id, data, offset)
+        with self._timer(name, 'multiput') as timer:
+            timer.nbytes = len(data)
+            return device.multiput(session_id, data, offset)
 
     def multiput_delete(self, name, session_id):
         """ 删除会话 """
         device, cache_device = self.devices[name]
-        return device.multiput_delete(session_id)
+        with self._timer(name, 'multiput_delete'):
+            return device.multiput_delete(session_id)
 
     def multiput_save(self, name, session_id):
         """ 保存、完结会话 """
         device, cache_device = self.devices[name]
-        key = device.multiput_save(session_id)
-        self.sessions.update(name, key, session_id='')
+        with self._timer(name, 'multiput_save'):
+            key = device.multiput_save(session_id)
+        self._session('update', name, key, session_id='')
         return key
 
 class Sessions:
@@ -226,6 +515,14 @@ class Sessions:
     def delete(self, device, key):
         os.remove(self.os_path(device, key))
 
+    def delete_many(self, items):
+        """ 批量删除 [(device, key), ...]，不存在的忽略 """
+        for device, key in items:
+            try:
+                self.delete(device, key)
+            except OSError:
+                pass
+
     def update(self, device, key, **kwargs):
         session = self.load(device, key)
         session.update(kwargs)
@@ -0,0 +1,133 @@
+# encoding: utf-8
+""" 并发分段下载：预分配目标文件，多个线程按字节范围读取并定位写入 """
+
+import os
+import uuid
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# 分段大小的上下限
+MIN_RANGE_SIZE = 1024 * 1024
+MAX_RANGE_SIZE = 16 * 1024 * 1024
+# 每个线程平均分到的分段数，越大负载越均衡，请求数也越多
+RANGES_PER_WORKER = 4
+RANGE_ALIGN = 64 * 1024
+
+
+def choose_range_size(total_size, concurrency, min_size=MIN_RANGE_SIZE):
+    """ 根据文件大小和并发数选择分段大小 """
+    range_size = total_size // (max(concurrency, 1) * RANGES_PER_WORKER)
+    range_size = max(min_size, min(max(MAX_RANGE_SIZE, min_size), range_size))
+    return (range_size + RANGE_ALIGN - 1) // RANGE_ALIGN * RANGE_ALIGN
+
+
+def preallocate(fd, size):
+    """ 预分配文件空间 """
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+
+class _PositionalWriter:
+    """ 定位写入，不支持pwrite的平台用锁保护seek+write """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self._lock = threading.Lock()
+
+    def write(self, offset, data):
+        view = memoryview(data)
+        if hasattr(os, 'pwrite'):
+            while view:
+                written = os.pwrite(self.fd, view, offset)
+                view = view[written:]
+                offset += written
+        else:
+            with self._lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                while view:
+                    view = view[os.write(self.fd, view):]
+
+
+def iter_ranges(read_range, offset, end, chunk_size, executor, readahead=2):
+    """ 按块顺序返回[offset, end)的数据，后台预读后面的readahead块 """
+    futures = deque()
+    next_offset = offset
+    try:
+        while futures or next_offset < end:
+            while next_offset < end and len(futures) <= readahead:
+                length = min(chunk_size, end - next_offset)
+                futures.append(executor.submit(read_range, next_offset, length))
+                next_offset += length
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def fetch_to_file(read_range, total_size, path, executor=None, concurrency=4,
+                  range_size=None, min_range_size=MIN_RANGE_SIZE):
+    """ 并发下载到path
+
+    read_range(offset, size) 返回该范围的数据；先写入临时文件，完成后改名，
+    其他进程不会看到写了一半的文件。
+    """
+    range_size = range_size or choose_range_size(total_size, concurrency, min_range_size)
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.exists(dir_name):
+        try:
+            os.makedirs(dir_name)
+        except OSError:
+            if not os.path.isdir(dir_name):
+                raise
+    tmp_path = '%s.%s.download' % (path, uuid.uuid4().hex)
+    fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+    own_executor = executor is None and total_size > range_size
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        preallocate(fd, total_size)
+        writer = _PositionalWriter(fd)
+
+        def fetch(offset):
+            size = min(range_size, total_size - offset)
+            data = read_range(offset, size)
+            if len(data) != size:
+                raise IOError('Short read at %d: %d != %d' % (offset, len(data), size))
+            writer.write(offset, data)
+
+        offsets = range(0, total_size, range_size)
+        if total_size <= range_size:
+            for offset in offsets:
+                fetch(offset)
+        else:
+            futures = [executor.submit(fetch, offset) for offset in offsets]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # 等待已经开始的分段结束，再关闭文件
+                for future in futures:
+                    future.cancel()
+                wait(futures)
+                raise
+        os.close(fd)
+        fd = None
+        os.replace(tmp_path, path)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+    return path
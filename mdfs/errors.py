@@ -1,2 +1,20 @@
 class FileNotFound(Exception):
   pass
+
+class MirrorError(Exception):
+  """ 镜像写入没有达到法定数，errors 为 {设备名: 异常} """
+
+  def __init__(self, message, errors):
+    Exception.__init__(self, message)
+    self.errors = errors
+
+class S3Error(Exception):
+  """ S3协议请求出错，status 为HTTP状态码，code 为S3错误码 """
+
+  def __init__(self, status, code='', message=''):
+    Exception.__init__(self, '%s %s: %s' % (status, code, message))
+    self.status = status
+    self.code = code
+
+class ChecksumMismatch(Exception):
+  """ 写入后的校验和和后端返回的不一致 """
@@ -0,0 +1,95 @@
+# encoding: utf-8
+""" 本地文件复制：写时复制文件系统上用reflink，其次内核态的copy_file_range，最后大缓冲区复制 """
+
+import os
+import errno
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# 缓冲区复制的大小
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+# copy_file_range每次调用复制的最大字节数
+COPY_RANGE_SIZE = 1024 * 1024 * 1024
+# 按优先顺序排列的复制方式
+STRATEGIES = ('reflink', 'copy_file_range', 'buffer')
+
+# 这些错误说明文件系统或内核不支持，这个设备以后不再尝试
+_UNSUPPORTED = set(getattr(errno, name) for name in
+                   ('EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'ENOSYS', 'EINVAL')
+                   if hasattr(errno, name))
+# 这些错误只和这一次复制有关(例如跨文件系统)，下次仍然尝试
+_SKIP = set(getattr(errno, name) for name in ('EXDEV', 'EBADF') if hasattr(errno, name))
+
+
+def reflink(src_fd, dst_fd, size):
+    """ 克隆整个文件，不复制数据 """
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, 'reflink is not supported')
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def copy_range(src_fd, dst_fd, size):
+    """ 在内核中复制，同一文件系统上可能由文件系统直接完成 """
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not supported')
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(src_fd, dst_fd, min(size - copied, COPY_RANGE_SIZE))
+        if count == 0:
+            break
+        copied += count
+    if copied < size:
+        raise OSError(errno.EIO, 'copy_file_range stopped at %d of %d' % (copied, size))
+
+
+def copy_buffer(src_fd, dst_fd, size):
+    """ 用大缓冲区在用户态复制 """
+    while True:
+        data = os.read(src_fd, COPY_BUFFER_SIZE)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+
+
+_COPY_FUNCTIONS = {
+    'reflink': reflink,
+    'copy_file_range': copy_range,
+    'buffer': copy_buffer,
+}
+
+
+def copy_file(src, dst, strategies=STRATEGIES, unsupported=None):
+    """ 依次尝试strategies中的复制方式，返回实际使用的方式
+
+    unsupported: 集合，记录不支持的方式，之后的复制直接跳过
+    """
+    with open(src, 'rb') as fsrc:
+        size = os.fstat(fsrc.fileno()).st_size
+        with open(dst, 'wb') as fdst:
+            for strategy in strategies:
+                if unsupported is not None and strategy in unsupported:
+                    continue
+                try:
+                    _COPY_FUNCTIONS[strategy](fsrc.fileno(), fdst.fileno(), size)
+                    break
+                except OSError as e:
+                    if strategy == 'buffer' or e.errno not in _UNSUPPORTED | _SKIP:
+                        raise
+                    if e.errno in _UNSUPPORTED and unsupported is not None:
+                        unsupported.add(strategy)
+                # 失败的方式可能已经复制了部分数据，从头开始
+                os.lseek(fsrc.fileno(), 0, os.SEEK_SET)
+                os.ftruncate(fdst.fileno(), 0)
+                os.lseek(fdst.fileno(), 0, os.SEEK_SET)
+            else:
+                raise OSError(errno.ENOTSUP, 'no copy strategy available: %s' % (strategies,))
+    shutil.copymode(src, dst)
+    return strategy
@@ -0,0 +1,86 @@
+# encoding: utf-8
+""" 远程设备的元数据(HEAD结果)缓存，不存在的key也缓存(negative cache) """
+
+import time
+import threading
+from collections import OrderedDict
+
+# 元数据缓存时间（秒）
+META_TTL = 30
+# key不存在的结果的缓存时间（秒）
+NEGATIVE_TTL = 5
+# 最多缓存的key数
+META_CACHE_SIZE = 10000
+
+_MISSING = object()
+
+
+class MetaCache:
+    """ 按key缓存stat结果，None表示key不存在；ttl为0时不缓存 """
+
+    def __init__(self, ttl=META_TTL, negative_ttl=NEGATIVE_TTL, maxsize=META_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        # 每次失效加一，load期间发生过失效的结果不缓存，避免写回旧值
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """ 返回缓存的值，没有或过期时调用load(key)并缓存 """
+        hit, value, now, generation = self._lookup(key)
+        if hit:
+            return value
+        return self._store(key, load(key), now, generation)
+
+    async def aget(self, key, aload):
+        """ get的协程版本，aload是协程函数 """
+        hit, value, now, generation = self._lookup(key)
+        if hit:
+            return value
+        return self._store(key, await aload(key), now, generation)
+
+    def _lookup(self, key):
+        """ 返回(是否命中, 缓存的值, 当前时间, 失效计数) """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] > now:
+                self.hits += 1
+                return True, entry[1], now, self._generation
+            self.misses += 1
+            return False, None, now, self._generation
+
+    def _store(self, key, value, now, generation):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl > 0:
+            with self._lock:
+                if generation != self._generation:
+                    return value
+                self._entries.pop(key, None)
+                self._entries[key] = (now + ttl, value)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def invalidate_prefix(self, prefix):
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
@@ -0,0 +1,149 @@
+# encoding: utf-8
+""" 按设备、操作统计的延迟直方图、读写字节数、错误数
+
+StorageDeviceManager 的每个操作都通过 Metrics.timer 记录；hooks 可以把每次记录转发给
+Prometheus、StatsD 等系统：hook(device, operation, seconds, nbytes, error)。
+"""
+
+import time
+import bisect
+import threading
+
+# 延迟直方图的桶上界（秒），最后一个桶是 +Inf
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """ 固定桶的直方图，counts[i] 是落在 (buckets[i-1], buckets[i]] 的次数 """
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """ 估计分位数，返回所在桶的上界；落在最后一个桶时返回 inf """
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+
+    def snapshot(self):
+        return {
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class _OpStats:
+
+    __slots__ = ('latency', 'errors', 'bytes')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.bytes = 0
+
+    def snapshot(self):
+        return {'count': self.latency.count, 'errors': self.errors, 'bytes': self.bytes,
+                'latency': self.latency.snapshot()}
+
+
+class _Timer:
+    """ 记录一次操作，nbytes 在操作中设置 """
+
+    __slots__ = ('metrics', 'device', 'operation', 'nbytes', 'start')
+
+    def __init__(self, metrics, device, operation):
+        self.metrics = metrics
+        self.device = device
+        self.operation = operation
+        self.nbytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is GeneratorExit:
+            # 流式读取没有读完就关闭，不是错误
+            exc = None
+        self.metrics.record(self.device, self.operation, time.perf_counter() - self.start,
+                            self.nbytes, exc)
+
+
+class Metrics:
+    """ 按 (设备名, 操作) 汇总，enabled 为False时不记录 """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.hooks = []
+        self._ops = {}
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """ hook(device, operation, seconds, nbytes, error)，error为None或异常；
+        在操作所在的线程中调用，应尽快返回 """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def timer(self, device, operation):
+        return _Timer(self, device, operation)
+
+    def record(self, device, operation, seconds, nbytes=0, error=None):
+        if not self.enabled:
+            return
+        key = (device, operation)
+        with self._lock:
+            stats = self._ops.get(key)
+            if stats is None:
+                stats = self._ops[key] = _OpStats()
+            stats.latency.observe(seconds)
+            stats.bytes += nbytes
+            if error is not None:
+                stats.errors += 1
+        for hook in self.hooks:
+            try:
+                hook(device, operation, seconds, nbytes, error)
+            except Exception as e:
+                print('metrics hook error:' + str(e))
+
+    def iter_bytes(self, device, operation, chunks):
+        """ 包装一个数据块迭代器，读完(或关闭)时记录总时间和字节数 """
+        timer = self.timer(device, operation)
+        with timer:
+            for data in chunks:
+                timer.nbytes += len(data)
+                yield data
+
+    def snapshot(self):
+        """ {设备名: {操作: {count, errors, bytes, latency}}} """
+        with self._lock:
+            items = [(key, stats.snapshot()) for key, stats in self._ops.items()]
+        result = {}
+        for (device, operation), stats in items:
+            result.setdefault(device, {})[operation] = stats
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._ops = {}
@@ -1,15 +1,125 @@
 # encoding: utf-8
 
+import time
+import errno
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed, FIRST_COMPLETED
+
 #from types import UnicodeType
 from .device import BaseDevice
+from .checksum import Checksum
+from . import errors
 try:
     from types import UnicodeType
 except ImportError:
     UnicodeType = None
 
+# 所有镜像设备共享的线程池大小
+MIRROR_WORKERS = 16
+# 最多记录的落后镜像操作数
+LAGGING_LIMIT = 1000
+# 读取出错的镜像跳过的时间（秒）
+ERROR_COOLDOWN = 30
+# 延迟的滑动平均系数和用于计算百分位的样本数
+LATENCY_ALPHA = 0.2
+LATENCY_WINDOW = 100
+# 样本数少于这个值时不发对冲请求
+HEDGE_MIN_SAMPLES = 10
+# 一个镜像上同一个上传会话最多排队的操作数，再落后就让这个镜像退出该会话
+MAX_PENDING = 32
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """ 共享的镜像写入线程池 """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=MIRROR_WORKERS)
+    return _executor
+
+
+def _not_found(error):
+    """ 文件不存在的错误，不代表镜像有故障 """
+    return isinstance(error, (errors.FileNotFound, KeyError)) or \
+        getattr(error, 'errno', None) == errno.ENOENT or \
+        getattr(error, 'status', None) == 404
+
+
+class ReadScheduler:
+    """ 记录每个镜像的读取延迟，选择最快的健康镜像 """
+
+    def __init__(self, devices, error_cooldown=ERROR_COOLDOWN):
+        self.devices = devices
+        self.error_cooldown = error_cooldown
+        self._lock = threading.Lock()
+        self._latency = dict((device.name, None) for device in devices)
+        self._samples = dict((device.name, deque(maxlen=LATENCY_WINDOW)) for device in devices)
+        self._skip_until = dict((device.name, 0) for device in devices)
+
+    def candidates(self):
+        """ 健康的镜像按延迟排序，没有样本的优先，以便得到延迟估计 """
+        now = time.time()
+        with self._lock:
+            healthy = [device for device in self.devices if self._skip_until[device.name] <= now]
+            if not healthy:
+                # 全部出错，尽早恢复的优先
+                return sorted(self.devices, key=lambda device: self._skip_until[device.name])
+            return sorted(healthy, key=lambda device: self._latency[device.name] or 0)
+
+    def record(self, device, elapsed):
+        with self._lock:
+            latency = self._latency[device.name]
+            if latency is None:
+                self._latency[device.name] = elapsed
+            else:
+                self._latency[device.name] = latency + LATENCY_ALPHA * (elapsed - latency)
+            self._samples[device.name].append(elapsed)
+
+    def record_error(self, device):
+        with self._lock:
+            self._skip_until[device.name] = time.time() + self.error_cooldown
+
+    def percentile(self, device, percent):
+        """ 延迟的百分位，样本不足时返回None """
+        with self._lock:
+            samples = sorted(self._samples[device.name])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return dict((name, {'latency': self._latency[name],
+                                'healthy': self._skip_until[name] <= now})
+                        for name in self._latency)
+
+
+class _Lane:
+    """ 一个镜像上同一个会话或key的操作队列，由一个线程依次执行，不占用其他线程等待 """
+
+    def __init__(self, sticky):
+        # 上传会话：失败后退出该会话，之后的操作直接失败，直到保存或删除会话
+        self.sticky = sticky
+        # [(operation, args, future, force)]
+        self.tasks = deque()
+        self.running = False
+        self.error = None
+        # 会话已经保存或删除，执行完后移除
+        self.closing = False
+        self.tail = None
+
+
 class MirrorDevice(BaseDevice):
 
-    def __init__(self, name, title='', mirror_devices=[], read_devices=[], options={}):
+    def __init__(self, name, title='', mirror_devices=[], read_devices=[], options={},
+                 write_quorum=None, hedge_percentile=None, error_cooldown=ERROR_COOLDOWN,
+                 checksum=None, max_pending=MAX_PENDING):
         self.name = name
         self.title = title
         self.options = options
@@ -21,10 +131,187 @@ class MirrorDevice(BaseDevice):
                     self.read_device = device
         else:
             self.read_device = mirror_devices[0]
+        # 读取在read_devices中选择最快的健康镜像，未指定时在全部镜像中选择
+        read_mirrors = [device for device in mirror_devices if device.name in read_devices]
+        self.scheduler = ReadScheduler(read_mirrors or mirror_devices, error_cooldown)
+        # 首选镜像超过这个延迟百分位还没有返回，就向第二个镜像发对冲请求
+        self.hedge_percentile = hedge_percentile
+        # 写入成功的镜像数达到write_quorum就返回，默认全部镜像
+        self.write_quorum = write_quorum or len(mirror_devices)
+        # 落后(写入失败)的镜像，留待修复: [{'device', 'operation', 'args', 'error'}]
+        self.lagging = deque(maxlen=LAGGING_LIMIT)
+        self._lock = threading.Lock()
+        # 每个镜像上同一个会话或key的操作按顺序执行: {(镜像序号, 会话或key): _Lane}
+        self._lanes = {}
+        self.max_pending = max_pending
+        # 写入时计算的校验和算法，保存后和各镜像stat返回的校验和比较
+        self.checksum = checksum
+        self._checksums = {}
+
+    def _submit(self, index, chain_key, operation, args, sticky=False, force=False):
+        """ 在镜像index上执行操作，排在同一个chain_key的前一个操作之后
+
+        sticky: 上传会话，失败或落后超过max_pending个操作后，这个镜像退出该会话
+        force: 删除会话，丢弃排队的操作，不管之前是否失败都执行；数据已经不存在也算成功
+        """
+        device = self.mirror_devices[index]
+        lane_key = (index, chain_key)
+        future = Future()
+        if sticky and not chain_key:
+            # 开始会话时就失败的镜像不在这个会话中，没有需要删除的
+            if force:
+                future.set_result(None)
+            else:
+                future.set_exception(errors.MirrorError('%s: not in session' % device.name, {}))
+            return future
+        failed = []
+        with self._lock:
+            lane = self._lanes.get(lane_key)
+            if lane is None:
+                lane = self._lanes[lane_key] = _Lane(sticky)
+            if force:
+                failed.extend(lane.tasks)
+                lane.tasks.clear()
+                error = errors.MirrorError('%s: session deleted' % device.name, {})
+            elif sticky and lane.error is None and len(lane.tasks) >= self.max_pending:
+                lane.error = errors.MirrorError('%s: %d operations behind' % (
+                    device.name, len(lane.tasks)), {})
+                self.lagging.append({'device': device.name, 'operation': operation,
+                                     'args': (chain_key,), 'error': lane.error})
+                failed.extend(lane.tasks)
+                lane.tasks.clear()
+            if force or operation == 'multiput_save':
+                lane.closing = True
+            lane.tasks.append((operation, args, future, force))
+            lane.tail = future
+            start = not lane.running
+            lane.running = True
+        for task in failed:
+            task[2].set_exception(lane.error or error)
+        if start:
+            get_executor().submit(self._drain, device, lane_key, lane)
+        return future
+
+    def _drain(self, device, lane_key, lane):
+        """ 依次执行lane中的操作，队列空了就退出 """
+        while True:
+            with self._lock:
+                if not lane.tasks:
+                    lane.running = False
+                    if (not lane.sticky or lane.closing) and self._lanes.get(lane_key) is lane:
+                        del self._lanes[lane_key]
+                    return
+                operation, args, future, force = lane.tasks.popleft()
+                error = None if force else lane.error
+            if not future.set_running_or_notify_cancel():
+                continue
+            if error is not None:
+                # 已经退出该会话，不再执行；保存失败仍然记为落后
+                if operation != 'multiput':
+                    self._record_lagging(device, operation, args, error)
+                future.set_exception(error)
+                continue
+            try:
+                result = getattr(device, operation)(*args)
+            except Exception as e:
+                if force and _not_found(e):
+                    future.set_result(None)
+                    continue
+                with self._lock:
+                    if lane.sticky and lane.error is None:
+                        lane.error = e
+                self._record_lagging(device, operation, args, e)
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def _record_lagging(self, device, operation, args, error):
+        with self._lock:
+            self.lagging.append({'device': device.name, 'operation': operation,
+                                 'args': args, 'error': error})
+
+    def _wait_tail(self, index, chain_key):
+        """ 等待镜像index上chain_key的操作全部完成 """
+        with self._lock:
+            lane = self._lanes.get((index, chain_key))
+            future = lane.tail if lane is not None else None
+        if future is not None:
+            wait([future])
+
+    def _fanout(self, operation, chain_keys, args_list, quorum=None, sticky=False, force=False):
+        """ 并发在所有镜像上执行，quorum个成功就返回最靠前的镜像的结果 """
+        futures = [self._submit(index, chain_keys[index], operation, args_list[index],
+                                sticky, force)
+                   for index in range(len(self.mirror_devices))]
+        return self._quorum(operation, futures, quorum)
+
+    def _quorum(self, operation, futures, quorum=None):
+        """ 等待quorum个成功，返回最靠前的镜像的结果；不够时抛出MirrorError """
+        quorum = quorum or self.write_quorum
+        pending = set(futures)
+        succeeded, failed = 0, 0
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    succeeded += 1
+                else:
+                    failed += 1
+            if succeeded >= quorum or failed > len(futures) - quorum:
+                break
+
+        if succeeded < quorum:
+            mirror_errors = {}
+            for index, future in enumerate(futures):
+                if future.done() and future.exception() is not None:
+                    mirror_errors[self.mirror_devices[index].name] = future.exception()
+            raise errors.MirrorError('%s: %d of %d mirrors succeeded, %d required' % (
+                operation, succeeded, len(futures), quorum), mirror_errors)
+        for future in futures:
+            if future.done() and future.exception() is None:
+                return future.result()
+
+    def _timed_read(self, device, operation, args):
+        start = time.time()
+        try:
+            result = getattr(device, operation)(*args)
+        except Exception as e:
+            if not _not_found(e):
+                self.scheduler.record_error(device)
+            raise
+        self.scheduler.record(device, time.time() - start)
+        return result
+
+    def _read(self, operation, *args):
+        """ 从最快的健康镜像读取，出错时依次尝试下一个镜像 """
+        candidates = self.scheduler.candidates()
+        threshold = None
+        if self.hedge_percentile and len(candidates) > 1:
+            threshold = self.scheduler.percentile(candidates[0], self.hedge_percentile)
+
+        error = None
+        if threshold is not None:
+            futures = [get_executor().submit(self._timed_read, candidates[0], operation, args)]
+            done, pending = wait(futures, timeout=threshold)
+            if not done:
+                futures.append(get_executor().submit(
+                    self._timed_read, candidates[1], operation, args))
+            for future in as_completed(futures):
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            candidates = candidates[len(futures):]
+
+        for device in candidates:
+            try:
+                return self._timed_read(device, operation, args)
+            except Exception as e:
+                error = e
+        raise error
 
     def os_path(self, key):
         """ 找到key在操作系统中的地址 """
-        return self.read_device.os_path(key)
+        return self._read('os_path', key)
 
     def gen_key(self, prefix='', suffix=''):
         """
@@ -36,74 +323,164 @@ class MirrorDevice(BaseDevice):
         return self.mirror_devices[0].gen_key(prefix, suffix)
 
     def exists(self, key):
-        return self.read_device.exists(key)
+        return self._read('exists', key)
 
     def get_data(self, key, offset=0, size=-1):
         """ 根据key返回文件内容，适合小文件 """
-        return self.read_device.get_data(key, offset, size)
+        return self._read('get_data', key, offset, size)
+
+    def iter_data(self, key, offset=0, size=-1, chunk_size=None):
+        """ 从最快的健康镜像流式读取 """
+        device = self.scheduler.candidates()[0]
+        return device.iter_data(key, offset, size, chunk_size)
 
     def multiput_new(self, key, size=-1):
-        """ 开始一个多次写入会话, 返回会话ID"""
-        results = []
-        for device in self.mirror_devices:
-            results.append(device.multiput_new(key, size))
-        return "|".join(results)
+        """ 开始一个多次写入会话, 返回会话ID
+
+        失败的镜像记为落后，会话ID中对应的位置为空，之后的操作跳过它；
+        成功的少于write_quorum时删除已经开始的会话后报错
+        """
+        count = len(self.mirror_devices)
+        futures = [get_executor().submit(device.multiput_new, key, size)
+                   for device in self.mirror_devices]
+        wait(futures)
+        mirror_errors = {}
+        for device, future in zip(self.mirror_devices, futures):
+            if future.exception() is not None:
+                mirror_errors[device.name] = future.exception()
+                self._record_lagging(device, 'multiput_new', (key, size), future.exception())
+        if count - len(mirror_errors) < self.write_quorum:
+            for device, future in zip(self.mirror_devices, futures):
+                if future.exception() is None:
+                    try:
+                        device.multiput_delete(future.result())
+                    except Exception as e:
+                        print('multiput_new %s delete session error:%s' % (device.name, e))
+            raise errors.MirrorError('multiput_new: %d of %d mirrors failed' % (
+                len(mirror_errors), count), mirror_errors)
+        session_id = "|".join('' if future.exception() is not None else future.result()
+                              for future in futures)
+        if self.checksum:
+            with self._lock:
+                self._checksums[session_id] = Checksum(self.checksum)
+        return session_id
 
     def multiput_offset(self, session_id):
-        """ 某个文件当前上传位置 """
-        return self.mirror_devices[0].multiput_offset(session_id.split("|", 1)[0])
+        """ 某个文件当前上传位置，从还在会话中的镜像查询 """
+        error = None
+        for index, session in enumerate(session_id.split("|")):
+            if not session:
+                continue
+            with self._lock:
+                lane = self._lanes.get((index, session))
+                if lane is not None and lane.error is not None:
+                    continue
+            self._wait_tail(index, session)
+            with self._lock:
+                if lane is not None and lane.error is not None:
+                    continue
+            try:
+                return self.mirror_devices[index].multiput_offset(session)
+            except Exception as e:
+                error = e
+        raise error or errors.MirrorError('multiput_offset: no mirror in session', {})
 
     def multiput(self, session_id, data, offset=None):
         """ 从offset处写入数据 """
-        results = []
         sessions = session_id.split("|")
-        for index, device in enumerate(self.mirror_devices):
-            results.append(device.multiput(sessions[index], data, offset))
-        return results[0]
+        checksum = self._checksums.get(session_id)
+        if checksum is not None:
+            checksum.update(data, offset)
+        return self._fanout('multiput', sessions,
+                            [(session, data, offset) for session in sessions], sticky=True)
 
     def multiput_save(self, session_id):
         """ 某个文件当前上传位置 """
-        results = []
         sessions = session_id.split("|")
-        for index, device in enumerate(self.mirror_devices):
-            results.append(device.multiput_save(sessions[index]))
-        return results[0]
+        with self._lock:
+            checksum = self._checksums.pop(session_id, None)
+        futures = [self._submit(index, session, 'multiput_save', (session,), sticky=True)
+                   for index, session in enumerate(sessions)]
+        for index, future in enumerate(futures):
+            # 保存失败的镜像，删除它写了一半的会话
+            future.add_done_callback(lambda future, index=index: self._discard_failed(
+                future, index, sessions[index]))
+        key = self._quorum('multiput_save', futures)
+        if checksum is not None and checksum.value() is not None:
+            self._verify_checksum(key, checksum.value(), futures)
+        return key
+
+    def _discard_failed(self, future, index, session):
+        if future.exception() is not None:
+            self._submit(index, session, 'multiput_delete', (session,), sticky=True, force=True)
+
+    def _verify_checksum(self, key, value, tails):
+        """ 比较各镜像保存的校验和，不一致的镜像记为落后；一致的少于write_quorum时报错
+
+        tails是各镜像保存的future，还在保存的镜像上可能还是旧文件，保存完成后再在后台比较
+        """
+        def check_later(tail, device):
+            if tail.exception() is None:
+                get_executor().submit(self._check_mirror, device, key, value)
+
+        futures = {}
+        for device, tail in zip(self.mirror_devices, tails):
+            if tail.done():
+                if tail.exception() is None:
+                    futures[device.name] = get_executor().submit(
+                        self._check_mirror, device, key, value)
+            else:
+                tail.add_done_callback(lambda tail, device=device: check_later(tail, device))
+        mismatched = {}
+        for name, future in futures.items():
+            error = future.result()
+            if error is not None:
+                mismatched[name] = error
+        if len(self.mirror_devices) - len(mismatched) < self.write_quorum:
+            raise errors.MirrorError('multiput_save: checksum mismatch on %d of %d mirrors' % (
+                len(mismatched), len(self.mirror_devices)), mismatched)
+
+    def _check_mirror(self, device, key, value):
+        """ 镜像保存的校验和和value不一致时记为落后，返回ChecksumMismatch """
+        try:
+            stored = device.stat(key).get('hash')
+        except Exception:
+            return None
+        if not stored or not stored.startswith(value.split(':', 1)[0] + ':') or stored == value:
+            return None
+        error = errors.ChecksumMismatch('%s: %s, expected %s' % (key, stored, value))
+        with self._lock:
+            self.lagging.append({'device': device.name, 'operation': 'multiput_save',
+                                 'args': (key,), 'error': error})
+        return error
 
     def multiput_delete(self, session_id):
-        """ 删除一个写入会话 """
-        results = []
+        """ 删除一个写入会话，在所有镜像上执行，已经失败、退出会话的镜像也删除 """
         sessions = session_id.split("|")
-        for index, device in enumerate(self.mirror_devices):
-            results.append(device.multiput_delete(sessions[index]))
-        return results[0]
+        with self._lock:
+            self._checksums.pop(session_id, None)
+        return self._fanout('multiput_delete', sessions,
+                            [(session,) for session in sessions],
+                            quorum=len(sessions), sticky=True, force=True)
 
     def remove(self, key):
         """ 删除key文件 """
-        results = []
-        for device in self.mirror_devices:
-            results.append(device.remove(key))
-        return results[0]
+        count = len(self.mirror_devices)
+        return self._fanout('remove', [key] * count, [(key,)] * count)
 
     def rmdir(self, key):
         """ 删除key文件夹"""
-        results = []
-        for device in self.mirror_devices:
-            results.append(device.rmdir(key))
-        return results[0]
+        count = len(self.mirror_devices)
+        return self._fanout('rmdir', [key] * count, [(key,)] * count, quorum=count)
 
     def move(self, key, new_key):
         """ 升级旧的key，更换为一个新的 """
-        results = []
-        for device in self.mirror_devices:
-            results.append(device.move(key, new_key))
-        return results[0]
+        count = len(self.mirror_devices)
+        return self._fanout('move', [key] * count, [(key, new_key)] * count)
 
     def copy_data(self, from_key, to_key):
-        results = []
-        for device in self.mirror_devices:
-            results.append(device.copy_data(from_key, to_key))
-        return results[0]
+        count = len(self.mirror_devices)
+        return self._fanout('copy_data', [to_key] * count, [(from_key, to_key)] * count)
 
     def stat(self, key):
-        return self.read_device.stat(key)
-
+        return self._read('stat', key)
@@ -0,0 +1,274 @@
+# encoding: utf-8
+""" 对象存储设备的预取：批量把文件下载到本地Cache，以及get_data顺序读时预读后面的范围 """
+
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+
+# 后台预取文件的线程数
+PREFETCH_WORKERS = 4
+# 排队等待预取的最多文件数，超过的丢弃
+MAX_QUEUE = 10000
+# get_data 顺序读时预读的范围数，默认0不预读，需要时在设备上打开
+RANGE_READAHEAD = 0
+# 连续读到这么多个相邻的范围，才认为是顺序读
+SEQUENTIAL_READS = 2
+# 超过这个大小的读取不预读
+MAX_READAHEAD_SIZE = 8 * 1024 * 1024
+# 同时跟踪的顺序读的文件数，超过的淘汰最久没有读的
+MAX_STREAMS = 64
+# 所有文件预读中、预读好还没有读走的数据的总大小上限
+MAX_AHEAD_BYTES = 64 * 1024 * 1024
+
+
+class Prefetcher:
+    """ 按优先级在后台调用 fetch(key)，priority越大越先；同一个key只排队一次 """
+
+    def __init__(self, fetch, workers=PREFETCH_WORKERS, max_queue=MAX_QUEUE):
+        self.fetch = fetch
+        self.workers = workers
+        self.max_queue = max_queue
+        # [(-priority, 序号, key)]，取消、提高优先级后留下的旧项在取出时跳过
+        self._heap = []
+        # 排队中的 {key: priority}
+        self._queued = {}
+        self._running = set()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._threads = []
+        self._stop = False
+        self.fetched = self.errors = self.dropped = 0
+        self.last_error = None
+
+    def add(self, keys, priority=0):
+        """ 加入预取队列，返回新加入(或提高了优先级)的key数 """
+        added = 0
+        with self._changed:
+            for key in keys:
+                if key in self._running or self._queued.get(key, priority - 1) >= priority:
+                    continue
+                if key not in self._queued and len(self._queued) >= self.max_queue:
+                    self.dropped += 1
+                    continue
+                self._queued[key] = priority
+                heapq.heappush(self._heap, (-priority, next(self._counter), key))
+                added += 1
+            if added:
+                self._start()
+                self._changed.notify_all()
+        return added
+
+    def cancel(self, keys=None):
+        """ 取消排队中的key，keys为None时取消全部；正在下载的不中断 """
+        with self._changed:
+            if keys is None:
+                self._queued.clear()
+                self._heap = []
+            else:
+                for key in keys:
+                    self._queued.pop(key, None)
+            self._changed.notify_all()
+
+    def _start(self):
+        """ 第一次有任务时启动线程，调用时持有锁 """
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name='mdfs-prefetch')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self):
+        """ 取出优先级最高的key，停止时返回None """
+        with self._changed:
+            while not self._stop:
+                while self._heap:
+                    priority, number, key = heapq.heappop(self._heap)
+                    if self._queued.get(key) == -priority:
+                        del self._queued[key]
+                        self._running.add(key)
+                        return key
+                self._changed.wait()
+        return None
+
+    def _run(self):
+        while True:
+            key = self._next()
+            if key is None:
+                return
+            try:
+                self.fetch(key)
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                    self.last_error = '%s: %s' % (key, e)
+            else:
+                with self._lock:
+                    self.fetched += 1
+            finally:
+                with self._changed:
+                    self._running.discard(key)
+                    self._changed.notify_all()
+
+    def wait(self, timeout=None):
+        """ 等待队列中的key都预取完，超时返回False """
+        with self._changed:
+            return self._changed.wait_for(lambda: not self._queued and not self._running,
+                                          timeout)
+
+    def stats(self):
+        with self._lock:
+            return {'queued': len(self._queued), 'running': len(self._running),
+                    'fetched': self.fetched, 'errors': self.errors, 'dropped': self.dropped,
+                    'last_error': self.last_error}
+
+    def stop(self):
+        """ 停止后台线程，排队中的丢弃 """
+        with self._changed:
+            self._stop = True
+            self._queued.clear()
+            self._heap = []
+            self._changed.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+class _Stream:
+    """ 一个文件的顺序读状态 """
+
+    def __init__(self):
+        self.next_offset = None
+        # 连续读到的相邻范围数
+        self.run = 0
+        # 已经提交预读的范围 {offset: (size, future)}
+        self.ahead = {}
+        self.ahead_end = None
+        self.total_size = None
+
+    def reset(self):
+        """ 丢弃预读，返回丢弃的字节数 """
+        dropped = 0
+        for size, future in self.ahead.values():
+            future.cancel()
+            dropped += size
+        self.ahead = {}
+        self.ahead_end = None
+        self.run = 0
+        return dropped
+
+
+class Readahead:
+    """ 检测对同一个key的顺序范围读取，在后台预读后面的ranges个范围
+
+    read_range(key, offset, size) 读取数据，size_of(key) 返回文件大小，
+    get_executor() 返回执行预读的线程池；所有文件预读的数据不超过max_bytes
+    """
+
+    def __init__(self, read_range, size_of, get_executor, ranges=RANGE_READAHEAD,
+                 sequential_reads=SEQUENTIAL_READS, max_size=MAX_READAHEAD_SIZE,
+                 max_streams=MAX_STREAMS, max_bytes=MAX_AHEAD_BYTES):
+        self.read_range = read_range
+        self.size_of = size_of
+        self.get_executor = get_executor
+        self.ranges = ranges
+        self.sequential_reads = sequential_reads
+        self.max_size = max_size
+        self.max_streams = max_streams
+        self.max_bytes = max_bytes
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+        # 所有文件预读中和预读好还没有读走的字节数
+        self._ahead_bytes = 0
+        self.hits = self.misses = self.skipped = 0
+
+    def get_data(self, key, offset, size):
+        """ 读取[offset, offset + size)，命中预读时用预读的数据 """
+        if size <= 0 or size > self.max_size:
+            return self.read_range(key, offset, size)
+        with self._lock:
+            stream = self._stream(key)
+            prefetched = stream.ahead.pop(offset, None)
+            if prefetched is not None:
+                self._ahead_bytes -= prefetched[0]
+            if offset == stream.next_offset:
+                stream.run += 1
+            else:
+                self._ahead_bytes -= stream.reset()
+                stream.run = 1
+            stream.next_offset = offset + size
+            # 读取大小变了，对不上的预读已经没用
+            for stale in [start for start in stream.ahead if start < stream.next_offset]:
+                length, future = stream.ahead.pop(stale)
+                future.cancel()
+                self._ahead_bytes -= length
+            sequential = stream.run >= self.sequential_reads
+            need_size = sequential and stream.total_size is None
+
+        if need_size:
+            total_size = self.size_of(key)
+            with self._lock:
+                stream.total_size = total_size
+        if sequential:
+            self._schedule(key, stream, size)
+
+        data = None
+        if prefetched is not None and prefetched[0] >= size:
+            try:
+                data = prefetched[1].result()[:size]
+            except Exception:
+                data = None
+        if sequential:
+            with self._lock:
+                if data is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        if data is None:
+            data = self.read_range(key, offset, size)
+        return data
+
+    def _stream(self, key):
+        """ 调用时持有锁 """
+        stream = self._streams.pop(key, None)
+        if stream is None:
+            stream = _Stream()
+            while len(self._streams) >= self.max_streams:
+                self._ahead_bytes -= self._streams.popitem(last=False)[1].reset()
+        self._streams[key] = stream
+        return stream
+
+    def _schedule(self, key, stream, size):
+        """ 预读next_offset之后的范围，保持ranges个在途；总大小到了max_bytes时不再预读 """
+        with self._lock:
+            if self._streams.get(key) is not stream or stream.total_size is None:
+                return
+            offset = max(stream.ahead_end or 0, stream.next_offset)
+            while len(stream.ahead) < self.ranges and offset < stream.total_size:
+                length = min(size, stream.total_size - offset)
+                if self._ahead_bytes + length > self.max_bytes:
+                    self.skipped += 1
+                    break
+                future = self.get_executor().submit(self.read_range, key, offset, length)
+                stream.ahead[offset] = (length, future)
+                self._ahead_bytes += length
+                offset += length
+            stream.ahead_end = offset
+
+    def invalidate(self, key):
+        """ 文件被改写或删除，丢弃预读的数据 """
+        with self._lock:
+            stream = self._streams.pop(key, None)
+            if stream is not None:
+                self._ahead_bytes -= stream.reset()
+
+    def invalidate_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._streams if key.startswith(prefix)]:
+                self._ahead_bytes -= self._streams.pop(key).reset()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'skipped': self.skipped,
+                    'streams': len(self._streams), 'ahead_bytes': self._ahead_bytes}
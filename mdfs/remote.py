@@ -0,0 +1,759 @@
+# encoding: utf-8
+""" 对象存储设备(aliyun、ceph)的公共部分：分块上传、下载到本地Cache、流式读取、元数据缓存 """
+
+import os
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .device import BaseDevice
+from .buffer import BUFFER_POOL, PartBuffer
+from .download import fetch_to_file, iter_ranges
+from .singleflight import fill_cache
+from .metacache import MetaCache, META_TTL, NEGATIVE_TTL
+from .checksum import Checksum
+from .writeback import UploadJournal, WriteBackUploader
+from .prefetch import Prefetcher, Readahead, PREFETCH_WORKERS, RANGE_READAHEAD
+from . import errors
+
+# 存储每个文件上传的会话信息
+UPLOAD_SESSIONS = {}
+# 分块上传(复制)最多的分块数
+MAX_PARTS = 10000
+# 写回模式下，写到本地的会话ID的前缀
+WRITE_BACK_PREFIX = 'wb:'
+# 修改元数据时要原样带上的标准头部
+KEEP_HEADERS = ('content-type', 'content-disposition', 'content-encoding',
+                'content-language', 'cache-control', 'expires')
+
+
+class RemoteDevice(BaseDevice):
+    """ 对象存储设备的基类，子类实现对象存储的基本操作：
+
+    _init_upload, _upload_part_data, _complete_upload, _abort_upload,
+    _list_parts, _head_object, _delete_objects, _copy_object, _upload_part_copy, _get_range
+
+    ASYNC_NATIVE 为True的子类还实现这些操作的协程版本(_ahead_object、_aget_range等)，
+    aexists、aget_data、amultiput 等方法不占用线程
+    """
+
+    # 下载数据块的最小大小
+    PART_SIZE = 2 * 1024 * 1024
+    # 流式读取时预读的数据块数
+    READAHEAD = 2
+    # 不超过这个大小用一次请求复制，超过的分块复制
+    COPY_THRESHOLD = 1024 * 1024 * 1024
+    # 分块复制时每块的最小大小，分块数不超过MAX_PARTS
+    COPY_PART_SIZE = 128 * 1024 * 1024
+    # 分块复制的并发数
+    COPY_CONCURRENCY = 8
+    # 完成上传时后端返回对象的CRC64
+    BACKEND_CRC64 = False
+    # 整个文件只有一个分块时，用 _put_object 一次上传并带上校验和
+    PUT_WITH_CHECKSUM = False
+    # 后台预取文件的线程数
+    PREFETCH_WORKERS = PREFETCH_WORKERS
+    # 子类实现了对象存储操作的协程版本
+    ASYNC_NATIVE = False
+
+    def _init_remote(self, local_device, cache, upload_concurrency, download_concurrency,
+                     buffer_pool, part_size, meta_ttl=META_TTL, negative_ttl=NEGATIVE_TTL,
+                     checksum=None, write_back=None, range_readahead=RANGE_READAHEAD):
+        self.local_device = local_device
+        # 上传时计算的校验和算法(md5、crc64、blake2b)，None不计算
+        self.checksum = checksum
+        # HEAD结果的缓存，本进程的写操作会使它失效
+        self.meta_cache = MetaCache(meta_ttl, negative_ttl)
+        # 本地Cache的容量管理(CacheManager)，可选
+        self.cache = cache
+        # 分块上传线程池，信号量限制在途的分块数（也就限制了缓存的内存）
+        self.upload_concurrency = upload_concurrency
+        self._upload_executor = None
+        self._upload_slots = threading.BoundedSemaphore(max(upload_concurrency, 1))
+        self._upload_lock = threading.Lock()
+        # 上传分块的缓冲，内存超出上限时写入临时文件
+        self.buffer_pool = buffer_pool or BUFFER_POOL
+        self.part_size = part_size
+        self.download_concurrency = download_concurrency
+        self._download_executor = None
+        self._copy_executor = None
+        # 批量预取到本地Cache(prefetch)
+        self.prefetcher = Prefetcher(self._prefetch_one, self.PREFETCH_WORKERS)
+        # get_data 顺序读时的预读，range_readahead为0时不预读
+        self.readahead = None
+        if range_readahead:
+            self.readahead = Readahead(self._get_range, self._object_size,
+                                       self._get_download_executor, range_readahead)
+        # 写回模式的后台上传(writeback.WriteBackUploader)，None为直接上传
+        self.write_back = None
+        if write_back:
+            self.start_write_back(write_back)
+
+    def start_write_back(self, journal_path, **kwargs):
+        """ 开启写回模式：写入先保存到local_device，再由后台上传，待上传的key记在journal_path
+
+        进程重启后用同一个journal_path开启，继续上传没有完成的key
+        """
+        self.write_back = WriteBackUploader(self, UploadJournal(journal_path), **kwargs)
+        return self.write_back
+
+    def _is_pending(self, key):
+        """ 写回模式下还没有上传完，只在本地有 """
+        return self.write_back is not None and self.write_back.is_pending(key)
+
+    def upload_state(self, key):
+        """ 写回模式下待上传的key的状态 {'size', 'attempts', 'error', ...}，已上传的返回None """
+        if self.write_back is None:
+            return None
+        return self.write_back.journal.get(key)
+
+    def os_path(self, key):
+        """找到key在操作系统中的地址 """
+        os_path = self.local_device.os_path(key)
+        if self.local_device.exists(key):
+            if self.cache is not None:
+                self.cache.hit(key)
+        else:
+            if self.cache is not None:
+                self.cache.miss(key)
+            self._warm(key, os_path)
+        return os_path
+
+    def _warm(self, key, os_path):
+        """ 分段下载到本地Cache，并发请求同一个文件只下载一次 """
+        fill_cache(os_path, lambda: self._fill_local(key, os_path))
+        if self.cache is not None:
+            self.cache.add(key)
+
+    def prefetch(self, keys, priority=0):
+        """ 在后台把keys下载到本地Cache，priority越大越先下载；返回加入队列的key数
+
+        例如打开文件夹时预取其中的文件，之后的os_path不用等下载
+        """
+        return self.prefetcher.add(
+            [key for key in keys if not self.local_device.exists(key)], priority)
+
+    def cancel_prefetch(self, keys=None):
+        """ 取消还没有开始的预取，keys为None时取消全部 """
+        self.prefetcher.cancel(keys)
+
+    def _prefetch_one(self, key):
+        os_path = self.local_device.os_path(key)
+        if not self.local_device.exists(key):
+            self._warm(key, os_path)
+
+    def get_data(self, key, offset=0, size=-1):
+        """ 根据key返回文件内容，适合小文件；本地有Cache时读Cache，顺序读取时预读后面的范围 """
+        if size == 0:
+            return b''
+        if self._is_pending(key) or self.local_device.exists(key):
+            return self.local_device.get_data(key, offset=offset, size=size)
+        if self.readahead is not None and size != -1:
+            return self.readahead.get_data(key, offset, size)
+        return self._get_range(key, offset, size)
+
+    def _invalidate(self, key):
+        """ key被改写或删除，丢弃缓存的HEAD结果和预读的数据 """
+        self.meta_cache.invalidate(key)
+        if self.readahead is not None:
+            self.readahead.invalidate(key)
+
+    def _invalidate_prefix(self, prefix):
+        self.meta_cache.invalidate_prefix(prefix)
+        if self.readahead is not None:
+            self.readahead.invalidate_prefix(prefix)
+
+    def _fill_local(self, key, os_path):
+        """ 下载到本地Cache """
+        # 获取下载文件的总大小
+        self._download(key, os_path, self._object_size(key))
+
+    def _head(self, key):
+        """ 云端文件的状态，不存在时返回None；结果会缓存 """
+        return self.meta_cache.get(key, self._head_object)
+
+    def _object_size(self, key):
+        if self._is_pending(key):
+            return self.local_device.stat(key)['file_size']
+        head = self._head(key)
+        if head is None:
+            raise errors.FileNotFound(key)
+        return head['file_size']
+
+    def exists(self, key):
+        """ 判断key是否存在"""
+        return os.path.exists(self.local_device.os_path(key)) or self._head(key) is not None
+
+    def stat(self, key):
+        """ 得到云端文件状态，还没有上传的读本地文件 """
+        if self._is_pending(key):
+            return self.local_device.stat(key)
+        head = self._head(key)
+        if head is None:
+            raise errors.FileNotFound(key)
+        return dict(head)
+
+    def _get_download_executor(self):
+        """延迟创建下载线程池"""
+        if self._download_executor is None:
+            with self._upload_lock:
+                if self._download_executor is None:
+                    self._download_executor = ThreadPoolExecutor(
+                        max_workers=self.download_concurrency)
+        return self._download_executor
+
+    def _get_copy_executor(self):
+        """延迟创建分块复制线程池"""
+        if self._copy_executor is None:
+            with self._upload_lock:
+                if self._copy_executor is None:
+                    self._copy_executor = ThreadPoolExecutor(max_workers=self.COPY_CONCURRENCY)
+        return self._copy_executor
+
+    def _download(self, key, os_path, size):
+        """ 并发分段下载到本地文件 """
+        fetch_to_file(lambda offset, length: self._get_range(key, offset, length),
+                      size, os_path, executor=self._get_download_executor(),
+                      concurrency=self.download_concurrency, min_range_size=self.PART_SIZE)
+
+    def gen_key(self, prefix='', suffix=''):
+        """
+        使用uuid生成一个未使用的key, 生成随机的两级目录
+        :param prefix: 可选前缀
+        :param suffix: 可选后缀
+        :return: 设备唯一的key
+        """
+        return self.local_device.gen_key(prefix, suffix)
+
+    def iter_data(self, key, offset=0, size=-1, chunk_size=None):
+        """ 流式读取，本地有Cache时读Cache，否则分段读取云端并预读 """
+        if self.local_device.exists(key):
+            return self.local_device.iter_data(key, offset, size, chunk_size)
+        end = self._object_size(key)
+        if size != -1:
+            end = min(end, offset + size)
+        return iter_ranges(lambda start, length: self._get_range(key, start, length),
+                           offset, end, chunk_size or self.PART_SIZE,
+                           self._get_download_executor(), self.READAHEAD)
+
+    def _get_upload_session(self, session_id):
+        """获取upload_session"""
+        if session_id not in UPLOAD_SESSIONS:
+            upload_id, key, size = session_id.rsplit(':', 2)
+            UPLOAD_SESSIONS[session_id] = self._resumed_session(self._list_parts(key, upload_id))
+        return UPLOAD_SESSIONS[session_id]
+
+    def _new_session(self):
+        return {'parts': [], 'offset': 0, 'part_number': 1, 'buffer': None, 'pending': [],
+                'checksum': self._new_checksum()}
+
+    def _resumed_session(self, parts):
+        """ 其他进程开始的会话，从已经上传的分块继续 """
+        upload_session = self._new_session()
+        upload_session['parts'] = [(number, etag) for number, etag, part_size in parts]
+        upload_session['part_number'] = len(parts) + 1
+        upload_session['offset'] = sum(part_size for number, etag, part_size in parts)
+        if upload_session['checksum'] is not None:
+            # 之前上传的数据没有计算，校验和无效
+            upload_session['checksum'].valid = False
+        return upload_session
+
+    def _get_upload_executor(self):
+        """延迟创建分块上传线程池"""
+        if self._upload_executor is None:
+            with self._upload_lock:
+                if self._upload_executor is None:
+                    self._upload_executor = ThreadPoolExecutor(
+                        max_workers=self.upload_concurrency)
+        return self._upload_executor
+
+    def _upload_part(self, key, upload_id, part_number, part):
+        """上传一个分块，返回(part_number, etag)；上传后释放缓冲"""
+        try:
+            etag = self._upload_part_data(key, upload_id, part_number, part.getvalue())
+        finally:
+            part.close()
+        return part_number, etag
+
+    def _submit_part(self, upload_session, key, upload_id, part):
+        """提交一个分块：并发模式放入线程池，在途分块数满时阻塞"""
+        part_number = upload_session['part_number']
+        upload_session['part_number'] += 1
+        upload_session['offset'] += len(part)
+        if self.upload_concurrency <= 1:
+            upload_session['parts'].append(
+                self._upload_part(key, upload_id, part_number, part))
+            return
+
+        # 之前的分块失败了，尽早报错
+        for future in upload_session['pending']:
+            if future.done() and future.exception() is not None:
+                part.close()
+                raise future.exception()
+
+        self._upload_slots.acquire()
+        try:
+            future = self._get_upload_executor().submit(
+                self._upload_part, key, upload_id, part_number, part)
+        except Exception:
+            self._upload_slots.release()
+            part.close()
+            raise
+        future.add_done_callback(lambda f: self._upload_slots.release())
+        upload_session['pending'].append(future)
+
+    def _wait_parts(self, upload_session):
+        """等待所有在途分块完成，按分块号排序"""
+        pending, upload_session['pending'] = upload_session['pending'], []
+        error = None
+        for future in pending:
+            try:
+                upload_session['parts'].append(future.result())
+            except Exception as e:
+                error = error or e
+        upload_session['parts'].sort()
+        if error is not None:
+            raise error
+
+    def _get_buffer_data(self, upload_session, data, size):
+        """进行数据累积，依次返回已经写满的分块；调用方提交分块后才继续累积"""
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        start = 0
+        while start < len(data):
+            if upload_session['buffer'] is None:
+                upload_session['buffer'] = PartBuffer(self.buffer_pool, self.part_size)
+            part = upload_session['buffer']
+            start += part.write(data, start)
+            if part.full or (size != -1 and upload_session['offset'] + len(part) >= size):
+                upload_session['buffer'] = None
+                yield part
+
+    def multiput_new(self, key, size=-1):
+        """开始一个多次上传会话, 返回会话ID；写回模式下写到本地"""
+        if self.write_back is not None:
+            return WRITE_BACK_PREFIX + self.local_device.multiput_new(key, size)
+        return self._upload_new(key, size)
+
+    def _upload_new(self, key, size):
+        session_id = ':'.join([self._init_upload(key), key, str(size)])
+        UPLOAD_SESSIONS[session_id] = self._new_session()
+        return session_id
+
+    def _new_checksum(self):
+        if not self.checksum:
+            return None
+        return Checksum(self.checksum, verify_crc64=self.BACKEND_CRC64)
+
+    def multiput_offset(self, session_id):
+        """ 某个文件当前上传位置 """
+        if session_id.startswith(WRITE_BACK_PREFIX):
+            return self.local_device.multiput_offset(session_id[len(WRITE_BACK_PREFIX):])
+        upload_session = self._get_upload_session(session_id)
+        return upload_session['offset'] + len(upload_session['buffer'] or b'')
+
+    def multiput(self, session_id, data, offset=None):
+        """ 从offset处上传数据 """
+        if session_id.startswith(WRITE_BACK_PREFIX):
+            return self.local_device.multiput(session_id[len(WRITE_BACK_PREFIX):], data, offset)
+        upload_id, key, size = session_id.rsplit(':', 2)
+        upload_session = self._get_upload_session(session_id)
+        if upload_session['checksum'] is not None:
+            upload_session['checksum'].update(data, offset)
+        for part in self._get_buffer_data(upload_session, data, int(size)):
+            self._submit_part(upload_session, key, upload_id, part)
+        return upload_session['offset'] + len(upload_session['buffer'] or b'')
+
+    def multiput_save(self, session_id):
+        """ 某个上传会话当前上传位置；写回模式下保存到本地后加入上传队列 """
+        if session_id.startswith(WRITE_BACK_PREFIX):
+            key = self.local_device.multiput_save(session_id[len(WRITE_BACK_PREFIX):])
+            self._invalidate(key)
+            self.write_back.add(key, self.local_device.stat(key)['file_size'])
+            if self.cache is not None:
+                self.cache.add(key)
+            return key
+        return self._upload_save(session_id)
+
+    def _upload_save(self, session_id):
+        upload_id, key, size = session_id.rsplit(':', 2)
+        upload_session = self._get_upload_session(session_id)
+        if self._use_put(upload_session):
+            return self._put_save(session_id, upload_session)
+        if upload_session['buffer'] is not None:
+            # 最后一块不足分块大小的数据
+            part, upload_session['buffer'] = upload_session['buffer'], None
+            self._submit_part(upload_session, key, upload_id, part)
+        self._wait_parts(upload_session)
+        if size != '-1' and upload_session.get('offset') != int(size):
+            raise Exception("File Size Check Failed")
+        crc = self._complete_upload(key, upload_id, upload_session['parts'])
+        self._invalidate(key)
+        UPLOAD_SESSIONS.pop(session_id)
+        if upload_session['checksum'] is not None:
+            self._finish_checksum(key, upload_session['checksum'], crc)
+        return key
+
+    def _use_put(self, upload_session):
+        """ 整个文件在一个分块里，并且要保存校验和 """
+        checksum = upload_session['checksum']
+        return (self.PUT_WITH_CHECKSUM and upload_session['part_number'] == 1
+                and upload_session['buffer'] is not None and checksum is not None
+                and checksum.value() is not None
+                and not (self.BACKEND_CRC64 and checksum.value().startswith('crc64:')))
+
+    def _put_save(self, session_id, upload_session):
+        """ 整个文件在一个分块里：一次请求上传并带上校验和，不用再修改元数据；
+        放弃已经开始的分块上传 """
+        upload_id, key, size = session_id.rsplit(':', 2)
+        part, upload_session['buffer'] = upload_session['buffer'], None
+        try:
+            if size != '-1' and len(part) != int(size):
+                raise Exception("File Size Check Failed")
+            crc = self._put_object(key, part.getvalue(), upload_session['checksum'].value())
+        finally:
+            part.close()
+        self._invalidate(key)
+        UPLOAD_SESSIONS.pop(session_id)
+        try:
+            self._abort_upload(key, upload_id)
+        except Exception as e:
+            print('abort upload %s error:%s' % (key, e))
+        self._finish_checksum(key, upload_session['checksum'], crc, saved=True)
+        return key
+
+    def _put_object(self, key, data, checksum):
+        """ 上传整个文件，校验和保存到对象上，返回后端计算的CRC64；子类实现 """
+        raise NotImplementedError
+
+    def _finish_checksum(self, key, checksum, crc, saved=False):
+        """ 和后端返回的CRC64比较，不一致时删除文件；一致时保存校验和，saved表示已经随上传保存 """
+        error = self._check_crc(key, checksum, crc)
+        if error is not None:
+            self._delete_objects([key])
+            self._invalidate(key)
+            raise error
+        value = checksum.value()
+        if value is not None and not saved:
+            self._save_checksum(key, value, checksum.offset)
+            self._invalidate(key)
+
+    def _check_crc(self, key, checksum, crc):
+        """ 和后端返回的CRC64不一致时返回ChecksumMismatch """
+        if crc is not None and checksum.crc64 is not None and checksum.crc64 != int(crc):
+            return errors.ChecksumMismatch('%s: crc64 %016x, backend %016x' % (
+                key, checksum.crc64, int(crc)))
+        return None
+
+    def _save_checksum(self, key, value, size):
+        """ 把校验和保存到对象上，子类实现 """
+
+    def multiput_delete(self, session_id):
+        """ 删除一个上传会话 """
+        if session_id.startswith(WRITE_BACK_PREFIX):
+            return self.local_device.multiput_delete(session_id[len(WRITE_BACK_PREFIX):])
+        upload_id, key, size = session_id.rsplit(':', 2)
+        upload_session = self._get_upload_session(session_id)
+        if upload_session['buffer'] is not None:
+            upload_session['buffer'].close()
+            upload_session['buffer'] = None
+        try:
+            self._wait_parts(upload_session)
+        except Exception:
+            pass
+        self._abort_upload(key, upload_id)
+        UPLOAD_SESSIONS.pop(session_id)
+
+    def _upload_local(self, key):
+        """ 写回模式的后台上传：把本地文件上传到对象存储，返回上传的字节数 """
+        os_path = self.local_device.os_path(key)
+        size = os.path.getsize(os_path)
+        session_id = self._upload_new(key, size)
+        try:
+            with open(os_path, 'rb') as f:
+                for data in iter(lambda: f.read(self.part_size), b''):
+                    self.multiput(session_id, data)
+            self._upload_save(session_id)
+        except Exception:
+            try:
+                self.multiput_delete(session_id)
+            except Exception:
+                pass
+            raise
+        return size
+
+    def copy_data(self, from_key, to_key):
+        """ 服务器端复制：小文件一次请求，大文件并发分块复制；还没有上传的在本地复制 """
+        if self._is_pending(from_key):
+            self.local_device.copy_data(from_key, to_key)
+            self._invalidate(to_key)
+            self.write_back.add(to_key, self.local_device.stat(to_key)['file_size'])
+            return
+        total_size = self._object_size(from_key)
+        if total_size <= self.COPY_THRESHOLD:
+            self._copy_object(from_key, to_key)
+        else:
+            self._multipart_copy(from_key, to_key, total_size)
+        self._invalidate(to_key)
+
+    def _multipart_copy(self, from_key, to_key, total_size):
+        part_size = max(self.COPY_PART_SIZE, -(-total_size // MAX_PARTS))
+        upload_id = self._init_upload(to_key)
+        executor = self._get_copy_executor()
+        futures = []
+        for part_number, offset in enumerate(range(0, total_size, part_size), 1):
+            byte_range = (offset, min(offset + part_size, total_size) - 1)
+            futures.append(executor.submit(self._copy_part, from_key, byte_range, to_key,
+                                           upload_id, part_number))
+        try:
+            parts = [future.result() for future in futures]
+            self._complete_upload(to_key, upload_id, parts)
+        except Exception:
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            self._abort_upload(to_key, upload_id)
+            raise
+
+    def _copy_part(self, from_key, byte_range, to_key, upload_id, part_number):
+        return part_number, self._upload_part_copy(from_key, byte_range, to_key,
+                                                   upload_id, part_number)
+
+    def move(self, key, new_key):
+        """ 对象存储没有改名操作，复制后删除；还没有上传的在本地改名 """
+        if self._is_pending(key):
+            self.local_device.move(key, new_key)
+            self.write_back.rename(key, new_key)
+            if self.cache is not None:
+                self.cache.discard(key)
+                self.cache.add(new_key)
+            # 云端可能有旧版本
+            self._delete_objects([key])
+            self._invalidate(key)
+            self._invalidate(new_key)
+            return
+        self.copy_data(key, new_key)
+        if self.local_device.exists(key):
+            self.local_device.move(key, new_key)
+            if self.cache is not None:
+                self.cache.discard(key)
+                self.cache.add(new_key)
+        self.remove(key)
+
+    def remove_many(self, keys):
+        """ 批量删除，使用对象存储的批量删除接口，返回 {key: None或删除失败的异常} """
+        keys = list(dict.fromkeys(keys))
+        for key in keys:
+            self._remove_local(key)
+        failed = self._delete_objects(keys)
+        for key in keys:
+            self._invalidate(key)
+        return dict((key, failed.get(key)) for key in keys)
+
+    def _remove_local(self, key):
+        """ 删除本地Cache，还没有上传的不再上传 """
+        if self.write_back is not None:
+            self.write_back.discard(key)
+        if self.local_device.exists(key):
+            self.local_device.remove(key)
+            if self.cache is not None:
+                self.cache.discard(key)
+
+    # 协程版本，由 aio.AsyncStorageDeviceManager 调用；一个上传会话只能用同一种接口
+
+    def async_native(self):
+        """ 是否用协程直接访问对象存储；写回模式要写本地文件，仍在线程池中执行 """
+        return self.ASYNC_NATIVE and self.write_back is None
+
+    async def _ahead(self, key):
+        return await self.meta_cache.aget(key, self._ahead_object)
+
+    async def _aobject_size(self, key):
+        if self._is_pending(key):
+            return self.local_device.stat(key)['file_size']
+        head = await self._ahead(key)
+        if head is None:
+            raise errors.FileNotFound(key)
+        return head['file_size']
+
+    async def aexists(self, key):
+        return os.path.exists(self.local_device.os_path(key)) or \
+            (await self._ahead(key)) is not None
+
+    async def astat(self, key):
+        if self._is_pending(key):
+            return self.local_device.stat(key)
+        head = await self._ahead(key)
+        if head is None:
+            raise errors.FileNotFound(key)
+        return dict(head)
+
+    async def aget_data(self, key, offset=0, size=-1):
+        """ 本地有Cache时在默认线程池中读Cache，否则直接读云端；不预读 """
+        if size == 0:
+            return b''
+        if self._is_pending(key) or self.local_device.exists(key):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.local_device.get_data, key, offset, size)
+        return await self._aget_range(key, offset, size)
+
+    async def aiter_data(self, key, offset=0, size=-1, chunk_size=None):
+        """ 流式读取，分段读取云端并预读READAHEAD段 """
+        if self.local_device.exists(key):
+            loop = asyncio.get_running_loop()
+            chunks = self.local_device.iter_data(key, offset, size, chunk_size)
+            try:
+                while True:
+                    data = await loop.run_in_executor(None, next, chunks, None)
+                    if data is None:
+                        break
+                    yield data
+            finally:
+                chunks.close()
+            return
+        end = await self._aobject_size(key)
+        if size != -1:
+            end = min(end, offset + size)
+        chunk_size = chunk_size or self.PART_SIZE
+        pending = deque()
+        try:
+            for start in range(offset, end, chunk_size):
+                pending.append(asyncio.ensure_future(
+                    self._aget_range(key, start, min(chunk_size, end - start))))
+                if len(pending) > self.READAHEAD:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def aremove(self, key):
+        """ 删除key文件，本地缓存也删除 """
+        self._remove_local(key)
+        await self._adelete_object(key)
+        self._invalidate(key)
+
+    async def _aget_upload_session(self, session_id):
+        if session_id not in UPLOAD_SESSIONS:
+            upload_id, key, size = session_id.rsplit(':', 2)
+            parts = await self._alist_parts(key, upload_id)
+            if session_id not in UPLOAD_SESSIONS:
+                UPLOAD_SESSIONS[session_id] = self._resumed_session(parts)
+        return UPLOAD_SESSIONS[session_id]
+
+    async def amultiput_new(self, key, size=-1):
+        session_id = ':'.join([await self._ainit_upload(key), key, str(size)])
+        UPLOAD_SESSIONS[session_id] = self._new_session()
+        return session_id
+
+    async def amultiput_offset(self, session_id):
+        upload_session = await self._aget_upload_session(session_id)
+        return upload_session['offset'] + len(upload_session['buffer'] or b'')
+
+    async def amultiput(self, session_id, data, offset=None):
+        upload_id, key, size = session_id.rsplit(':', 2)
+        upload_session = await self._aget_upload_session(session_id)
+        if upload_session['checksum'] is not None:
+            upload_session['checksum'].update(data, offset)
+        for part in self._get_buffer_data(upload_session, data, int(size)):
+            await self._asubmit_part(upload_session, key, upload_id, part)
+        return upload_session['offset'] + len(upload_session['buffer'] or b'')
+
+    async def _aupload_part(self, key, upload_id, part_number, part):
+        try:
+            etag = await self._aupload_part_data(key, upload_id, part_number, part.getvalue())
+        finally:
+            part.close()
+        return part_number, etag
+
+    async def _asubmit_part(self, upload_session, key, upload_id, part):
+        """ 分块作为任务上传，每个会话最多upload_concurrency个在途分块，满时等待 """
+        part_number = upload_session['part_number']
+        upload_session['part_number'] += 1
+        upload_session['offset'] += len(part)
+        for task in upload_session['pending']:
+            if task.done() and not task.cancelled() and task.exception() is not None:
+                part.close()
+                raise task.exception()
+        slots = upload_session.get('slots')
+        if slots is None:
+            slots = upload_session['slots'] = asyncio.Semaphore(max(self.upload_concurrency, 1))
+        try:
+            await slots.acquire()
+        except BaseException:
+            part.close()
+            raise
+        task = asyncio.ensure_future(self._aupload_part(key, upload_id, part_number, part))
+        task.add_done_callback(lambda t: slots.release())
+        upload_session['pending'].append(task)
+
+    async def _await_parts(self, upload_session):
+        pending, upload_session['pending'] = upload_session['pending'], []
+        error = None
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, BaseException):
+                error = error or result
+            else:
+                upload_session['parts'].append(result)
+        upload_session['parts'].sort()
+        if error is not None:
+            raise error
+
+    async def amultiput_save(self, session_id):
+        upload_id, key, size = session_id.rsplit(':', 2)
+        upload_session = await self._aget_upload_session(session_id)
+        checksum = upload_session['checksum']
+        if self._use_put(upload_session):
+            part, upload_session['buffer'] = upload_session['buffer'], None
+            try:
+                if size != '-1' and len(part) != int(size):
+                    raise Exception("File Size Check Failed")
+                crc = await self._aput_object(key, part.getvalue(), checksum.value())
+            finally:
+                part.close()
+            self._invalidate(key)
+            UPLOAD_SESSIONS.pop(session_id)
+            try:
+                await self._aabort_upload(key, upload_id)
+            except Exception as e:
+                print('abort upload %s error:%s' % (key, e))
+            await self._afinish_checksum(key, checksum, crc, saved=True)
+            return key
+        if upload_session['buffer'] is not None:
+            part, upload_session['buffer'] = upload_session['buffer'], None
+            await self._asubmit_part(upload_session, key, upload_id, part)
+        await self._await_parts(upload_session)
+        if size != '-1' and upload_session.get('offset') != int(size):
+            raise Exception("File Size Check Failed")
+        crc = await self._acomplete_upload(key, upload_id, upload_session['parts'])
+        self._invalidate(key)
+        UPLOAD_SESSIONS.pop(session_id)
+        if checksum is not None:
+            await self._afinish_checksum(key, checksum, crc)
+        return key
+
+    async def _afinish_checksum(self, key, checksum, crc, saved=False):
+        error = self._check_crc(key, checksum, crc)
+        if error is not None:
+            await self._adelete_object(key)
+            self._invalidate(key)
+            raise error
+        value = checksum.value()
+        if value is not None and not saved:
+            await self._asave_checksum(key, value, checksum.offset)
+            self._invalidate(key)
+
+    async def amultiput_delete(self, session_id):
+        upload_id, key, size = session_id.rsplit(':', 2)
+        upload_session = await self._aget_upload_session(session_id)
+        if upload_session['buffer'] is not None:
+            upload_session['buffer'].close()
+            upload_session['buffer'] = None
+        try:
+            await self._await_parts(upload_session)
+        except Exception:
+            pass
+        await self._aabort_upload(key, upload_id)
+        UPLOAD_SESSIONS.pop(session_id)
@@ -0,0 +1,577 @@
+# encoding: utf-8
+""" S3协议的简单客户端(ceph rgw)，使用线程安全的长连接池；
+a开头的方法是协程版本，用asyncio的连接，不占用线程 """
+
+import ssl
+import hmac
+import time
+import base64
+import socket
+import asyncio
+import hashlib
+import weakref
+import threading
+from collections import deque
+from contextlib import contextmanager
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+try:
+    from http import client as httplib
+    from urllib.parse import quote, urlparse
+except ImportError:
+    import httplib
+    from urllib import quote
+    from urlparse import urlparse
+
+from . import errors
+from . import connpool
+from .connpool import IDLE_TIMEOUT
+
+# 每个连接池的最大连接数
+POOL_SIZE = connpool.POOL_SIZE
+# 请求超时（秒）
+TIMEOUT = 60
+# 一次批量删除的最大数量
+DELETE_BATCH = 1000
+
+# 复用的长连接可能已经被服务器关闭，这些错误重试一次
+_RETRY_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest,
+                 ConnectionResetError, BrokenPipeError, ConnectionAbortedError)
+_ASYNC_RETRY_ERRORS = (ConnectionResetError, BrokenPipeError, ConnectionAbortedError,
+                       asyncio.IncompleteReadError)
+
+
+class ConnectionPool:
+    """ 同一个服务器的长连接池，最多maxsize个连接，用完时等待 """
+
+    def __init__(self, host, port=None, secure=False, maxsize=POOL_SIZE, timeout=TIMEOUT,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(maxsize)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reaped = 0
+        self.in_use = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _new_connection(self):
+        connection_class = httplib.HTTPSConnection if self.secure else httplib.HTTPConnection
+        with self._lock:
+            self.created += 1
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _get(self, fresh=False):
+        """ 取一个空闲连接，fresh为True时新建连接 """
+        now = time.time()
+        with self._lock:
+            while self._idle and not fresh:
+                connection, idle_since = self._idle.pop()
+                if now - idle_since < self.idle_timeout:
+                    return connection, True
+                connection.close()
+        return self._new_connection(), False
+
+    def _put(self, connection):
+        with self._lock:
+            self._idle.append((connection, time.time()))
+
+    @contextmanager
+    def connection(self, fresh=False):
+        """ 借用一个连接，返回(连接, 是否复用)；出错时关闭连接 """
+        start = time.time()
+        self._slots.acquire()
+        with self._lock:
+            self.wait_time += time.time() - start
+            self.waits += 1
+            self.in_use += 1
+        connection = None
+        try:
+            connection, reused = self._get(fresh)
+            yield connection, reused
+        except BaseException:
+            if connection is not None:
+                connection.close()
+            raise
+        else:
+            self._put(connection)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {'in_use': self.in_use, 'idle': len(self._idle), 'created': self.created,
+                    'reaped': self.reaped, 'wait_time': self.wait_time,
+                    'avg_wait': self.wait_time / self.waits if self.waits else 0.0,
+                    'maxsize': self.maxsize}
+
+    def reap(self, idle_timeout):
+        """ 关闭空闲超时的连接 """
+        now = time.time()
+        with self._lock:
+            expired = [item for item in self._idle if now - item[1] > idle_timeout]
+            self._idle = deque(item for item in self._idle if now - item[1] <= idle_timeout)
+            self.reaped += len(expired)
+        for connection, idle_since in expired:
+            connection.close()
+        return len(expired)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for connection, idle_since in idle:
+            connection.close()
+
+
+class AsyncConnectionPool:
+    """ asyncio的长连接池(HTTP/1.1)，属于一个事件循环；最多maxsize个连接同时在用 """
+
+    def __init__(self, host, port=None, secure=False, maxsize=POOL_SIZE, timeout=TIMEOUT,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.host = host
+        self.port = port or (443 if secure else 80)
+        self.secure = secure
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        # [(reader, writer, 空闲开始时间)]
+        self._idle = deque()
+        self._slots = asyncio.Semaphore(maxsize)
+        self.created = 0
+        self.in_use = 0
+
+    async def _connect(self):
+        ssl_context = ssl.create_default_context() if self.secure else None
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=ssl_context)
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.created += 1
+        return reader, writer
+
+    def _get_idle(self):
+        """ 取一个空闲连接，超时或已经被服务器关闭的丢掉 """
+        now = time.time()
+        while self._idle:
+            reader, writer, idle_since = self._idle.pop()
+            if now - idle_since < self.idle_timeout and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    async def request(self, method, url, headers, body):
+        """ 发送请求，返回(状态码, 小写的响应头, 响应内容)；复用的连接已经关闭时用新连接重试一次 """
+        async with self._slots:
+            self.in_use += 1
+            try:
+                connection = self._get_idle()
+                while True:
+                    reused = connection is not None
+                    if not reused:
+                        connection = await asyncio.wait_for(self._connect(), self.timeout)
+                    try:
+                        status, response_headers, data, keep_alive = await asyncio.wait_for(
+                            self._exchange(connection, method, url, headers, body),
+                            self.timeout)
+                    except _ASYNC_RETRY_ERRORS:
+                        connection[1].close()
+                        if not reused:
+                            raise
+                        connection = None
+                        continue
+                    except BaseException:
+                        connection[1].close()
+                        raise
+                    break
+                if keep_alive:
+                    self._idle.append((connection[0], connection[1], time.time()))
+                else:
+                    connection[1].close()
+                return status, response_headers, data
+            finally:
+                self.in_use -= 1
+
+    async def _exchange(self, connection, method, url, headers, body):
+        reader, writer = connection
+        lines = ['%s %s HTTP/1.1' % (method, url)]
+        lines.extend('%s: %s' % (name, value) for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if body:
+            writer.write(body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('connection closed by server')
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        status = int(status)
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        keep_alive = version == 'HTTP/1.1' and \
+            response_headers.get('connection', '').lower() != 'close'
+        if method == 'HEAD' or status in (204, 304):
+            data = b''
+        elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            data = await self._read_chunked(reader)
+        elif 'content-length' in response_headers:
+            data = await reader.readexactly(int(response_headers['content-length']))
+        else:
+            data = await reader.read()
+            keep_alive = False
+        return status, response_headers, data, keep_alive
+
+    @staticmethod
+    async def _read_chunked(reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0], 16)
+            if not size:
+                # 跳过trailer
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    def stats(self):
+        return {'in_use': self.in_use, 'idle': len(self._idle), 'created': self.created,
+                'maxsize': self.maxsize}
+
+    def close(self):
+        idle, self._idle = self._idle, deque()
+        for reader, writer, idle_since in idle:
+            writer.close()
+
+
+def _sign(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _children(elem, name):
+    return [child for child in elem if _local_name(child.tag) == name]
+
+
+def _text(elem, name, default=''):
+    children = _children(elem, name)
+    return children[0].text or default if children else default
+
+
+def _body_length(body):
+    if hasattr(body, 'seek') and hasattr(body, 'tell'):
+        position = body.tell()
+        body.seek(0, 2)
+        length = body.tell() - position
+        body.seek(position)
+        return length
+    return len(body)
+
+
+class S3Client:
+    """ 路径风格(path style)访问一个bucket，AWS签名V4；同一个endpoint共享连接池 """
+
+    def __init__(self, endpoint, access_key_id, access_key_secret, bucket_name,
+                 region='us-east-1', pool_size=None, timeout=TIMEOUT):
+        endpoint = connpool.normalize_endpoint(endpoint)
+        url = urlparse(endpoint)
+        self.host = url.netloc
+        self.access_key_id = access_key_id
+        self.access_key_secret = access_key_secret
+        self.bucket_name = bucket_name
+        self.region = region
+        self.pool = connpool.shared(endpoint, lambda: ConnectionPool(
+            url.hostname, url.port, url.scheme == 'https',
+            maxsize=connpool.pool_size_for(endpoint, pool_size), timeout=timeout))
+        # 协程版本的连接池，每个事件循环一个
+        self._async_args = (url.hostname, url.port, url.scheme == 'https',
+                            connpool.pool_size_for(endpoint, pool_size), timeout)
+        self._async_pools = weakref.WeakKeyDictionary()
+
+    def _path(self, key=''):
+        return '/' + self.bucket_name + '/' + quote(key, safe='/~')
+
+    def _auth_headers(self, method, path, params, headers):
+        """ AWS签名V4，数据不参与签名(UNSIGNED-PAYLOAD) """
+        now = time.gmtime()
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', now)
+        date_stamp = amz_date[:8]
+        headers = dict((name.lower(), str(value).strip()) for name, value in headers.items())
+        headers['host'] = self.host
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = 'UNSIGNED-PAYLOAD'
+        query = '&'.join('%s=%s' % (quote(name, safe='~'), quote(value, safe='~'))
+                         for name, value in sorted(params.items()))
+        signed_headers = ';'.join(sorted(headers))
+        canonical_request = '\n'.join([
+            method, path, query,
+            ''.join('%s:%s\n' % (name, headers[name]) for name in sorted(headers)),
+            signed_headers, 'UNSIGNED-PAYLOAD'])
+        scope = '%s/%s/s3/aws4_request' % (date_stamp, self.region)
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+        signing_key = _sign(_sign(_sign(_sign(
+            ('AWS4' + self.access_key_secret).encode('utf-8'), date_stamp),
+            self.region), 's3'), 'aws4_request')
+        signature = hmac.new(signing_key, string_to_sign.encode('utf-8'),
+                             hashlib.sha256).hexdigest()
+        headers['authorization'] = 'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (
+            self.access_key_id, scope, signed_headers, signature)
+        return headers, query
+
+    def _prepare(self, method, key, params, headers, body):
+        """ 签名，返回(url, 请求头, 请求内容) """
+        path = self._path(key)
+        headers, query = self._auth_headers(method, path, params or {}, headers or {})
+        url = path + ('?' + query if query else '')
+        if body is None:
+            body = b''
+        headers['content-length'] = str(_body_length(body))
+        return url, headers, body
+
+    def _check(self, status, ok, data):
+        """ 状态码不在ok中时抛出S3Error """
+        if status not in ok:
+            code, message = '', ''
+            if data:
+                try:
+                    root = ElementTree.fromstring(data)
+                    code, message = _text(root, 'Code'), _text(root, 'Message')
+                except ElementTree.ParseError:
+                    message = data[:200]
+            raise errors.S3Error(status, code, message)
+
+    def request(self, method, key='', params=None, headers=None, body=b'', ok=(200, 204, 206)):
+        """ 发送请求，返回(状态码, 响应头, 响应内容) """
+        url, headers, body = self._prepare(method, key, params, headers, body)
+        position = body.tell() if hasattr(body, 'tell') else None
+
+        fresh = False
+        while True:
+            try:
+                with self.pool.connection(fresh) as (connection, reused):
+                    try:
+                        connection.request(method, url, body=body, headers=headers)
+                        response = connection.getresponse()
+                        data = response.read()
+                    except _RETRY_ERRORS:
+                        if not reused or fresh:
+                            raise
+                        raise _Retry()
+                    if response.will_close:
+                        connection.close()
+            except _Retry:
+                if position is not None:
+                    body.seek(position)
+                fresh = True
+                continue
+            break
+
+        response_headers = dict((name.lower(), value) for name, value in response.getheaders())
+        self._check(response.status, ok, data)
+        return response.status, response_headers, data
+
+    def async_pool(self):
+        """ 当前事件循环的连接池 """
+        loop = asyncio.get_running_loop()
+        pool = self._async_pools.get(loop)
+        if pool is None:
+            host, port, secure, maxsize, timeout = self._async_args
+            pool = self._async_pools[loop] = AsyncConnectionPool(host, port, secure, maxsize,
+                                                                 timeout)
+        return pool
+
+    async def aclose(self):
+        """ 关闭当前事件循环的空闲连接 """
+        pool = self._async_pools.pop(asyncio.get_running_loop(), None)
+        if pool is not None:
+            pool.close()
+
+    async def arequest(self, method, key='', params=None, headers=None, body=b'',
+                       ok=(200, 204, 206)):
+        """ request的协程版本 """
+        url, headers, body = self._prepare(method, key, params, headers, body)
+        if hasattr(body, 'read'):
+            body = body.read()
+        status, response_headers, data = await self.async_pool().request(
+            method, url, headers, body)
+        self._check(status, ok, data)
+        return status, response_headers, data
+
+    def head_object(self, key):
+        return self.request('HEAD', key)[1]
+
+    async def ahead_object(self, key):
+        return (await self.arequest('HEAD', key))[1]
+
+    def get_object(self, key, byte_range=None):
+        """ byte_range=(start, end)，end包含在内，为None时读到结尾 """
+        return self.request('GET', key, headers=_range_headers(byte_range))[2]
+
+    async def aget_object(self, key, byte_range=None):
+        return (await self.arequest('GET', key, headers=_range_headers(byte_range)))[2]
+
+    def put_object(self, key, data, headers=None):
+        return self.request('PUT', key, body=data, headers=headers)[1].get('etag')
+
+    async def aput_object(self, key, data, headers=None):
+        return (await self.arequest('PUT', key, body=data, headers=headers))[1].get('etag')
+
+    def delete_object(self, key):
+        self.request('DELETE', key)
+
+    async def adelete_object(self, key):
+        await self.arequest('DELETE', key)
+
+    def delete_objects(self, keys):
+        """ 批量删除，每次最多DELETE_BATCH个；返回删除失败的 {key: S3Error} """
+        keys = list(keys)
+        failed = {}
+        for i in range(0, len(keys), DELETE_BATCH):
+            body = ('<Delete><Quiet>true</Quiet>%s</Delete>' % ''.join(
+                '<Object><Key>%s</Key></Object>' % escape(key)
+                for key in keys[i:i + DELETE_BATCH])).encode('utf-8')
+            md5 = base64.b64encode(hashlib.md5(body).digest()).decode('ascii')
+            data = self.request('POST', params={'delete': ''}, body=body,
+                                headers={'Content-MD5': md5, 'Content-Type': 'application/xml'})[2]
+            if data:
+                for error in _children(ElementTree.fromstring(data), 'Error'):
+                    failed[_text(error, 'Key')] = errors.S3Error(
+                        200, _text(error, 'Code'), _text(error, 'Message'))
+        return failed
+
+    def list_objects(self, prefix=''):
+        """ 列出前缀为prefix的所有key """
+        params = {'list-type': '2', 'prefix': prefix}
+        while True:
+            root = ElementTree.fromstring(self.request('GET', params=params)[2])
+            for content in _children(root, 'Contents'):
+                yield _text(content, 'Key')
+            token = _text(root, 'NextContinuationToken')
+            if _text(root, 'IsTruncated') != 'true' or not token:
+                break
+            params['continuation-token'] = token
+
+    def copy_object(self, from_key, to_key, headers=None):
+        """ headers中有 x-amz-metadata-directive: REPLACE 时替换元数据 """
+        self.request('PUT', to_key, headers=self._copy_headers(from_key, headers))
+
+    async def acopy_object(self, from_key, to_key, headers=None):
+        await self.arequest('PUT', to_key, headers=self._copy_headers(from_key, headers))
+
+    def _copy_headers(self, from_key, headers):
+        headers = dict(headers or {})
+        headers['x-amz-copy-source'] = self._path(from_key)
+        return headers
+
+    def create_multipart_upload(self, key):
+        return _upload_id(self.request('POST', key, params={'uploads': ''})[2])
+
+    async def acreate_multipart_upload(self, key):
+        return _upload_id((await self.arequest('POST', key, params={'uploads': ''}))[2])
+
+    def upload_part(self, key, upload_id, part_number, data):
+        headers = self.request('PUT', key, body=data, params={
+            'partNumber': str(part_number), 'uploadId': upload_id})[1]
+        return headers.get('etag')
+
+    async def aupload_part(self, key, upload_id, part_number, data):
+        headers = (await self.arequest('PUT', key, body=data, params={
+            'partNumber': str(part_number), 'uploadId': upload_id}))[1]
+        return headers.get('etag')
+
+    def upload_part_copy(self, from_key, byte_range, key, upload_id, part_number):
+        data = self.request('PUT', key, params={
+            'partNumber': str(part_number), 'uploadId': upload_id}, headers={
+            'x-amz-copy-source': self._path(from_key),
+            'x-amz-copy-source-range': 'bytes=%d-%d' % byte_range})[2]
+        return _text(ElementTree.fromstring(data), 'ETag')
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        _check_complete(self.request('POST', key, params={'uploadId': upload_id},
+                                     body=_complete_body(parts),
+                                     headers={'Content-Type': 'application/xml'})[2])
+
+    async def acomplete_multipart_upload(self, key, upload_id, parts):
+        _check_complete((await self.arequest('POST', key, params={'uploadId': upload_id},
+                                             body=_complete_body(parts),
+                                             headers={'Content-Type': 'application/xml'}))[2])
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.request('DELETE', key, params={'uploadId': upload_id})
+
+    async def aabort_multipart_upload(self, key, upload_id):
+        await self.arequest('DELETE', key, params={'uploadId': upload_id})
+
+    def list_parts(self, key, upload_id):
+        """ 已经上传的分块 [(part_number, etag, size)] """
+        params = {'uploadId': upload_id}
+        parts = []
+        while True:
+            if _read_parts(self.request('GET', key, params=params)[2], parts, params):
+                return parts
+
+    async def alist_parts(self, key, upload_id):
+        params = {'uploadId': upload_id}
+        parts = []
+        while True:
+            if _read_parts((await self.arequest('GET', key, params=params))[2], parts, params):
+                return parts
+
+
+def _range_headers(byte_range):
+    headers = {}
+    if byte_range is not None:
+        start, end = byte_range
+        headers['Range'] = 'bytes=%d-%s' % (start, '' if end is None else end)
+    return headers
+
+
+def _upload_id(data):
+    return _text(ElementTree.fromstring(data), 'UploadId')
+
+
+def _complete_body(parts):
+    return ('<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % ''.join(
+        '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (number, escape(etag))
+        for number, etag in parts)).encode('utf-8')
+
+
+def _check_complete(data):
+    """ 出错时也可能返回200，错误信息在内容中 """
+    root = ElementTree.fromstring(data)
+    if _local_name(root.tag) == 'Error':
+        raise errors.S3Error(200, _text(root, 'Code'), _text(root, 'Message'))
+
+
+def _read_parts(data, parts, params):
+    """ 把一页分块加到parts，返回是否是最后一页；不是时在params中设置下一页的位置 """
+    root = ElementTree.fromstring(data)
+    for part in _children(root, 'Part'):
+        parts.append((int(_text(part, 'PartNumber')), _text(part, 'ETag'),
+                      int(_text(part, 'Size', '0'))))
+    if _text(root, 'IsTruncated') != 'true':
+        return True
+    params['part-number-marker'] = _text(root, 'NextPartNumberMarker')
+    return False
+
+
+class _Retry(Exception):
+    pass
@@ -0,0 +1,131 @@
+# encoding: utf-8
+""" 基于SQLite的会话存储，接口和 device.Sessions 相同，按过期时间建有索引 """
+
+import os
+import json
+import errno
+import time
+import sqlite3
+import threading
+
+# 批量删除时每条语句的最大数量
+DELETE_BATCH = 500
+
+
+def _not_found(device, key):
+    """ 和 device.Sessions 一样，会话不存在时抛出OSError """
+    return FileNotFoundError(errno.ENOENT, 'session not found', '%s:%s' % (device, key))
+
+
+class SqliteSessions:
+    """ 所有会话存在一个SQLite数据库(WAL模式)中 """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        dir_name = os.path.dirname(db_path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                         'device TEXT NOT NULL, key TEXT NOT NULL, '
+                         'data TEXT NOT NULL, mtime REAL NOT NULL, '
+                         'PRIMARY KEY (device, key))')
+            conn.execute('CREATE INDEX IF NOT EXISTS sessions_mtime ON sessions (mtime)')
+
+    def _conn(self):
+        """ 每个线程一个连接 """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def new(self, device, key, **kwargs):
+        session = {
+            'device': device,
+            'key': key,
+        }
+        session.update(kwargs)
+        with self._conn() as conn:
+            conn.execute('INSERT OR REPLACE INTO sessions (device, key, data, mtime) '
+                         'VALUES (?, ?, ?, ?)', (device, key, json.dumps(session), time.time()))
+
+    def load(self, device, key):
+        row = self._conn().execute('SELECT data FROM sessions WHERE device = ? AND key = ?',
+                                   (device, key)).fetchone()
+        if row is None:
+            raise _not_found(device, key)
+        return json.loads(row[0])
+
+    def delete(self, device, key):
+        with self._conn() as conn:
+            cursor = conn.execute('DELETE FROM sessions WHERE device = ? AND key = ?',
+                                  (device, key))
+        if not cursor.rowcount:
+            raise _not_found(device, key)
+
+    def delete_many(self, items):
+        """ 批量删除 [(device, key), ...]，不存在的忽略 """
+        items = list(items)
+        with self._conn() as conn:
+            for i in range(0, len(items), DELETE_BATCH):
+                conn.executemany('DELETE FROM sessions WHERE device = ? AND key = ?',
+                                 items[i:i + DELETE_BATCH])
+
+    def update(self, device, key, **kwargs):
+        with self._conn() as conn:
+            row = conn.execute('SELECT data FROM sessions WHERE device = ? AND key = ?',
+                               (device, key)).fetchone()
+            if row is None:
+                raise _not_found(device, key)
+            session = json.loads(row[0])
+            session.update(kwargs)
+            conn.execute('UPDATE sessions SET data = ?, mtime = ? WHERE device = ? AND key = ?',
+                         (json.dumps(session), time.time(), device, key))
+
+    def query(self, expire=None, limit=None):
+        """ 查询超过expire秒没有更新的会话 """
+        sql, args = 'SELECT data FROM sessions', []
+        if expire is not None:
+            sql += ' WHERE mtime < ?'
+            args.append(time.time() - expire)
+        sql += ' ORDER BY mtime'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        rows = self._conn().execute(sql, args).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def import_dir(self, session_dir, remove=True):
+        """ 从 device.Sessions 的文件夹格式迁移，保留修改时间；返回迁移的会话数 """
+        count = 0
+        rows = []
+        for upload_session in os.listdir(session_dir):
+            fpath = os.path.join(session_dir, upload_session)
+            if not os.path.isfile(fpath):
+                continue
+            try:
+                with open(fpath) as f:
+                    session = json.load(f)
+                mtime = os.path.getmtime(fpath)
+            except (IOError, OSError, ValueError):
+                continue
+            rows.append((session['device'], session['key'], json.dumps(session), mtime, fpath))
+            if len(rows) >= DELETE_BATCH:
+                count += self._import_rows(rows, remove)
+                rows = []
+        count += self._import_rows(rows, remove)
+        return count
+
+    def _import_rows(self, rows, remove):
+        with self._conn() as conn:
+            conn.executemany('INSERT OR REPLACE INTO sessions (device, key, data, mtime) '
+                             'VALUES (?, ?, ?, ?)', [row[:4] for row in rows])
+        if remove:
+            for row in rows:
+                os.remove(row[4])
+        return len(rows)
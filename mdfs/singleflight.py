@@ -0,0 +1,127 @@
+# encoding: utf-8
+""" 同一个key的并发下载只执行一次：进程内用SingleFlight，进程间用锁文件 """
+
+import os
+import time
+import errno
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 没有fcntl时，超过这个时间的锁文件视为进程异常退出留下的
+STALE_LOCK_TIMEOUT = 60 * 10
+
+
+class _Call:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """ 同一个key同时只有一个调用在执行，其他调用等待并共享它的结果 """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+def _makedirs(dir_name):
+    if dir_name and not os.path.exists(dir_name):
+        try:
+            os.makedirs(dir_name)
+        except OSError:
+            if not os.path.isdir(dir_name):
+                raise
+
+
+@contextmanager
+def file_lock(path):
+    """ 进程间互斥的锁文件，退出时删除锁文件 """
+    _makedirs(os.path.dirname(path))
+    if fcntl is None:
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                try:
+                    if time.time() - os.path.getmtime(path) > STALE_LOCK_TIMEOUT:
+                        os.remove(path)
+                except OSError:
+                    pass
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            os.close(fd)
+            os.remove(path)
+        return
+
+    while True:
+        fd = os.open(path, os.O_CREAT | os.O_RDWR)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        # 拿到锁时文件可能已经被上一个持有者删除，需要重新打开
+        try:
+            same = os.path.samestat(os.fstat(fd), os.stat(path))
+        except OSError:
+            same = False
+        if same:
+            break
+        os.close(fd)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(path)
+        finally:
+            os.close(fd)
+
+
+CACHE_FILLS = SingleFlight()
+
+
+def fill_cache(os_path, download):
+    """ 本地文件不存在时调用download()下载到os_path，并发请求只下载一次 """
+    if os.path.exists(os_path):
+        return os_path
+
+    def fill():
+        with file_lock(os_path + '.lock'):
+            if not os.path.exists(os_path):
+                download()
+        return os_path
+
+    return CACHE_FILLS.do(os_path, fill)
@@ -3,11 +3,18 @@
 import os
 import time
 import sys
+import mmap
 import uuid
+import errno
+import select
 import shutil
 import mimetypes
+import threading
+from collections import OrderedDict
 #from types import UnicodeType
 from .device import BaseDevice
+from .fastcopy import copy_file, STRATEGIES
+from .checksum import Checksum, save_file_checksum, load_file_checksum
 try:
     from types import UnicodeType
 except ImportError:
@@ -16,68 +23,328 @@ from mdfs import errors
 
 FS_CHARSET = sys.getfilesystemencoding()
 OPEN_FILE_TIMEOUT = 60 * 10
+# 同时打开的写入文件数上限，超过时关闭最久未用的
+OPEN_FILES_LIMIT = 512
+# 后台关闭超时文件的间隔（秒）
+OPEN_FILES_REAP_INTERVAL = 30
+# 最多缓存的mmap文件数
+MAPPED_FILES_LIMIT = 128
+
+class _Handle:
+    """ 一个写入中的文件：文件对象(可能被关闭)、已写入的大小、最后使用时间
+
+    removed 表示已经从OpenFiles中去掉(超时回收、close_file或新建覆盖)，不能再使用
+    """
+
+    def __init__(self, fp, size):
+        self.fp = fp
+        self.size = size
+        self.used = time.time()
+        self.lock = threading.Lock()
+        self.removed = False
+
+
+def _sync(fd, sync):
+    """ 把文件数据写到磁盘，sync为 fsync 或 fdatasync """
+    if sync == 'fdatasync' and hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def _sync_path(path, sync):
+    """ 文件已经关闭，重新打开写到磁盘 """
+    fd = os.open(path, os.O_RDWR)
+    try:
+        _sync(fd, sync)
+    finally:
+        os.close(fd)
+
 
 class OpenFiles:
-    """ 管理打开的文件，打开10分钟就关闭；释放资源 """
-    
-    def __init__(self):
-        self._fps = {}
+    """ 管理写入中的文件，线程安全
+
+    打开的文件数不超过limit，超出时关闭最久未用的，再次写入时重新打开；
+    超过timeout没有写入的文件由后台线程关闭。
+    """
+
+    def __init__(self, limit=OPEN_FILES_LIMIT, timeout=OPEN_FILE_TIMEOUT,
+                 reap_interval=OPEN_FILES_REAP_INTERVAL):
+        self.limit = limit
+        self.timeout = timeout
+        self.reap_interval = reap_interval
+        # path -> _Handle，按使用顺序排列
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+        self._open_count = 0
+        self._counters = {'opened': 0, 'evicted': 0, 'reopened': 0, 'reaped': 0}
+        self._reaper = None
+
+    def _start_reaper(self):
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap_loop, name='mdfs-open-files')
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(self.reap_interval)
+            try:
+                self.clean()
+            except Exception as e:
+                print('clean open files error:' + str(e))
+
+    def _acquire(self, path, create=False):
+        """ 返回加了锁的_Handle，文件已打开；create为True时新建(清空)文件 """
+        while True:
+            with self._lock:
+                if create:
+                    handle = _Handle(None, 0)
+                    old = self._handles.pop(path, None)
+                else:
+                    old = None
+                    handle = self._handles.pop(path, None)
+                if handle is None:
+                    handle = _Handle(None, None)
+                self._handles[path] = handle
+            if old is not None:
+                with old.lock:
+                    old.removed = True
+                    self._close(old)
+            handle.lock.acquire()
+            # 等锁的时候可能已经被回收线程或close_file去掉了，重新取
+            with self._lock:
+                if not handle.removed and self._handles.get(path) is handle:
+                    break
+            handle.lock.release()
+        try:
+            if handle.fp is None:
+                self._open(path, handle, create)
+            handle.used = time.time()
+        except Exception:
+            handle.lock.release()
+            raise
+        self._evict()
+        return handle
+
+    def _open(self, path, handle, create):
+        if create:
+            handle.fp = open(path, 'wb')
+            self._count('opened')
+        else:
+            # 关闭后重新打开，或者进程重启后续传
+            handle.fp = open(path, 'r+b' if os.path.exists(path) else 'wb')
+            if handle.size is None:
+                handle.size = os.fstat(handle.fp.fileno()).st_size
+                self._count('opened')
+            else:
+                self._count('reopened')
+            handle.fp.seek(handle.size)
+        with self._lock:
+            self._open_count += 1
+
+    def _close(self, handle, sync=None):
+        """ 关闭文件，handle.lock由调用方持有 """
+        if handle.fp is None:
+            return
+        try:
+            if sync:
+                handle.fp.flush()
+                _sync(handle.fp.fileno(), sync)
+        finally:
+            handle.fp.close()
+            handle.fp = None
+            with self._lock:
+                self._open_count -= 1
+
+    def _evict(self):
+        """ 打开的文件超过上限时，关闭最久未用的空闲文件 """
+        if self._open_count <= self.limit:
+            return
+        with self._lock:
+            victims = [handle for handle in self._handles.values() if handle.fp is not None]
+        for handle in victims:
+            if self._open_count <= self.limit:
+                break
+            # 正在写入的文件跳过
+            if not handle.lock.acquire(False):
+                continue
+            try:
+                if handle.fp is not None:
+                    self._close(handle)
+                    self._count('evicted')
+            finally:
+                handle.lock.release()
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
 
     def new_file(self, path):
         """ 新建文件 """
-        self._fps[path] = (open(path, 'wb'), 0, int(time.time()))  # cache
-        return self._fps[path]
+        self._start_reaper()
+        handle = self._acquire(path, create=True)
+        handle.lock.release()
+
+    def is_open(self, path):
+        """ 文件是否正在写入 """
+        return path in self._handles
 
     def get_size(self, path):
-        if path in self._fps:
-            return self._fps[path][1]
-        else:
-            return os.path.getsize(path)
+        handle = self._handles.get(path)
+        if handle is not None and handle.size is not None:
+            return handle.size
+        return os.path.getsize(path)
 
     def clean(self):
-        """ 清理cache, 关闭和删除超时的 """
-        now = int(time.time())
-        for path, info in list(self._fps.items()):
-            modified = info[2]
-            if now > modified + OPEN_FILE_TIMEOUT:
-                self.close_file(path)
-
-    def close_file(self, path):
-        """ 关闭文件 """
-        if path in self._fps:
+        """ 关闭并忘记超时没有写入的文件 """
+        deadline = time.time() - self.timeout
+        with self._lock:
+            idle = [(path, handle) for path, handle in self._handles.items()
+                    if handle.used < deadline]
+        for path, handle in idle:
+            if not handle.lock.acquire(False):
+                continue
+            try:
+                if handle.used >= deadline or handle.removed:
+                    continue
+                handle.removed = True
+                self._close(handle)
+                with self._lock:
+                    if self._handles.get(path) is handle:
+                        del self._handles[path]
+                self._count('reaped')
+            finally:
+                handle.lock.release()
+
+    def close_file(self, path, sync=None):
+        """ 关闭文件，sync为 fsync 或 fdatasync 时先把数据写到磁盘 """
+        with self._lock:
+            handle = self._handles.pop(path, None)
+        if handle is None:
+            # 已经被回收线程关闭，关闭前没有写到磁盘
+            if sync:
+                _sync_path(path, sync)
+            return
+        with handle.lock:
+            handle.removed = True
             try:
-                self._fps[path][0].close()
+                if handle.fp is None and sync:
+                    # 超过打开文件数被关闭过，重新打开写到磁盘
+                    _sync_path(path, sync)
+                else:
+                    self._close(handle, sync)
             except Exception as e:
+                if sync:
+                    raise
                 print('close session error:' + str(e))
-            del self._fps[path]
 
     def append_data(self, path, data, offset=None):
         """ 文件写数据 """
-        if path not in self._fps:
-            fp, size = open(path, 'ab'), 0
-        else:
-            fp, size, _ = self._fps.pop(path)  # pop避免被清理
-
-        if offset is not None:
-            fp.seek(offset)
-            size = offset
+        handle = self._acquire(path)
+        try:
+            if offset is not None and offset != handle.size:
+                handle.fp.seek(offset)
+                handle.size = offset
+            handle.fp.write(data)
+            handle.size += len(data)
+            return handle.size
+        finally:
+            handle.lock.release()
 
-        fp.write(data)
-        size += len(data)
-        self._fps[path] = fp, size, int(time.time())
-        return size
+    def stats(self):
+        """ 打开的文件数、写入中的文件数，以及打开、关闭的计数 """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['open'] = self._open_count
+            stats['files'] = len(self._handles)
+        return stats
 
 OPEN_FILES = OpenFiles()
 
+
+class MappedFiles:
+    """ 缓存只读的mmap，文件改变(inode、大小、修改时间)后重新映射 """
+
+    def __init__(self, limit=MAPPED_FILES_LIMIT):
+        self.limit = limit
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """ 返回文件的mmap，空文件返回None """
+        st = os.stat(path)
+        version = (st.st_ino, st.st_size, st.st_mtime)
+        with self._lock:
+            cached = self._maps.pop(path, None)
+            if cached is not None and cached[0] == version:
+                self._maps[path] = cached
+                return cached[1]
+        if cached is not None:
+            self._close(cached[1])
+        if not st.st_size:
+            return None
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with self._lock:
+            self._maps[path] = (version, mapped)
+            while len(self._maps) > self.limit:
+                self._close(self._maps.popitem(last=False)[1][1])
+        return mapped
+
+    def invalidate(self, path):
+        """ 关闭文件的mmap；还有memoryview在使用、不能关闭时返回True
+
+        这时不能截断改写文件，访问映射中被截掉的部分会收到SIGBUS
+        """
+        with self._lock:
+            cached = self._maps.pop(path, None)
+        if cached is not None:
+            return not self._close(cached[1])
+        return False
+
+    @staticmethod
+    def _close(mapped):
+        """ 关闭mmap，还有memoryview在使用时返回False """
+        try:
+            mapped.close()
+        except BufferError:
+            # 还有memoryview在使用，等它们释放后由垃圾回收关闭
+            return False
+        return True
+
+MAPPED_FILES = MappedFiles()
+
 class VfsDevice(BaseDevice):
 
     PART_SIZE = 1024*1024
+    hierarchical = True
 
-    def __init__(self, name, title='', root_path=None, options={}):
+    def __init__(self, name, title='', root_path=None, options={}, zero_copy=False,
+                 copy_strategy='auto', checksum=None, fsync=None):
         self.name = name
         self.title = title
         self.options = options
         self.root_path = root_path
+        # 零拷贝模式：范围读取返回mmap上的memoryview
+        self.zero_copy = zero_copy
+        # 复制方式：auto 依次尝试 reflink、copy_file_range、buffer；
+        # 指定一种时从这种开始尝试，不支持时使用后面的方式
+        if copy_strategy == 'auto':
+            self.copy_strategies = STRATEGIES
+        else:
+            self.copy_strategies = STRATEGIES[STRATEGIES.index(copy_strategy):]
+        # 文件系统不支持的复制方式，不再尝试
+        self.unsupported_copies = set()
+        # 每种复制方式使用的次数
+        self.copy_counts = dict((strategy, 0) for strategy in STRATEGIES)
+        # 写入时计算的校验和算法(md5、crc64、blake2b)，None不计算
+        self.checksum = checksum
+        self._checksums = {}
+        # 保存时把数据写到磁盘：fsync、fdatasync，None由操作系统决定
+        if fsync not in (None, 'fsync', 'fdatasync'):
+            raise ValueError('unsupported fsync policy: %s' % fsync)
+        self.fsync = fsync
 
         if not os.path.exists(self.root_path):
             os.makedirs(self.root_path)
@@ -121,6 +388,8 @@ class VfsDevice(BaseDevice):
 
     def get_data(self, key, offset=0, size=-1):
         """ 根据key返回文件内容，适合小文件 """
+        if self.zero_copy and size != -1:
+            return self.get_view(key, offset, size)
         path = self.os_path(key)
         with open(path, 'rb') as f:
             if offset: 
@@ -130,13 +399,65 @@ class VfsDevice(BaseDevice):
             else:
                 return f.read()
 
+    def get_view(self, key, offset=0, size=-1):
+        """ 返回文件内容的只读memoryview，不复制数据 """
+        mapped = MAPPED_FILES.get(self.os_path(key))
+        if mapped is None:
+            return memoryview(b'')
+        end = len(mapped) if size == -1 else min(offset + size, len(mapped))
+        return memoryview(mapped)[offset:end]
+
+    def sendfile(self, key, out, offset=0, size=-1):
+        """ 把文件内容直接发送到socket(或文件描述符)，返回发送的字节数 """
+        out_fd = out.fileno() if hasattr(out, 'fileno') else out
+        path = self.os_path(key)
+        if size == -1:
+            size = os.path.getsize(path) - offset
+        sent = 0
+        with open(path, 'rb') as f:
+            while sent < size:
+                try:
+                    if hasattr(os, 'sendfile'):
+                        count = os.sendfile(out_fd, f.fileno(), offset + sent, size - sent)
+                    else:
+                        view = self.get_view(key, offset + sent, min(size - sent, self.PART_SIZE))
+                        count = os.write(out_fd, view)
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    # 非阻塞socket，等待可写
+                    select.select([], [out_fd], [])
+                    continue
+                if count == 0:
+                    break
+                sent += count
+        return sent
+
+    def iter_data(self, key, offset=0, size=-1, chunk_size=None):
+        """ 从offset开始，按块返回文件内容 """
+        chunk_size = chunk_size or self.PART_SIZE
+        with open(self.os_path(key), 'rb') as f:
+            if offset:
+                f.seek(offset)
+            while size != 0:
+                data = f.read(chunk_size if size == -1 else min(chunk_size, size))
+                if not data:
+                    break
+                yield data
+                if size != -1:
+                    size -= len(data)
+
     def multiput_new(self, key, size=-1):
         """ 开始一个多次写入会话, 返回会话ID"""
         os_path = self.os_path(key)
         self._makedirs(os_path)
+        if MAPPED_FILES.invalidate(os_path) and os.path.exists(os_path):
+            # 旧文件还在被映射，先删除再新建，映射保留旧的inode
+            os.remove(os_path)
         session = os_path + ':' + str(size)
-        OPEN_FILES.clean()  # 关闭全部超时不用的文件
         OPEN_FILES.new_file(os_path)
+        if self.checksum:
+            self._checksums[os_path] = Checksum(self.checksum)
         return session
 
     def multiput_offset(self, session_id):
@@ -147,31 +468,71 @@ class VfsDevice(BaseDevice):
     def multiput(self, session_id, data, offset=None):
         """ 从offset处写入数据 """
         os_path = session_id.rsplit(':', 1)[0]
-        return OPEN_FILES.append_data(os_path, data, offset)
+        size = OPEN_FILES.append_data(os_path, data, offset)
+        checksum = self._checksums.get(os_path)
+        if checksum is not None:
+            checksum.update(data, offset)
+        return size
 
     def multiput_save(self, session_id):
         """ 某个文件当前上传位置 """
         os_path, size = session_id.rsplit(':', 1)
-        OPEN_FILES.close_file(os_path)
-    
+        OPEN_FILES.close_file(os_path, self.fsync)
+
         if size != '-1' and int(size) != os.path.getsize(os_path):
             raise Exception('File Size Check Failed')
+        checksum = self._checksums.pop(os_path, None)
+        if self.checksum:
+            self._save_checksum(os_path, checksum)
         return os_path[len(self.root_path)+1:].replace('\\', '/')
 
+    def _save_checksum(self, os_path, checksum):
+        """ 保存写入时计算的校验和；断点续传、重写过的文件重新读取计算 """
+        if checksum is None or not checksum.valid or checksum.offset != os.path.getsize(os_path):
+            checksum = Checksum(self.checksum)
+            with open(os_path, 'rb') as f:
+                checksum.update_chunks(iter(lambda: f.read(self.PART_SIZE), b''))
+        save_file_checksum(os_path, checksum.value())
+
     def multiput_delete(self, session_id):
         """ 删除一个写入会话 """
         os_path = session_id.rsplit(':', 1)[0]
         OPEN_FILES.close_file(os_path)
+        self._checksums.pop(os_path, None)
         os.remove(os_path)
 
     def remove(self, key):
         """ 删除key文件 """
         ospath = self.os_path(key)
+        MAPPED_FILES.invalidate(ospath)
         try:
             os.remove(ospath)
         except Exception as e:
             raise errors.FileNotFound( str(e) )
 
+    def exists_many(self, keys):
+        """ 本地文件系统逐个判断比线程池快 """
+        return dict((key, self.exists(key)) for key in keys)
+
+    def stat_many(self, keys):
+        results = {}
+        for key in keys:
+            try:
+                results[key] = self.stat(key)
+            except OSError:
+                results[key] = None
+        return results
+
+    def remove_many(self, keys):
+        results = {}
+        for key in keys:
+            try:
+                self.remove(key)
+                results[key] = None
+            except errors.FileNotFound as e:
+                results[key] = e
+        return results
+
     def rmdir(self, key):
         """ 删除key文件夹"""
         ospath = self.os_path(key)
@@ -180,6 +541,8 @@ class VfsDevice(BaseDevice):
     def move(self, key, new_key):
         """ 升级旧的key，更换为一个新的 """
         ossrc, osdst = self.os_path(key), self.os_path(new_key)
+        MAPPED_FILES.invalidate(ossrc)
+        MAPPED_FILES.invalidate(osdst)
         # umove dosn't work with unicode filename yet
         if type(osdst) is UnicodeType and \
                not os.path.supports_unicode_filenames:
@@ -198,13 +561,33 @@ class VfsDevice(BaseDevice):
         src = self.os_path(from_key)
         dst = self.os_path(to_key)
         self._makedirs(dst)
-        shutil.copy(src, dst)
+        if MAPPED_FILES.invalidate(dst) and os.path.exists(dst):
+            strategy = self._copy_replace(src, dst)
+        else:
+            strategy = copy_file(src, dst, self.copy_strategies, self.unsupported_copies)
+        self.copy_counts[strategy] += 1
+        # 复制不保留扩展属性，校验和单独复制
+        checksum = load_file_checksum(src)
+        if checksum is not None:
+            save_file_checksum(dst, checksum)
+
+    def _copy_replace(self, src, dst):
+        """ dst还在被映射：复制到临时文件再替换，映射保留旧的inode """
+        tmp = '%s.%s.tmp' % (dst, uuid.uuid4().hex)
+        try:
+            strategy = copy_file(src, tmp, self.copy_strategies, self.unsupported_copies)
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return strategy
 
     def stat(self, key):
         os_path = self.os_path(key)
         return {
             "file_size": os.path.getsize(os_path),
-            "hash": None,
+            "hash": load_file_checksum(os_path),
             "mime_type": mimetypes.guess_type(key)[0],
             "put_time": os.path.getctime(os_path)
         }
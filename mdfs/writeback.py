@@ -0,0 +1,290 @@
+# encoding: utf-8
+""" 对象存储设备的写回模式：数据先写到本地(local_device)，后台上传到对象存储
+
+待上传的key记在一个SQLite日志(WAL模式)中，进程重启后继续上传；上传失败按指数退避重试。
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 同时上传的文件数
+UPLOAD_WORKERS = 4
+# 第一次重试的等待时间（秒），之后每次加倍
+RETRY_DELAY = 5
+# 重试的最长等待时间（秒）
+MAX_RETRY_DELAY = 600
+# 没有新任务时检查日志的间隔（秒）
+POLL_INTERVAL = 5
+
+
+class UploadJournal:
+    """ 待上传的key；每次重新写入version加一，并记下本地文件的修改时间(mtime，纳秒)，
+    上传期间被改写、删除的不会被误标记为完成 """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        dir_name = os.path.dirname(db_path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS uploads ('
+                         'key TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                         'version INTEGER NOT NULL, attempts INTEGER NOT NULL, '
+                         'next_try REAL NOT NULL, error TEXT, added REAL NOT NULL, '
+                         'mtime INTEGER)')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(uploads)')]
+            if 'mtime' not in columns:
+                # 旧版本的日志没有mtime
+                conn.execute('ALTER TABLE uploads ADD COLUMN mtime INTEGER')
+            conn.execute('CREATE INDEX IF NOT EXISTS uploads_next_try ON uploads (next_try)')
+
+    def _conn(self):
+        """ 每个线程一个连接 """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def add(self, key, size, mtime=None):
+        """ 记录一个待上传的key，已有的version加一、重新开始重试；
+        新的key的version从当前时间(纳秒)开始，删除后重新加入的不会和上传中的旧version相同 """
+        with self._conn() as conn:
+            conn.execute('INSERT INTO uploads (key, size, version, attempts, next_try, added, '
+                         'mtime) VALUES (?, ?, ?, 0, 0, ?, ?) ON CONFLICT (key) DO UPDATE SET '
+                         'size = excluded.size, version = version + 1, attempts = 0, '
+                         'next_try = 0, error = NULL, mtime = excluded.mtime',
+                         (key, size, time.time_ns(), time.time(), mtime))
+
+    def get(self, key):
+        """ 返回 {'key', 'size', 'version', 'attempts', 'error', 'mtime'}，不存在时返回None """
+        row = self._conn().execute(
+            'SELECT key, size, version, attempts, error, mtime FROM uploads WHERE key = ?',
+            (key,)).fetchone()
+        return dict(zip(('key', 'size', 'version', 'attempts', 'error', 'mtime'),
+                        row)) if row else None
+
+    def keys(self):
+        return [row[0] for row in self._conn().execute('SELECT key FROM uploads')]
+
+    def due(self, now, limit):
+        """ 到了上传时间的 [(key, version, attempts, mtime), ...]，先加入的在前 """
+        return self._conn().execute(
+            'SELECT key, version, attempts, mtime FROM uploads WHERE next_try <= ? '
+            'ORDER BY added LIMIT ?', (now, limit)).fetchall()
+
+    def done(self, key, version, mtime=None):
+        """ 上传完成；上传期间key被改写或删除(version、mtime变了)时返回False """
+        with self._conn() as conn:
+            return conn.execute('DELETE FROM uploads WHERE key = ? AND version = ? AND mtime IS ?',
+                                (key, version, mtime)).rowcount == 1
+
+    def retry(self, key, version, error, next_try, mtime=None):
+        with self._conn() as conn:
+            conn.execute('UPDATE uploads SET attempts = attempts + 1, error = ?, next_try = ? '
+                         'WHERE key = ? AND version = ? AND mtime IS ?',
+                         (error, next_try, key, version, mtime))
+
+    def retry_now(self):
+        """ 所有key不等重试时间，立即上传 """
+        with self._conn() as conn:
+            conn.execute('UPDATE uploads SET next_try = 0')
+
+    def remove(self, key):
+        """ 不再上传，返回是否存在 """
+        with self._conn() as conn:
+            return conn.execute('DELETE FROM uploads WHERE key = ?', (key,)).rowcount == 1
+
+    def remove_prefix(self, prefix):
+        """ 不再上传前缀为prefix的key，返回这些key """
+        with self._conn() as conn:
+            keys = [row[0] for row in conn.execute(
+                'SELECT key FROM uploads WHERE substr(key, 1, ?) = ?', (len(prefix), prefix))]
+            conn.execute('DELETE FROM uploads WHERE substr(key, 1, ?) = ?', (len(prefix), prefix))
+        return keys
+
+    def rename(self, key, new_key):
+        """ 改名，new_key原来的记录被覆盖 """
+        with self._conn() as conn:
+            conn.execute('DELETE FROM uploads WHERE key = ?', (new_key,))
+            conn.execute('UPDATE uploads SET key = ?, version = version + 1, attempts = 0, '
+                         'next_try = 0, error = NULL WHERE key = ?', (new_key, key))
+
+    def stats(self):
+        pending, pending_bytes, failing = self._conn().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(attempts > 0), 0) '
+            'FROM uploads').fetchone()
+        return {'pending': pending, 'pending_bytes': pending_bytes, 'failing': failing}
+
+
+class WriteBackUploader:
+    """ 在后台把日志中的key从设备的local_device上传到对象存储
+
+    device 需要提供 _upload_local(key)、_delete_objects(keys)、local_device 和 cache。
+    """
+
+    def __init__(self, device, journal, workers=UPLOAD_WORKERS, retry_delay=RETRY_DELAY,
+                 max_retry_delay=MAX_RETRY_DELAY, poll_interval=POLL_INTERVAL):
+        self.device = device
+        self.journal = journal
+        self.workers = workers
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval
+        # 待上传的key，读的时候不用查日志；重启后立即继续上传
+        journal.retry_now()
+        self._pending = set(journal.keys())
+        # 正在上传的key
+        self._uploading = set()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self.uploaded = self.uploaded_bytes = self.errors = 0
+        self.last_error = None
+        if device.cache is not None:
+            for key in self._pending:
+                device.cache.pin(key)
+        self._thread = threading.Thread(target=self._run, name='mdfs-write-back')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def is_pending(self, key):
+        return key in self._pending
+
+    def add(self, key, size):
+        """ 本地已经保存完的key，加入上传队列 """
+        self.journal.add(key, size, self._mtime(key))
+        with self._lock:
+            self._pending.add(key)
+        if self.device.cache is not None:
+            self.device.cache.pin(key)
+        self._wakeup.set()
+
+    def discard(self, key):
+        """ key已经删除，不再上传 """
+        self.journal.remove(key)
+        self._forget([key])
+
+    def discard_prefix(self, prefix):
+        self._forget(self.journal.remove_prefix(prefix))
+
+    def rename(self, key, new_key):
+        self.journal.rename(key, new_key)
+        self._forget([key])
+        with self._lock:
+            self._pending.add(new_key)
+        if self.device.cache is not None:
+            self.device.cache.pin(new_key)
+        self._wakeup.set()
+
+    def _mtime(self, key):
+        """ 本地文件的修改时间(纳秒)，不存在时返回None """
+        try:
+            return os.stat(self.device.local_device.os_path(key)).st_mtime_ns
+        except OSError:
+            return None
+
+    def _forget(self, keys):
+        with self._changed:
+            for key in keys:
+                self._pending.discard(key)
+            self._changed.notify_all()
+        if self.device.cache is not None:
+            for key in keys:
+                self.device.cache.unpin(key)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                self._schedule()
+            except Exception as e:
+                print('write back schedule error:' + str(e))
+            self._wakeup.wait(self.poll_interval)
+
+    def _schedule(self):
+        """ 提交到了上传时间的key，正在上传的不重复提交 """
+        with self._lock:
+            free = self.workers - len(self._uploading)
+            busy = set(self._uploading)
+        if free <= 0:
+            return
+        for key, version, attempts, mtime in self.journal.due(time.time(), free + len(busy)):
+            if key in busy:
+                continue
+            with self._lock:
+                self._uploading.add(key)
+            self._executor.submit(self._upload, key, version, attempts, mtime)
+            free -= 1
+            if free <= 0:
+                break
+
+    def _upload(self, key, version, attempts, mtime):
+        try:
+            size = self.device._upload_local(key)
+            if mtime is not None and self._mtime(key) != mtime:
+                # 上传期间本地文件被改写(大小可能不变)，上传的可能是新旧混合的数据
+                raise IOError('local file changed during upload')
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+                self.last_error = '%s: %s' % (key, e)
+            if not os.path.exists(self.device.local_device.os_path(key)):
+                # 本地文件已经不存在，无法再上传
+                self.discard(key)
+            else:
+                delay = min(self.retry_delay * 2 ** attempts, self.max_retry_delay)
+                self.journal.retry(key, version, str(e), time.time() + delay, mtime)
+        else:
+            if self.journal.done(key, version, mtime):
+                with self._lock:
+                    self.uploaded += 1
+                    self.uploaded_bytes += size
+                self._forget([key])
+                if self.device.cache is not None:
+                    self.device.cache.add(key)
+            elif self.journal.get(key) is None:
+                # 上传期间被删除了
+                self.device._delete_objects([key])
+        finally:
+            with self._changed:
+                self._uploading.discard(key)
+                self._changed.notify_all()
+            self._wakeup.set()
+
+    def flush(self, timeout=None):
+        """ 等待所有待上传的key上传完，超时返回False """
+        deadline = None if timeout is None else time.time() + timeout
+        self._wakeup.set()
+        with self._changed:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining if remaining is not None else self.poll_interval)
+        return True
+
+    def stats(self):
+        """ 队列深度、正在上传数、已上传数和最近的错误 """
+        stats = self.journal.stats()
+        with self._lock:
+            stats.update({'uploading': len(self._uploading), 'uploaded': self.uploaded,
+                          'uploaded_bytes': self.uploaded_bytes, 'errors': self.errors,
+                          'last_error': self.last_error})
+        return stats
+
+    def stop(self):
+        """ 停止后台上传，未上传的留在日志中，下次启动继续 """
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
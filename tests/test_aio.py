@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import hashlib
+import asyncio
+import tempfile
+import threading
+import unittest
+
+from mdfs import ceph, errors
+from mdfs.aio import AsyncStorageDeviceManager
+from mdfs.bench.fakes3 import FakeS3Server
+from mdfs.ceph import CephDevice
+from mdfs.device import StorageDeviceManager
+from mdfs.vfs import VfsDevice
+
+
+class AsyncStorageDeviceManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.manager = StorageDeviceManager(session_dir=os.path.join(self.workspace, 'sessions'))
+        self.device = VfsDevice('vfs', root_path=os.path.join(self.workspace, 'vfs'))
+        self.manager.add(self.device, None)
+        self.aio = AsyncStorageDeviceManager(self.manager, local_workers=2)
+        self.data = os.urandom(3 * 1024 * 1024 + 10)
+
+    def tearDown(self):
+        self.aio.close()
+        shutil.rmtree(self.workspace)
+
+    def test_1_put_and_read(self):
+        async def stream():
+            for i in range(0, len(self.data), 1000000):
+                yield self.data[i:i + 1000000]
+
+        async def run():
+            key = await self.aio.put_stream('vfs', 'a/1.doc', stream())
+            await self.aio.commit()
+            self.assertTrue(await self.aio.exists('vfs', key))
+            self.assertEqual((await self.aio.stat('vfs', key))['file_size'], len(self.data))
+            self.assertEqual(await self.aio.get_data('vfs', key, 10, 5), self.data[10:15])
+            chunks = [chunk async for chunk in self.aio.iter_data('vfs', key)]
+            self.assertEqual(b''.join(chunks), self.data)
+            with self.assertRaises((errors.FileNotFound, OSError)):
+                await self.aio.stat('vfs', 'a/2.doc')
+            await self.aio.remove('vfs', key)
+            self.assertFalse(await self.aio.exists('vfs', key))
+
+        asyncio.run(run())
+        self.assertEqual(list(self.manager.sessions.query()), [])
+
+    def test_2_transaction_per_task(self):
+        async def upload(key, commit):
+            await self.aio.put_data('vfs', key, b'data')
+            # 让两个任务交错执行
+            await asyncio.sleep(0.01)
+            await self.aio.copy_data('vfs', key, key + '.copy')
+            if commit:
+                await self.aio.commit()
+            else:
+                await self.aio.abort()
+
+        async def run():
+            await asyncio.gather(upload('a/1.doc', True), upload('b/1.doc', False))
+
+        asyncio.run(run())
+        self.assertTrue(self.device.exists('a/1.doc'))
+        self.assertTrue(self.device.exists('a/1.doc.copy'))
+        self.assertFalse(self.device.exists('b/1.doc'))
+        self.assertFalse(self.device.exists('b/1.doc.copy'))
+        self.assertEqual(list(self.manager.sessions.query()), [])
+
+    def test_3_sync_transaction_per_thread(self):
+        def upload(key):
+            self.manager.put_data('vfs', key, b'data')
+            self.manager.abort()
+
+        self.manager.put_data('vfs', 'a/1.doc', b'data')
+        thread = threading.Thread(target=upload, args=('b/1.doc',))
+        thread.start()
+        thread.join()
+        self.manager.commit()
+        self.assertTrue(self.device.exists('a/1.doc'))
+        self.assertFalse(self.device.exists('b/1.doc'))
+
+    def test_4_bounded_pool(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+        exists = self.device.exists
+
+        def slow_exists(key):
+            with lock:
+                running.append(key)
+                peak.append(len(running))
+            try:
+                return exists(key)
+            finally:
+                with lock:
+                    running.remove(key)
+
+        self.device.exists = slow_exists
+
+        async def run():
+            return await asyncio.gather(*[self.aio.exists('vfs', 'k%d' % i) for i in range(20)])
+
+        self.assertEqual(asyncio.run(run()), [False] * 20)
+        self.assertTrue(max(peak) <= 2)
+
+
+class CephAsyncTestCase(unittest.TestCase):
+    """ ceph设备用asyncio连接，不用线程池 """
+
+    def setUp(self):
+        self.server = FakeS3Server().start()
+        self.workspace = tempfile.mkdtemp()
+        self.manager = StorageDeviceManager(session_dir=os.path.join(self.workspace, 'sessions'))
+        self.device = CephDevice('ceph', local_device=VfsDevice(
+            'ceph_cache', root_path=os.path.join(self.workspace, 'cache')),
+            endpoint=self.server.endpoint, access_key_id='key', access_key_secret='secret',
+            bucket_name='test', pool_size=4, checksum='md5')
+        self.manager.add(self.device, None)
+        self.aio = AsyncStorageDeviceManager(self.manager, local_workers=2)
+
+    def tearDown(self):
+        self.aio.close()
+        self.device.client.pool.close()
+        self.server.stop()
+        shutil.rmtree(self.workspace)
+
+    def test_1_native(self):
+        data = os.urandom(ceph.BUFFER_SIZE * 2 + 100)
+
+        async def stream():
+            for i in range(0, len(data), 1024 * 1024):
+                yield data[i:i + 1024 * 1024]
+
+        async def run():
+            key = await self.aio.put_stream('ceph', 'a/1.doc', stream())
+            small = await self.aio.put_data('ceph', 'a/2.doc', b'small')
+            await self.aio.commit()
+            self.assertTrue(await self.aio.exists('ceph', key))
+            self.assertFalse(await self.aio.exists('ceph', 'a/3.doc'))
+            stat = await self.aio.stat('ceph', key)
+            self.assertEqual(stat['file_size'], len(data))
+            self.assertEqual(stat['hash'], 'md5:' + hashlib.md5(data).hexdigest())
+            self.assertEqual((await self.aio.stat('ceph', small))['hash'],
+                             'md5:' + hashlib.md5(b'small').hexdigest())
+            self.assertEqual(await self.aio.get_data('ceph', key, 10, 5), data[10:15])
+            self.assertEqual(await self.aio.get_data('ceph', small), b'small')
+            chunks = [chunk async for chunk in self.aio.iter_data('ceph', key, 3)]
+            self.assertEqual(b''.join(chunks), data[3:])
+            with self.assertRaises(errors.FileNotFound):
+                await self.aio.stat('ceph', 'a/3.doc')
+
+            session_id = await self.aio.multiput_new('ceph', 'b/1.doc')
+            await self.aio.multiput('ceph', session_id, data[:ceph.BUFFER_SIZE])
+            await self.aio.multiput_delete('ceph', session_id)
+            await self.aio.abort()
+
+            await self.aio.remove('ceph', key)
+            self.assertFalse(await self.aio.exists('ceph', key))
+            await self.aio.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(self.server.objects['a/2.doc'][0], b'small')
+        self.assertNotIn('a/1.doc', self.server.objects)
+        self.assertNotIn('b/1.doc', self.server.objects)
+        self.assertEqual(list(self.manager.sessions.query()), [])
+        # 没有用ceph的线程池和同步连接
+        self.assertNotIn('ceph', self.aio._executors)
+        self.assertEqual(self.device.client.pool.stats()['created'], 0)
+        self.assertTrue(self.server.requests['PUT'] >= 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
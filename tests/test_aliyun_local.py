@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from oss2.utils import make_crc_adapter
+
+from mdfs import aliyun, errors
+from mdfs.buffer import BufferPool, PartBuffer
+from mdfs.checksum import Crc64
+from mdfs.device import StorageDeviceManager
+from mdfs.vfs import VfsDevice
+
+from mdfs.bench.fakeoss import FakeBucket, new_device, put_stream
+
+
+class AliyunLocalTestCase(unittest.TestCase):
+    """ 使用本地假 Bucket 的测试 """
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.vfs_device = VfsDevice(name='vfs_cache', root_path=self.workspace)
+        self.key = 'ab/cd/efghijklmnopqrstuvwxyz.docx'
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def test_1_pipelined_upload(self):
+        device = new_device(self.vfs_device)
+        data = os.urandom(aliyun.BUFFER_SIZE * 5 + 1234)
+        self.assertEqual(put_stream(device, self.key, data), self.key)
+        self.assertEqual(device.bucket.objects[self.key][0], data)
+        self.assertEqual(device.bucket.requests['upload_part'], 6)
+
+    def test_2_known_size(self):
+        device = new_device(self.vfs_device, upload_concurrency=1)
+        data = os.urandom(aliyun.BUFFER_SIZE * 2 + 10)
+        put_stream(device, self.key, data, size=len(data))
+        self.assertEqual(device.bucket.objects[self.key][0], data)
+
+    def test_3_part_concurrency(self):
+        """ 有网络延迟时分块并发上传，同时在途的分块数不超过upload_concurrency """
+        data = os.urandom(aliyun.BUFFER_SIZE * 8)
+        peaks = []
+        for concurrency in (1, 8):
+            device = new_device(self.vfs_device, latency=0.05, upload_concurrency=concurrency)
+            put_stream(device, self.key, data)
+            self.assertEqual(device.bucket.objects[self.key][0], data)
+            peaks.append(device.bucket.peak['upload_part'])
+        self.assertEqual(peaks[0], 1)
+        self.assertGreater(peaks[1], 1)
+        self.assertLessEqual(peaks[1], 8)
+
+    def test_4_get_data_range(self):
+        device = new_device(self.vfs_device)
+        data = os.urandom(1000)
+        device.bucket.put_object(self.key, data)
+        self.assertEqual(device.get_data(self.key), data)
+        self.assertEqual(device.get_data(self.key, 10, 20), data[10:30])
+        self.assertEqual(device.get_data(self.key, 990), data[990:])
+        # 读取0字节不发请求
+        gets = device.bucket.requests['get_object']
+        self.assertEqual(device.get_data(self.key, 10, 0), b'')
+        self.assertEqual(device.bucket.requests['get_object'], gets)
+        # 本地有Cache时读Cache
+        device.os_path(self.key)
+        gets = device.bucket.requests['get_object']
+        self.assertEqual(device.get_data(self.key, 10, 20), data[10:30])
+        self.assertEqual(device.bucket.requests['get_object'], gets)
+
+    def test_5_os_path_parallel_fill(self):
+        device = new_device(self.vfs_device, latency=0.01)
+        data = os.urandom(aliyun.PART_SIZE * 5 + 4321)
+        device.bucket.put_object(self.key, data)
+        os_path = device.os_path(self.key)
+        with open(os_path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(device.bucket.requests['get_object'], 6)
+        self.assertEqual(os.listdir(os.path.dirname(os_path)), [os.path.basename(os_path)])
+
+    def test_6_iter_data(self):
+        device = new_device(self.vfs_device)
+        data = os.urandom(aliyun.PART_SIZE * 3 + 100)
+        device.bucket.put_object(self.key, data)
+        chunks = list(device.iter_data(self.key, offset=10, chunk_size=aliyun.PART_SIZE))
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(b''.join(chunks), data[10:])
+        self.assertEqual(b''.join(device.iter_data(self.key, 5, 1000, chunk_size=300)),
+                         data[5:1005])
+        # 本地有Cache时从Cache读取
+        device.os_path(self.key)
+        requests = device.bucket.requests['get_object']
+        self.assertEqual(b''.join(device.iter_data(self.key)), data)
+        self.assertEqual(device.bucket.requests['get_object'], requests)
+
+    def test_7_spill_to_disk(self):
+        pool = BufferPool(limit=aliyun.BUFFER_SIZE * 2)
+        device = new_device(self.vfs_device, latency=0.01, buffer_pool=pool)
+        data = os.urandom(aliyun.BUFFER_SIZE * 6 + 7)
+        put_stream(device, self.key, data)
+        self.assertEqual(device.bucket.objects[self.key][0], data)
+        stats = pool.stats()
+        self.assertGreater(stats['spilled'], 0)
+        self.assertLessEqual(stats['peak'], pool.limit)
+        self.assertEqual(stats['in_memory'], 0)
+
+    def test_8_meta_cache(self):
+        device = new_device(self.vfs_device)
+        data = os.urandom(1000)
+        device.bucket.put_object(self.key, data)
+        for i in range(3):
+            self.assertTrue(device.exists(self.key))
+            self.assertEqual(device.stat(self.key)['file_size'], 1000)
+        self.assertEqual(device.bucket.requests['head_object'], 1)
+        # 冷读只发一次HEAD
+        device.os_path(self.key)
+        self.assertEqual(device.bucket.requests['head_object'], 1)
+
+        # 不存在的key也缓存
+        for i in range(3):
+            self.assertFalse(device.exists('not/exists'))
+        self.assertEqual(device.bucket.requests['head_object'], 2)
+        self.assertRaises(errors.FileNotFound, device.stat, 'not/exists')
+
+        # 写入、删除后失效
+        put_stream(device, self.key, os.urandom(2000))
+        self.assertEqual(device.stat(self.key)['file_size'], 2000)
+        device.remove(self.key)
+        self.assertFalse(device.exists(self.key))
+        self.assertEqual(device.bucket.requests['head_object'], 4)
+
+    def test_9_meta_cache_ttl(self):
+        device = new_device(self.vfs_device, meta_ttl=0, negative_ttl=0)
+        device.bucket.put_object(self.key, b'data')
+        device.exists(self.key)
+        device.exists(self.key)
+        self.assertEqual(device.bucket.requests['head_object'], 2)
+
+    def test_10_batch(self):
+        device = new_device(self.vfs_device, latency=0.01)
+        keys = ['batch/%d' % i for i in range(2500)]
+        for key in keys:
+            device.bucket.objects[key] = (b'x', 0)
+        exists = device.exists_many(keys[:100] + ['not/exists'])
+        # 并发HEAD
+        self.assertGreater(device.bucket.peak['head_object'], 1)
+        self.assertTrue(all(exists[key] for key in keys[:100]))
+        self.assertFalse(exists['not/exists'])
+        self.assertIsNone(device.stat_many(['not/exists'])['not/exists'])
+        self.assertEqual(device.remove_many(keys), dict((key, None) for key in keys))
+        self.assertEqual(device.bucket.requests['batch_delete_objects'], 3)
+        self.assertEqual(device.bucket.objects, {})
+        self.assertFalse(device.exists(keys[0]))
+
+    def test_11_copy(self):
+        device = new_device(self.vfs_device, latency=0.02)
+        data = os.urandom(10000)
+        device.bucket.put_object(self.key, data)
+        device.copy_data(self.key, 'copy/1')
+        self.assertEqual(device.bucket.objects['copy/1'][0], data)
+        self.assertEqual(device.bucket.requests['copy_object'], 1)
+
+        # 大文件并发分块复制
+        device.COPY_THRESHOLD, device.COPY_PART_SIZE = 1000, 1000
+        device.copy_data(self.key, 'copy/2')
+        self.assertGreater(device.bucket.peak['upload_part_copy'], 1)
+        self.assertEqual(device.bucket.objects['copy/2'][0], data)
+        self.assertEqual(device.bucket.requests['upload_part_copy'], 10)
+
+        results = device.copy_many([(self.key, 'many/%d' % i) for i in range(5)] +
+                                   [('not/exists', 'many/x')])
+        self.assertIsInstance(results.pop('many/x'), errors.FileNotFound)
+        self.assertEqual(results, dict(('many/%d' % i, None) for i in range(5)))
+        self.assertEqual(device.bucket.objects['many/4'][0], data)
+
+    def test_12_checksum(self):
+        device = new_device(self.vfs_device, checksum='crc64')
+        data = os.urandom(aliyun.BUFFER_SIZE * 2 + 5)
+        put_stream(device, self.key, data)
+        crc = Crc64()
+        crc.update(data)
+        self.assertEqual(device.stat(self.key)['hash'], 'crc64:' + crc.hexdigest())
+        self.assertNotIn('update_object_meta', device.bucket.requests)
+
+        device = new_device(self.vfs_device, checksum='md5')
+        put_stream(device, self.key, data)
+        self.assertEqual(device.stat(self.key)['hash'], 'md5:' + hashlib.md5(data).hexdigest())
+
+        # 和OSS返回的CRC64不一致
+        complete = device.bucket.complete_multipart_upload
+        def corrupt(*args, **kwargs):
+            result = complete(*args, **kwargs)
+            result.crc ^= 1
+            return result
+        device.bucket.complete_multipart_upload = corrupt
+        self.assertRaises(errors.ChecksumMismatch, put_stream, device, self.key, data)
+        self.assertFalse(device.exists(self.key))
+
+    def test_13_manager_stats(self):
+        device = new_device(self.vfs_device)
+        manager = StorageDeviceManager(session_dir=os.path.join(self.workspace, '.sessions'))
+        manager.add(device, None)
+        manager.put_data('aliyun_fake', self.key, b'data')
+        manager.commit()
+        manager.stat('aliyun_fake', self.key)
+        manager.stat('aliyun_fake', self.key)
+        stats = manager.stats()['aliyun_fake']
+        self.assertEqual(stats['operations']['stat']['count'], 2)
+        self.assertEqual(stats['caches']['meta']['hits'], 1)
+
+    def test_14_part_buffer_crc_adapter(self):
+        # oss2 上传前用make_crc_adapter包装数据，整块、不满的块和溢出到文件的块都要能读
+        data = os.urandom(1000)
+        for pool, size in ((BufferPool(), 1000), (BufferPool(), 2000),
+                           (BufferPool(limit=0), 1000)):
+            part = PartBuffer(pool, size)
+            part.write(data)
+            try:
+                self.assertEqual(make_crc_adapter(part.getvalue()).read(), data)
+                # 失败重试时从头再读
+                value = part.getvalue()
+                value.read(10)
+                value.seek(0)
+                self.assertEqual(value.read(), data)
+            finally:
+                part.close()
+        self.assertRaises(AttributeError, FakeBucket().put_object, self.key, bytearray(data))
+
+    def test_15_checksum_keeps_headers(self):
+        device = new_device(self.vfs_device, checksum='md5')
+        content_type = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+        # 只有一个分块，校验和随 put_object 上传，不用修改元数据
+        data = os.urandom(1000)
+        put_stream(device, self.key, data)
+        self.assertEqual(device.stat(self.key)['hash'], 'md5:' + hashlib.md5(data).hexdigest())
+        self.assertEqual(device.stat(self.key)['mime_type'], content_type)
+        self.assertNotIn('update_object_meta', device.bucket.requests)
+        self.assertEqual(device.bucket.uploads, {})
+
+        # 分块上传后修改元数据，原有的Content-Type和自定义元数据都保留
+        data = os.urandom(aliyun.BUFFER_SIZE * 2 + 5)
+        init = device.bucket.init_multipart_upload
+        device.bucket.init_multipart_upload = lambda key, headers=None: init(
+            key, {'x-oss-meta-owner': 'mdfs'})
+        put_stream(device, self.key, data)
+        stat = device.stat(self.key)
+        self.assertEqual(stat['hash'], 'md5:' + hashlib.md5(data).hexdigest())
+        self.assertEqual(stat['mime_type'], content_type)
+        self.assertEqual(device.bucket.metas[self.key]['x-oss-meta-owner'], 'mdfs')
+        self.assertEqual(device.bucket.requests['update_object_meta'], 1)
+
+        # 超过单次复制上限的不修改元数据，用OSS的CRC64
+        device.COPY_THRESHOLD = aliyun.BUFFER_SIZE
+        put_stream(device, self.key, data)
+        self.assertTrue(device.stat(self.key)['hash'].startswith('crc64:'))
+        self.assertEqual(device.bucket.requests['update_object_meta'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+from mdfs.bench import suite
+
+
+class BenchSuiteTestCase(unittest.TestCase):
+
+    def test_1_run_and_compare(self):
+        args = suite.parse_args(['--backend', 'oss', '--latency', '0', '--size', '2M',
+                                 '--rounds', '1', '--sessions', '20', '--small-files', '8',
+                                 '--concurrency', '2'])
+        result = suite.run(args)
+        json.dumps(result)
+        self.assertEqual(list(result['results']), list(suite.BENCHMARKS))
+        self.assertTrue(result['results']['transfer']['put_stream_bytes_per_second'] > 0)
+        self.assertEqual(suite.compare(result, result, 0.2), [])
+
+        baseline = {'results': {'transfer': {'put_stream_bytes_per_second': 100.0},
+                                'sessions': {'sessions_file_query_seconds': 1.0}}}
+        current = {'results': {'transfer': {'put_stream_bytes_per_second': 70.0},
+                               'sessions': {'sessions_file_query_seconds': 1.1}}}
+        regressions = suite.compare(baseline, current, 0.2)
+        self.assertEqual([item['metric'] for item in regressions],
+                         ['put_stream_bytes_per_second'])
+        current['results']['sessions']['sessions_file_query_seconds'] = 1.5
+        self.assertEqual(len(suite.compare(baseline, current, 0.2)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
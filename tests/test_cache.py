@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from mdfs.cache import CacheManager
+from mdfs.vfs import VfsDevice
+
+from mdfs.bench.fakeoss import new_device
+
+
+class CacheManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.vfs_device = VfsDevice(name='vfs_cache', root_path=self.workspace)
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def put(self, cache, key, size=100):
+        session_id = self.vfs_device.multiput_new(key)
+        self.vfs_device.multiput(session_id, b'a' * size)
+        self.vfs_device.multiput_save(session_id)
+        cache.add(key)
+
+    def test_1_lru(self):
+        cache = CacheManager(self.vfs_device, max_bytes=350)
+        for i in range(5):
+            self.put(cache, 'a/%d' % i)
+            time.sleep(0.01)
+        cache.hit('a/0')
+        self.assertEqual(cache.evict(), 2)
+        self.assertTrue(self.vfs_device.exists('a/0'))
+        self.assertFalse(self.vfs_device.exists('a/1'))
+        self.assertFalse(self.vfs_device.exists('a/2'))
+        self.assertEqual(cache.stats()['bytes'], 300)
+
+    def test_2_lfu_and_file_count(self):
+        cache = CacheManager(self.vfs_device, max_files=3, policy='lfu')
+        for i in range(4):
+            self.put(cache, 'b/%d' % i)
+        for i in (0, 1, 3):
+            cache.hit('b/%d' % i)
+        self.assertEqual(cache.evict(), 2)
+        self.assertFalse(self.vfs_device.exists('b/2'))
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    def test_3_skip_open_files(self):
+        self.put(CacheManager(self.vfs_device), 'c/0')
+        session_id = self.vfs_device.multiput_new('c/1')
+        self.vfs_device.multiput(session_id, b'a' * 100)
+        # 重新扫描，正在上传的文件也在Cache文件夹中
+        cache = CacheManager(self.vfs_device, max_files=1)
+        cache.hit('c/0')
+        self.assertEqual(cache.evict(), 1)
+        self.assertFalse(self.vfs_device.exists('c/0'))
+        self.vfs_device.multiput_save(session_id)
+        self.assertTrue(self.vfs_device.exists('c/1'))
+
+    def test_4_pull_through(self):
+        cache = CacheManager(self.vfs_device, max_files=1, interval=0.01)
+        device = new_device(self.vfs_device, cache=cache)
+        device.bucket.put_object('d/0', b'0')
+        device.bucket.put_object('d/1', b'1')
+        device.os_path('d/0')
+        device.os_path('d/0')
+        cache.start()
+        try:
+            device.os_path('d/1')
+            time.sleep(0.1)
+        finally:
+            cache.stop()
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 2, 1))
+        self.assertFalse(self.vfs_device.exists('d/0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mdfs import ceph, errors, remote
+from mdfs.bench.fakes3 import FakeS3Server
+from mdfs.ceph import CephDevice
+from mdfs.vfs import VfsDevice
+
+
+class CephTestCase(unittest.TestCase):
+    """ 使用本地S3服务器的测试 """
+
+    def setUp(self):
+        self.server = FakeS3Server().start()
+        self.workspace = tempfile.mkdtemp()
+        self.vfs_device = VfsDevice(name='vfs_cache', root_path=self.workspace)
+        self.device = CephDevice('ceph_test', local_device=self.vfs_device,
+                                 endpoint=self.server.endpoint, access_key_id='key',
+                                 access_key_secret='secret', bucket_name='test', pool_size=4)
+        self.key = 'ab/cd/efghijklmnopqrstuvwxyz.docx'
+
+    def tearDown(self):
+        self.device.client.pool.close()
+        self.server.stop()
+        shutil.rmtree(self.workspace)
+
+    def put(self, key, data, size=-1):
+        session_id = self.device.multiput_new(key, size)
+        for i in range(0, len(data), 1024 * 1024):
+            self.device.multiput(session_id, data[i:i + 1024 * 1024])
+        return self.device.multiput_save(session_id)
+
+    def test_1_upload_and_read(self):
+        data = os.urandom(ceph.BUFFER_SIZE * 2 + 100)
+        self.assertEqual(self.put(self.key, data, len(data)), self.key)
+        self.assertEqual(self.server.objects[self.key][0], data)
+        self.assertTrue(self.device.exists(self.key))
+        self.assertFalse(self.device.exists('no/such/key'))
+        self.assertEqual(self.device.get_data(self.key, 10, 20), data[10:30])
+        self.assertEqual(self.device.stat(self.key)['file_size'], len(data))
+        self.assertEqual(b''.join(self.device.iter_data(self.key, 5)), data[5:])
+
+    def test_2_os_path_cache(self):
+        data = os.urandom(ceph.PART_SIZE * 3 + 5)
+        self.server.objects[self.key] = (data, 0)
+        with open(self.device.os_path(self.key), 'rb') as f:
+            self.assertEqual(f.read(), data)
+        gets = self.server.requests['GET']
+        self.assertEqual(self.device.get_data(self.key, 1, 2), data[1:3])
+        self.assertEqual(self.server.requests['GET'], gets)
+
+    def test_3_resume_upload(self):
+        data = os.urandom(ceph.BUFFER_SIZE + 10)
+        session_id = self.device.multiput_new(self.key)
+        self.device.multiput(session_id, data[:ceph.BUFFER_SIZE])
+        self.device._wait_parts(remote.UPLOAD_SESSIONS.pop(session_id))
+        # 其他进程继续上传
+        self.assertEqual(self.device.multiput_offset(session_id), ceph.BUFFER_SIZE)
+        self.device.multiput(session_id, data[ceph.BUFFER_SIZE:])
+        self.device.multiput_save(session_id)
+        self.assertEqual(self.server.objects[self.key][0], data)
+
+    def test_4_copy_move_remove(self):
+        self.put(self.key, b'data')
+        self.device.copy_data(self.key, 'copy/1')
+        self.device.os_path('copy/1')
+        self.device.move('copy/1', 'copy/2')
+        self.assertEqual(self.device.get_data('copy/2'), b'data')
+        self.assertFalse(self.device.exists('copy/1'))
+        self.device.remove('copy/2')
+        self.assertFalse(self.device.exists('copy/2'))
+        self.assertRaises(errors.FileNotFound, self.device.stat, 'copy/2')
+
+    def test_5_multipart_copy(self):
+        data = os.urandom(1000)
+        self.server.objects[self.key] = (data, 0)
+        self.device.COPY_THRESHOLD, self.device.COPY_PART_SIZE = 100, 300
+        puts = self.server.requests.get('PUT', 0)
+        self.device.copy_data(self.key, 'copy/1')
+        self.assertEqual(self.server.objects['copy/1'][0], data)
+        self.assertEqual(self.server.requests['PUT'] - puts, 4)
+
+    def test_6_rmdir(self):
+        for i in range(3):
+            self.put('dir/%d' % i, b'x')
+        self.put('other', b'x')
+        self.device.os_path('dir/0')
+        self.device.rmdir('dir/')
+        self.assertEqual(list(self.server.objects), ['other'])
+        self.assertFalse(self.vfs_device.exists('dir/0'))
+
+        # 云端删除失败时报错，本地Cache不删除
+        self.put('dir/1', b'x')
+        self.device.os_path('dir/1')
+        self.device.client.delete_objects = lambda keys: dict(
+            (key, errors.S3Error(200, 'AccessDenied', key)) for key in keys)
+        self.assertRaises(errors.S3Error, self.device.rmdir, 'dir/')
+        self.assertTrue(self.vfs_device.exists('dir/1'))
+
+    def test_8_batch(self):
+        keys = ['batch/%d' % i for i in range(1500)]
+        for key in keys:
+            self.server.objects[key] = (b'x', 0)
+        self.assertEqual(self.device.exists_many(keys[:3] + ['no/such/key']),
+                         dict([(key, True) for key in keys[:3]] + [('no/such/key', False)]))
+        stats = self.device.stat_many(['batch/0', 'no/such/key'])
+        self.assertEqual(stats['batch/0']['file_size'], 1)
+        self.assertIsNone(stats['no/such/key'])
+        posts = self.server.requests.get('POST', 0)
+        self.assertEqual(self.device.remove_many(keys), dict((key, None) for key in keys))
+        self.assertEqual(self.server.objects, {})
+        self.assertEqual(self.server.requests['POST'] - posts, 2)
+        self.assertFalse(self.device.exists(keys[0]))
+
+    def test_7_connection_pool(self):
+        self.put(self.key, b'data')
+
+        def read():
+            for i in range(20):
+                self.device.get_data(self.key, 0, 2)
+
+        threads = [threading.Thread(target=read) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.device.client.pool.stats()
+        self.assertLessEqual(stats['created'], 4)
+        self.assertLessEqual(self.server.requests['connections'], 4)
+        self.assertEqual(stats['in_use'], 0)
+
+
+    def test_9_checksum(self):
+        device = CephDevice('ceph_test', local_device=self.vfs_device,
+                            endpoint=self.server.endpoint, access_key_id='key',
+                            access_key_secret='secret', bucket_name='test', checksum='md5')
+        # 一个分块的文件，校验和随上传保存
+        data = os.urandom(1000)
+        session_id = device.multiput_new(self.key)
+        device.multiput(session_id, data)
+        device.multiput_save(session_id)
+        self.assertEqual(device.stat(self.key)['hash'], 'md5:' + hashlib.md5(data).hexdigest())
+        self.assertEqual(self.server.requests['PUT'], 1)
+
+        # 分块上传后复制替换元数据，保留原有的Content-Type和自定义元数据
+        request = device.client.request
+        def init_with_metas(method, key='', params=None, headers=None, **kwargs):
+            if params == {'uploads': ''}:
+                headers = {'Content-Type': 'text/plain', 'x-amz-meta-owner': 'mdfs'}
+            return request(method, key, params, headers, **kwargs)
+        device.client.request = init_with_metas
+        data = os.urandom(ceph.BUFFER_SIZE + 10)
+        session_id = device.multiput_new(self.key)
+        device.multiput(session_id, data)
+        device.multiput_save(session_id)
+        stat = device.stat(self.key)
+        self.assertEqual(stat['hash'], 'md5:' + hashlib.md5(data).hexdigest())
+        self.assertEqual(stat['mime_type'], 'text/plain')
+        self.assertEqual(self.server.metas[self.key]['x-amz-meta-owner'], 'mdfs')
+
+
+if __name__ == '__main__':
+    unittest.main()
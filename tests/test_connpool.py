@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mdfs import connpool
+from mdfs.aliyun import AliyunDevice
+from mdfs.bench.fakes3 import FakeS3Server
+from mdfs.ceph import CephDevice
+from mdfs.vfs import VfsDevice
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    """ 用本地S3服务器测试共享连接池，oss2对IP地址的endpoint也使用路径风格 """
+
+    def setUp(self):
+        self.server = FakeS3Server().start()
+        self.server.objects['a.txt'] = (b'0123456789', 0)
+        self.workspace = tempfile.mkdtemp()
+        self.vfs_device = VfsDevice('vfs_cache', root_path=self.workspace)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.workspace)
+
+    def test_1_shared_oss_pool(self):
+        devices = [AliyunDevice('aliyun_%d' % i, local_device=self.vfs_device,
+                                access_key_id='key', access_key_secret='secret',
+                                endpoint=self.server.endpoint, bucket_name='test', pool_size=3)
+                   for i in range(3)]
+        self.assertTrue(devices[0].pool is devices[2].pool)
+
+        def read():
+            for device in devices:
+                for i in range(5):
+                    self.assertEqual(device.get_data('a.txt', 2, 3), b'234')
+
+        run_threads(6, read)
+        stats = connpool.stats()[connpool.normalize_endpoint(self.server.endpoint)]
+        self.assertEqual(stats['in_use'], 0)
+        self.assertLessEqual(stats['created'], 3)
+        self.assertLessEqual(self.server.requests['connections'], 3)
+        self.assertGreater(stats['idle'], 0)
+
+        self.assertGreaterEqual(connpool.reap(idle_timeout=0), stats['idle'])
+        self.assertEqual(devices[0].pool.stats()['idle'], 0)
+        self.assertEqual(devices[1].get_data('a.txt', 0, 1), b'0')
+
+    def test_2_oss_pool_buckets(self):
+        # 每个bucket是一个虚拟主机：不同主机的请求合起来也不超过endpoint的上限
+        server = FakeS3Server(latency=0.02).start()
+        try:
+            pool = connpool.OssPool(2)
+            for bucket_name in ('test', 'test2', 'test3'):
+                pool.add_bucket(bucket_name)
+            port = server.server_address[1]
+            urls = ['http://%s:%d/test/a.txt' % (host, port)
+                    for host in ('127.0.0.1', 'localhost')]
+
+            def read():
+                for i in range(3):
+                    for url in urls:
+                        # 没有签名，服务器返回AccessDenied，只关心连接
+                        self.assertTrue(pool.session.session.get(url).content)
+
+            run_threads(6, read)
+            stats = pool.stats()
+            self.assertEqual(stats['in_use'], 0)
+            self.assertEqual(stats['peak'], 2)
+            self.assertEqual(len(pool.adapter.poolmanager.pools), 2)
+            self.assertLessEqual(stats['created'], 4)
+        finally:
+            server.stop()
+
+    def test_3_released_after_head(self):
+        device = AliyunDevice('aliyun_head', local_device=self.vfs_device,
+                              access_key_id='key', access_key_secret='secret',
+                              endpoint=self.server.endpoint, bucket_name='test', pool_size=2)
+        for i in range(5):
+            self.assertTrue(device.exists('a.txt'))
+            device.meta_cache.invalidate('a.txt')
+            self.assertFalse(device.exists('b.txt'))
+        self.assertEqual(device.pool.stats()['in_use'], 0)
+
+    def test_4_shared_s3_pool(self):
+        devices = [CephDevice('ceph_%d' % i, local_device=self.vfs_device,
+                              endpoint=self.server.endpoint, access_key_id='key',
+                              access_key_secret='secret', bucket_name='test', pool_size=2)
+                   for i in range(2)]
+        self.assertTrue(devices[0].client.pool is devices[1].client.pool)
+        run_threads(4, lambda: [device.get_data('a.txt', 0, 1) for device in devices])
+        self.assertLessEqual(self.server.requests['connections'], 2)
+        self.assertEqual(devices[0].client.pool.reap(idle_timeout=0), 2)
+        self.assertEqual(devices[0].client.pool.stats()['reaped'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
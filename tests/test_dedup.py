@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+
+from mdfs import errors
+from mdfs.dedup import DedupDevice, blob_key
+from mdfs.vfs import VfsDevice
+
+
+class DedupDeviceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.vfs_device = VfsDevice('vfs', root_path=os.path.join(self.workspace, 'vfs'))
+        self.device = DedupDevice('dedup', self.vfs_device,
+                                  os.path.join(self.workspace, 'dedup.db'))
+        self.data = os.urandom(100000)
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def put(self, key, data):
+        session_id = self.device.multiput_new(key)
+        for i in range(0, len(data), 30000):
+            self.device.multiput(session_id, data[i:i + 30000])
+        return self.device.multiput_save(session_id)
+
+    def blobs(self):
+        return [name for root, dirs, files in os.walk(self.vfs_device.os_path('blobs'))
+                for name in files]
+
+    def test_1_dedup(self):
+        self.put('a/1.doc', self.data)
+        self.put('b/2.doc', self.data)
+        self.assertEqual(self.device.get_data('b/2.doc'), self.data)
+        digest = hashlib.sha256(self.data).hexdigest()
+        self.assertEqual(self.blobs(), [digest])
+        self.assertEqual(self.device.stat('a/1.doc')['hash'], 'sha256:' + digest)
+        self.assertEqual(self.device.stats(), {'keys': 2, 'blobs': 1, 'stored_bytes': 100000,
+                                               'logical_bytes': 200000})
+        self.assertEqual(os.listdir(self.vfs_device.os_path('.dedup/tmp')), [])
+
+    def test_2_copy_remove(self):
+        self.put('a/1.doc', self.data)
+        self.device.copy_data('a/1.doc', 'a/2.doc')
+        self.device.move('a/2.doc', 'a/3.doc')
+        self.assertFalse(self.device.exists('a/2.doc'))
+        self.device.remove('a/1.doc')
+        self.assertEqual(b''.join(self.device.iter_data('a/3.doc')), self.data)
+        self.device.remove('a/3.doc')
+        self.assertEqual(self.blobs(), [])
+        self.assertRaises(errors.FileNotFound, self.device.remove, 'a/3.doc')
+        self.assertRaises(errors.FileNotFound, self.device.stat, 'a/3.doc')
+
+    def test_3_overwrite(self):
+        self.put('a/1.doc', self.data)
+        self.put('a/1.doc', b'new data')
+        self.assertEqual(self.device.get_data('a/1.doc'), b'new data')
+        self.assertEqual(self.blobs(), [hashlib.sha256(b'new data').hexdigest()])
+        self.device.rmdir('a/')
+        self.assertEqual(self.device.stats()['keys'], 0)
+
+    def test_4_concurrent_uploads(self):
+        threads = [threading.Thread(target=self.put, args=('k/%d' % i, self.data))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.blobs()), 1)
+        digest = hashlib.sha256(self.data).hexdigest()
+        self.assertEqual(self.vfs_device.get_data(blob_key(digest)), self.data)
+        self.assertEqual(self.device.stats()['keys'], 8)
+
+    def test_5_sequential_only(self):
+        session_id = self.device.multiput_new('a/1.doc')
+        self.device.multiput(session_id, b'abc', 0)
+        self.assertRaises(Exception, self.device.multiput, session_id, b'abc', 10)
+        self.device.multiput_delete(session_id)
+        self.assertFalse(self.device.exists('a/1.doc'))
+
+    def test_6_resume_session(self):
+        session_id = self.device.multiput_new('a/1.doc')
+        self.device.multiput(session_id, self.data[:30000])
+        # 会话ID中带有临时文件和key，新的实例(如另一个进程)也能继续写入和保存
+        device = DedupDevice('dedup', self.vfs_device, os.path.join(self.workspace, 'dedup.db'))
+        self.assertEqual(device.multiput_offset(session_id), 30000)
+        device.multiput(session_id, self.data[30000:], 30000)
+        self.assertEqual(device.multiput_save(session_id), 'a/1.doc')
+        self.assertEqual(self.device.get_data('a/1.doc'), self.data)
+        self.assertEqual(self.device.stat('a/1.doc')['hash'],
+                         'sha256:' + hashlib.sha256(self.data).hexdigest())
+
+        session_id = self.device.multiput_new('b/2.doc')
+        device.multiput_delete(session_id)
+        self.assertEqual(os.listdir(self.vfs_device.os_path('.dedup/tmp')), [])
+
+    def test_7_cleanup_tmp(self):
+        old_session = self.device.multiput_new('a/1.doc')
+        self.device.multiput(old_session, b'abc')
+        tmp_dir = self.vfs_device.os_path('.dedup/tmp')
+        old_name = os.listdir(tmp_dir)[0]
+        os.utime(os.path.join(tmp_dir, old_name), (0, 0))
+        new_session = self.device.multiput_new('b/2.doc')
+        self.device.multiput(new_session, b'def')
+        self.assertEqual(self.device.cleanup(3600), 1)
+        self.assertEqual(len(os.listdir(tmp_dir)), 1)
+        self.assertNotIn(old_name, os.listdir(tmp_dir))
+        self.device.multiput_save(new_session)
+        self.assertEqual(self.device.get_data('b/2.doc'), b'def')
+
+
+if __name__ == '__main__':
+    unittest.main()
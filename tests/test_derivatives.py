@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from mdfs.derivatives import DerivativeIndex
+from mdfs.device import StorageDeviceManager
+from mdfs.vfs import VfsDevice
+
+from mdfs.bench.fakeoss import new_device
+
+
+class DerivativeIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.index = DerivativeIndex(os.path.join(self.workspace, 'derivatives.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def test_1_add_list(self):
+        self.index.add('vfs', 'a/b.doc', 'application/pdf', '', 100)
+        self.index.add('vfs', 'a/b.doc', 'image/png', '1.png', 20)
+        self.index.add('vfs', 'a/b.doc', 'image/png', '1.png', 30)
+        self.index.add('vfs', 'a/c.doc', '', '', 5)
+        self.assertEqual([(e['mime'], e['subpath'], e['size']) for e in self.index.list('vfs', 'a/b.doc')],
+                         [('application/pdf', '', 100), ('image/png', '1.png', 30)])
+        self.assertEqual(self.index.total_size('vfs', 'a/b.doc'), 130)
+        self.assertEqual(self.index.total_size('vfs'), 135)
+        self.assertEqual(self.index.total_size('other'), 0)
+        self.index.discard('vfs', 'a/b.doc', 'image/png', '1.png')
+        self.assertEqual(self.index.total_size('vfs', 'a/b.doc'), 100)
+
+    def test_2_pop_move(self):
+        self.index.add('vfs', 'a/b.doc', 'application/pdf', '', 100)
+        self.index.add('vfs', 'a/d.doc', 'image/png', '', 1)
+        self.assertEqual(len(self.index.move('vfs', 'a/b.doc', 'a/d.doc')), 1)
+        self.assertEqual(self.index.list('vfs', 'a/b.doc'), [])
+        self.assertEqual([e['mime'] for e in self.index.list('vfs', 'a/d.doc')], ['application/pdf'])
+        self.assertEqual(len(self.index.pop('vfs', 'a/d.doc')), 1)
+        self.assertEqual(self.index.total_size('vfs'), 0)
+
+
+class ManagerDerivativesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.key = 'ab/cd/efghijklmnopqrstuvwxyz.docx'
+        self.device = VfsDevice('vfs', root_path=os.path.join(self.workspace, 'vfs'))
+        self.manager = StorageDeviceManager(
+            session_dir=os.path.join(self.workspace, 'sessions'),
+            derivatives=DerivativeIndex(os.path.join(self.workspace, 'derivatives.db')))
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def put_derivatives(self, name):
+        self.manager.put_data(name, self.key, b'source')
+        self.manager.commit()
+        self.manager.put_cache(name, self.key, b'pdf', 'application/pdf')
+        self.manager.put_cache(name, self.key, b'page1', 'image/png', '1.png')
+        self.manager.put_cache(name, self.key, b'page2', 'image/png', '2.png')
+        self.assertEqual(self.manager.cache_size(name, self.key), 13)
+
+    def test_1_local_cache(self):
+        cache_device = VfsDevice('cache', root_path=os.path.join(self.workspace, 'cache'))
+        self.manager.add(self.device, cache_device)
+        self.put_derivatives('vfs')
+        new_key = 'xy/z.docx'
+        self.manager.move('vfs', self.key, new_key)
+        self.assertFalse(cache_device.exists(self.manager.get_cache_key(self.key)))
+        self.assertEqual(cache_device.get_data(self.manager.get_cache_key(new_key, 'image/png', '2.png')),
+                         b'page2')
+        self.assertEqual(len(self.manager.list_cache('vfs', new_key)), 3)
+
+        self.manager.remove('vfs', new_key)
+        self.assertFalse(cache_device.exists(self.manager.get_cache_key(new_key)))
+        self.assertEqual(self.manager.cache_size('vfs'), 0)
+
+    def test_2_object_storage_cache(self):
+        """ 对象存储上的缓存按索引逐个处理，不需要列举前缀 """
+        cache_device = new_device(self.device)
+        bucket = cache_device.bucket
+        self.manager.add(self.device, cache_device)
+        self.put_derivatives('vfs')
+        new_key = 'xy/z.docx'
+        self.manager.move('vfs', self.key, new_key)
+        self.assertEqual(sorted(bucket.objects),
+                         [self.manager.get_cache_key(new_key, 'application/pdf'),
+                          self.manager.get_cache_key(new_key, 'image/png', '1.png'),
+                          self.manager.get_cache_key(new_key, 'image/png', '2.png')])
+        self.manager.remove('vfs', new_key)
+        self.assertEqual(bucket.objects, {})
+        self.assertNotIn('list_objects', bucket.requests)
+
+    def test_3_remove_many(self):
+        cache_device = new_device(self.device)
+        bucket = cache_device.bucket
+        self.manager.add(self.device, cache_device)
+        keys = ['a/%d.doc' % i for i in range(20)]
+        for key in keys:
+            self.manager.put_data('vfs', key, b'source')
+            self.manager.put_cache('vfs', key, b'pdf', 'application/pdf')
+        self.manager.commit()
+        self.assertEqual(self.manager.exists_many('vfs', keys + ['none']),
+                         dict([(key, True) for key in keys] + [('none', False)]))
+        results = self.manager.remove_many('vfs', keys + ['none'])
+        self.assertEqual([key for key, error in results.items() if error is not None], ['none'])
+        self.assertEqual(bucket.objects, {})
+        self.assertEqual(bucket.requests['batch_delete_objects'], 1)
+        self.assertEqual(self.manager.cache_size('vfs'), 0)
+        self.assertEqual(set(self.manager.stat_many('vfs', keys).values()), set([None]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from mdfs.device import StorageDeviceManager
+from mdfs.metrics import Histogram, Metrics
+from mdfs.vfs import VfsDevice
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.manager = StorageDeviceManager(session_dir=os.path.join(self.workspace, 'sessions'))
+        self.manager.add(VfsDevice('vfs', root_path=os.path.join(self.workspace, 'vfs')),
+                         VfsDevice('cache', root_path=os.path.join(self.workspace, 'cache')))
+        self.data = os.urandom(100000)
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def test_1_histogram(self):
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.75), 1.0)
+        self.assertEqual(histogram.quantile(1), float('inf'))
+        self.assertIsNone(Histogram().quantile(0.5))
+
+    def test_2_manager_stats(self):
+        self.manager.put_data('vfs', 'a/1.doc', self.data)
+        self.manager.commit()
+        self.assertEqual(self.manager.get_data('vfs', 'a/1.doc', 0, 10), self.data[:10])
+        self.assertEqual(b''.join(self.manager.iter_data('vfs', 'a/1.doc')), self.data)
+        self.assertRaises(OSError, self.manager.stat, 'vfs', 'a/2.doc')
+        self.manager.put_cache('vfs', 'a/1.doc', b'thumb', 'image/png')
+
+        stats = self.manager.stats()['vfs']
+        operations = stats['operations']
+        self.assertEqual(operations['multiput']['bytes'], len(self.data))
+        self.assertEqual(operations['get_data']['bytes'], 10)
+        self.assertEqual(operations['iter_data']['bytes'], len(self.data))
+        self.assertEqual(operations['stat']['errors'], 1)
+        self.assertEqual(operations['stat']['count'], 1)
+        self.assertEqual(operations['put_cache']['bytes'], 5)
+        for operation in ('session_new', 'session_update', 'session_delete'):
+            self.assertEqual(operations[operation]['count'], 1)
+        latency = operations['multiput_save']['latency']
+        self.assertEqual(sum(latency['counts']), 1)
+        self.assertEqual(stats['caches'], {})
+
+    def test_3_hooks(self):
+        records = []
+        self.manager.metrics.add_hook(lambda *args: records.append(args))
+        self.manager.metrics.add_hook(lambda *args: 1 / 0)
+        self.manager.exists('vfs', 'a/1.doc')
+        self.assertEqual(len(records), 1)
+        device, operation, seconds, nbytes, error = records[0]
+        self.assertEqual((device, operation, nbytes, error), ('vfs', 'exists', 0, None))
+        self.assertTrue(seconds >= 0)
+
+        # 没有读完就关闭的流式读取不算错误
+        self.manager.put_data('vfs', 'a/1.doc', self.data)
+        chunks = self.manager.iter_data('vfs', 'a/1.doc', chunk_size=1000)
+        next(chunks)
+        chunks.close()
+        self.assertEqual(records[-1][1], 'iter_data')
+        self.assertEqual(records[-1][3], 1000)
+        self.assertIsNone(records[-1][4])
+
+    def test_4_disabled(self):
+        manager = StorageDeviceManager(session_dir=os.path.join(self.workspace, 'sessions'),
+                                       metrics=Metrics(enabled=False))
+        manager.add(VfsDevice('vfs', root_path=os.path.join(self.workspace, 'vfs')), None)
+        manager.put_data('vfs', 'a/1.doc', self.data)
+        self.assertEqual(manager.stats(), {'vfs': {'operations': {}, 'caches': {}}})
+
+
+if __name__ == '__main__':
+    unittest.main()
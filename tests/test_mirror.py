@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import hashlib
+import tempfile
+import time
+import unittest
+
+from mdfs import errors
+from mdfs.mirror import MirrorDevice
+from mdfs.vfs import VfsDevice
+
+
+class SlowDevice(VfsDevice):
+    """ 每个写操作都有延迟，可以设置为失败 """
+
+    def __init__(self, name, root_path, latency=0, fail=False):
+        VfsDevice.__init__(self, name, root_path=root_path)
+        self.latency = latency
+        self.fail = fail
+        self.read_latency = 0
+        self.read_fail = False
+        self.new_fail = False
+        self.reads = 0
+
+    def _delay(self):
+        time.sleep(self.latency)
+        if self.fail:
+            raise IOError('%s is down' % self.name)
+
+    def multiput_new(self, key, size=-1):
+        if self.new_fail:
+            raise IOError('%s is down' % self.name)
+        return VfsDevice.multiput_new(self, key, size)
+
+    def multiput(self, session_id, data, offset=None):
+        self._delay()
+        return VfsDevice.multiput(self, session_id, data, offset)
+
+    def remove(self, key):
+        self._delay()
+        return VfsDevice.remove(self, key)
+
+    def get_data(self, key, offset=0, size=-1):
+        self.reads += 1
+        time.sleep(self.read_latency)
+        if self.read_fail:
+            raise IOError('%s is down' % self.name)
+        return VfsDevice.get_data(self, key, offset, size)
+
+
+class MirrorDeviceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.key = 'ab/cd/efghijklmnopqrstuvwxyz.docx'
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def new_device(self, devices, **kwargs):
+        devices = [SlowDevice(name, os.path.join(self.workspace, name), latency, fail)
+                   for name, latency, fail in devices]
+        return MirrorDevice('mirror', mirror_devices=devices, **kwargs)
+
+    def put(self, device, chunks):
+        session_id = device.multiput_new(self.key)
+        for i in range(chunks):
+            device.multiput(session_id, b'%d' % i)
+        return device.multiput_save(session_id)
+
+    def test_1_concurrent_fanout(self):
+        device = self.new_device([('a', 0.05, False), ('b', 0.05, False), ('c', 0.05, False)])
+        start = time.time()
+        self.put(device, 4)
+        self.assertLess(time.time() - start, 0.4)
+        for mirror in device.mirror_devices:
+            self.assertEqual(mirror.get_data(self.key), b'0123')
+
+    def test_2_quorum(self):
+        device = self.new_device([('a', 0, False), ('b', 0, False), ('slow', 0.2, False)],
+                                 write_quorum=2)
+        start = time.time()
+        self.put(device, 3)
+        self.assertLess(time.time() - start, 0.3)
+        self.assertEqual(device.get_data(self.key), b'012')
+        # 慢的镜像按顺序继续写入
+        device.remove(self.key)
+        slow = device.mirror_devices[2]
+        time.sleep(0.5)
+        self.assertFalse(slow.exists(self.key))
+        self.assertEqual(list(device.lagging), [])
+
+    def test_3_lagging(self):
+        device = self.new_device([('a', 0, False), ('down', 0, True)], write_quorum=1)
+        self.put(device, 2)
+        time.sleep(0.05)
+        self.assertEqual(set(item['device'] for item in device.lagging), set(['down']))
+        self.assertEqual(set(item['operation'] for item in device.lagging),
+                         set(['multiput', 'multiput_save']))
+
+    def test_4_errors_per_mirror(self):
+        device = self.new_device([('a', 0, False), ('down', 0, True)])
+        session_id = device.multiput_new(self.key)
+        try:
+            device.multiput(session_id, b'data')
+        except errors.MirrorError as e:
+            self.assertEqual(list(e.errors.keys()), ['down'])
+            self.assertIsInstance(e.errors['down'], IOError)
+        else:
+            self.fail('MirrorError not raised')
+
+    def test_5_read_routing(self):
+        device = self.new_device([('slow', 0, False), ('fast', 0, False)])
+        self.put(device, 1)
+        device.mirror_devices[0].read_latency = 0.02
+        for i in range(10):
+            self.assertEqual(device.get_data(self.key), b'0')
+        slow, fast = device.mirror_devices
+        self.assertEqual(slow.reads, 1)
+        self.assertEqual(fast.reads, 9)
+
+    def test_6_error_cooldown(self):
+        device = self.new_device([('a', 0, False), ('b', 0, False)], error_cooldown=60)
+        self.put(device, 1)
+        a, b = device.mirror_devices
+        a.read_fail = True
+        for i in range(5):
+            self.assertEqual(device.get_data(self.key), b'0')
+        self.assertEqual(a.reads, 1)
+        self.assertFalse(device.scheduler.stats()['a']['healthy'])
+        # 文件不存在不算镜像故障
+        self.assertRaises(IOError, device.get_data, 'no/such/key')
+        self.assertTrue(device.scheduler.stats()['b']['healthy'])
+
+    def test_7_hedged_read(self):
+        device = self.new_device([('a', 0, False), ('b', 0, False)], hedge_percentile=90)
+        self.put(device, 1)
+        a, b = device.mirror_devices
+        for i in range(20):
+            device.scheduler.record(a, 0.01)
+            device.scheduler.record(b, 0.01)
+        first = device.scheduler.candidates()[0]
+        first.read_latency = 1
+        start = time.time()
+        self.assertEqual(device.get_data(self.key), b'0')
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_8_copy_data(self):
+        device = self.new_device([('a', 0, False), ('b', 0, False)])
+        self.put(device, 4)
+        device.copy_data(self.key, 'copy/1')
+        for mirror in device.mirror_devices:
+            self.assertEqual(mirror.get_data('copy/1'), b'0123')
+            self.assertEqual(sum(mirror.copy_counts.values()), 1)
+
+    def test_9_checksum(self):
+        device = self.new_device([('a', 0, False), ('b', 0, False), ('c', 0, False)],
+                                 write_quorum=3, checksum='md5')
+        for mirror in device.mirror_devices:
+            mirror.checksum = 'md5'
+        self.put(device, 4)
+        self.assertEqual(device.stat(self.key)['hash'], 'md5:' + hashlib.md5(b'0123').hexdigest())
+        self.assertEqual(len(device.lagging), 0)
+
+        # 一个镜像的数据和写入的不一致；还在保存的镜像保存完后再比较
+        bad = device.mirror_devices[2]
+        bad_stat = bad.stat
+        bad.stat = lambda key: dict(bad_stat(key), hash='md5:0')
+        device.write_quorum = 2
+        self.put(device, 4)
+        for i in range(100):
+            if device.lagging:
+                break
+            time.sleep(0.01)
+        self.assertEqual([item['device'] for item in device.lagging], ['c'])
+        device.write_quorum = 3
+        self.assertRaises(errors.MirrorError, self.put, device, 4)
+
+    def wait_lanes(self, device):
+        for i in range(100):
+            if not device._lanes:
+                break
+            time.sleep(0.01)
+        self.assertEqual(device._lanes, {})
+
+    def test_10_delete_degraded_session(self):
+        device = self.new_device([('a', 0, False), ('down', 0, True)], write_quorum=1)
+        session_id = device.multiput_new(self.key)
+        device.multiput(session_id, b'0')
+        device.multiput(session_id, b'1')
+        # 失败的镜像也删除会话，不再报错
+        device.multiput_delete(session_id)
+        for mirror in device.mirror_devices:
+            self.assertFalse(mirror.exists(self.key))
+        self.wait_lanes(device)
+
+    def test_11_detach_lagging_mirror(self):
+        device = self.new_device([('a', 0, False), ('slow', 0.05, False)], write_quorum=1,
+                                 max_pending=2)
+        start = time.time()
+        self.put(device, 20)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(device.get_data(self.key), b''.join(b'%d' % i for i in range(20)))
+        self.assertIn('slow', set(item['device'] for item in device.lagging))
+        self.wait_lanes(device)
+        slow = device.mirror_devices[1]
+        # 退出会话的镜像删除了写了一半的文件
+        self.assertFalse(slow.exists(self.key))
+
+    def test_12_new_session_quorum(self):
+        device = self.new_device([('down', 0, False), ('a', 0, False), ('b', 0, False)],
+                                 write_quorum=2)
+        down = device.mirror_devices[0]
+        down.new_fail = True
+        # 一个镜像开始会话失败，其余的满足quorum，仍然可以上传
+        session_id = device.multiput_new(self.key)
+        device.multiput(session_id, b'0')
+        device.multiput(session_id, b'1')
+        self.assertEqual(device.multiput_offset(session_id), 2)
+        device.multiput_save(session_id)
+        self.assertEqual(device.mirror_devices[1].get_data(self.key), b'01')
+        self.assertFalse(down.exists(self.key))
+        self.assertIn('multiput_new', [item['operation'] for item in device.lagging])
+        self.wait_lanes(device)
+
+        # 不满足quorum时，已经开始的会话都删除
+        device.mirror_devices[1].new_fail = True
+        self.assertRaises(errors.MirrorError, device.multiput_new, 'x/1.doc')
+        self.assertFalse(device.mirror_devices[2].exists('x/1.doc'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from mdfs.device import StorageDeviceManager
+from mdfs.prefetch import Prefetcher, Readahead
+from mdfs.vfs import VfsDevice
+
+from mdfs.bench.fakeoss import new_device
+
+
+class PrefetchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.device = new_device(VfsDevice('local', root_path=self.workspace), range_readahead=4)
+        self.data = os.urandom(100000)
+
+    def tearDown(self):
+        self.device.prefetcher.stop()
+        shutil.rmtree(self.workspace)
+
+    def put(self, key, data):
+        session_id = self.device.multiput_new(key)
+        self.device.multiput(session_id, data)
+        self.device.multiput_save(session_id)
+        self.device._remove_local(key)
+
+    def test_1_prefetch(self):
+        keys = ['a/%d.doc' % i for i in range(5)]
+        for key in keys:
+            self.put(key, self.data)
+        manager = StorageDeviceManager(session_dir=os.path.join(self.workspace, '.sessions'))
+        manager.add(self.device, None)
+        self.assertEqual(manager.prefetch('aliyun_fake', keys + ['a/missing.doc']), 6)
+        self.assertTrue(self.device.prefetcher.wait(5))
+        for key in keys:
+            self.assertTrue(self.device.local_device.exists(key))
+
+        # 已经在本地的不再预取，os_path不用下载
+        gets = self.device.bucket.requests['get_object']
+        self.assertEqual(manager.prefetch('aliyun_fake', keys), 0)
+        with open(manager.os_path('aliyun_fake', keys[0]), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(self.device.bucket.requests['get_object'], gets)
+
+        stats = manager.stats()['aliyun_fake']['prefetch']
+        self.assertEqual((stats['queued'], stats['fetched'], stats['errors']), (0, 5, 1))
+
+    def test_2_priority(self):
+        order = []
+        gate = threading.Event()
+
+        def fetch(key):
+            gate.wait()
+            order.append(key)
+
+        prefetcher = Prefetcher(fetch, workers=1)
+        prefetcher.add(['first'])
+        for i in range(20):
+            if prefetcher.stats()['running']:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(prefetcher.add(['low', 'high', 'first']), 2)
+        self.assertEqual(prefetcher.add(['high'], priority=10), 1)
+        prefetcher.add(['cancelled'], priority=5)
+        prefetcher.cancel(['cancelled'])
+        gate.set()
+        self.assertTrue(prefetcher.wait(5))
+        self.assertEqual(order, ['first', 'high', 'low'])
+        prefetcher.stop()
+
+    def test_3_readahead(self):
+        self.put('a/1.doc', self.data)
+        size = 1000
+        data = b''.join(self.device.get_data('a/1.doc', offset, size)
+                        for offset in range(0, len(self.data), size))
+        self.assertEqual(data, self.data)
+        stats = self.device.readahead.stats()
+        self.assertTrue(stats['hits'] > 90)
+
+        # 随机读不预读
+        gets = self.device.bucket.requests['get_object']
+        for offset in (50000, 10000, 70000):
+            self.assertEqual(self.device.get_data('a/1.doc', offset, 10),
+                             self.data[offset:offset + 10])
+        self.assertEqual(self.device.bucket.requests['get_object'] - gets, 3)
+
+        # 改写后不会读到预读的旧数据
+        self.device.get_data('a/1.doc', 0, size)
+        self.device.get_data('a/1.doc', size, size)
+        new_data = os.urandom(len(self.data))
+        self.put('a/1.doc', new_data)
+        self.assertEqual(self.device.get_data('a/1.doc', size * 2, size),
+                         new_data[size * 2:size * 3])
+
+    def test_4_readahead_disabled(self):
+        # 默认不预读
+        device = new_device(self.device.local_device, bucket=self.device.bucket)
+        self.put('a/1.doc', self.data)
+        for offset in range(0, 10000, 1000):
+            self.assertEqual(device.get_data('a/1.doc', offset, 1000),
+                             self.data[offset:offset + 1000])
+        self.assertIsNone(device.readahead)
+        self.assertEqual(device.bucket.requests['get_object'], 10)
+
+    def test_5_readahead_max_bytes(self):
+        # 所有文件预读的数据总量有上限，读走之后才继续预读
+        gate = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(executor.shutdown)
+        self.addCleanup(gate.set)
+
+        def read_range(key, offset, size):
+            # 预读的范围等到检查完再返回
+            if offset >= 2000:
+                gate.wait()
+            return self.data[offset:offset + size]
+
+        readahead = Readahead(read_range, lambda key: len(self.data), lambda: executor,
+                              ranges=4, max_bytes=2500)
+        for key in ('a', 'b'):
+            readahead.get_data(key, 0, 1000)
+        readahead.get_data('a', 1000, 1000)
+        readahead.get_data('b', 1000, 1000)
+        stats = readahead.stats()
+        self.assertEqual(stats['ahead_bytes'], 2000)
+        self.assertTrue(stats['skipped'] > 0)
+        gate.set()
+        self.assertEqual(readahead.get_data('a', 2000, 1000), self.data[2000:3000])
+        self.assertEqual(readahead.stats()['hits'], 1)
+        readahead.invalidate('a')
+        readahead.invalidate('b')
+        self.assertEqual(readahead.stats()['ahead_bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
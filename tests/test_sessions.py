@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from mdfs.device import Sessions, StorageDeviceManager
+from mdfs.sessions import SqliteSessions
+from mdfs.vfs import VfsDevice
+
+
+class SqliteSessionsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.sessions = SqliteSessions(os.path.join(self.workspace, 'sessions.db'))
+        self.device, self.key = 'default', 'ab/cd/efghijklmnopqrstuvwxyz.docx'
+        self.sessions.new(self.device, self.key, a='1', b=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def test_1_load_update(self):
+        self.sessions.update(self.device, self.key, b=3, c='3')
+        self.assertEqual(self.sessions.load(self.device, self.key),
+                         {'device': self.device, 'key': self.key, 'a': '1', 'b': 3, 'c': '3'})
+
+    def test_2_query_expire(self):
+        time.sleep(0.1)
+        self.sessions.new(self.device, 'as/df/qwertyuiofdgdasf4567d.pptx')
+        sessions = self.sessions.query(expire=0.05)
+        self.assertEqual([session['key'] for session in sessions], [self.key])
+        self.assertEqual(len(self.sessions.query()), 2)
+
+    def test_3_delete(self):
+        self.sessions.delete(self.device, self.key)
+        self.assertRaises(OSError, self.sessions.load, self.device, self.key)
+        self.assertRaises(OSError, self.sessions.delete, self.device, self.key)
+        self.assertRaises(OSError, self.sessions.update, self.device, self.key, a=2)
+
+    def test_4_delete_many(self):
+        items = [(self.device, 'k/%d' % i) for i in range(1200)]
+        for device, key in items:
+            self.sessions.new(device, key)
+        self.sessions.delete_many(items + [('none', 'none')])
+        self.assertEqual(len(self.sessions.query()), 1)
+
+    def test_5_import_dir(self):
+        session_dir = os.path.join(self.workspace, 'dir')
+        old = Sessions(session_dir=session_dir)
+        old.new('default', 'x/y/z.doc', session_id='123')
+        os.utime(old.os_path('default', 'x/y/z.doc'), (1, 1))
+        self.assertEqual(self.sessions.import_dir(session_dir), 1)
+        self.assertEqual(os.listdir(session_dir), [])
+        self.assertEqual(self.sessions.load('default', 'x/y/z.doc')['session_id'], '123')
+        self.assertEqual([s['key'] for s in self.sessions.query(expire=3600)], ['x/y/z.doc'])
+
+    def test_6_manager_cleanup(self):
+        self.sessions.delete(self.device, self.key)
+        manager = StorageDeviceManager(sessions=self.sessions)
+        manager.add(VfsDevice('vfs', root_path=os.path.join(self.workspace, 'vfs')), None)
+        manager.multiput_new('vfs', 'a/b.txt')
+        manager.multiput('vfs', manager.sessions.load('vfs', 'a/b.txt')['session_id'], b'data')
+        time.sleep(0.05)
+        manager.cleanup(expire=0.01)
+        self.assertFalse(manager.exists('vfs', 'a/b.txt'))
+        self.assertEqual(manager.sessions.query(), [])
+
+    def test_7_cleanup_continues_after_error(self):
+        self.sessions.delete(self.device, self.key)
+        manager = StorageDeviceManager(sessions=self.sessions)
+        manager.add(VfsDevice('vfs', root_path=os.path.join(self.workspace, 'vfs')), None)
+        for key in ('a/1', 'a/2'):
+            manager.put_data('vfs', key, b'data')
+        manager._t_pop()
+        failing = manager.remove
+
+        def remove(name, key):
+            if key == 'a/1':
+                raise IOError('remove failed')
+            failing(name, key)
+        manager.remove = remove
+        time.sleep(0.05)
+        manager.cleanup(expire=0.01)
+        # 失败的会话保留记录，之后的会话照常删除
+        self.assertTrue(manager.exists('vfs', 'a/1'))
+        self.assertFalse(manager.exists('vfs', 'a/2'))
+        self.assertEqual([session['key'] for session in manager.sessions.query()], ['a/1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mdfs.singleflight import SingleFlight, file_lock
+from mdfs.vfs import VfsDevice
+
+from mdfs.bench.fakeoss import new_device
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def test_1_shared_result(self):
+        flight = SingleFlight()
+        calls, results = [], []
+
+        def fn():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'done'
+
+        run_threads(10, lambda: results.append(flight.do('key', fn)))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['done'] * 10)
+
+    def test_2_shared_error(self):
+        flight = SingleFlight()
+        errors = []
+
+        def fn():
+            time.sleep(0.1)
+            raise ValueError('failed')
+
+        def call():
+            try:
+                flight.do('key', fn)
+            except ValueError as e:
+                errors.append(e)
+
+        run_threads(5, call)
+        self.assertEqual(len(errors), 5)
+
+    def test_3_file_lock(self):
+        path = os.path.join(self.workspace, 'a', 'b.lock')
+        holders = []
+
+        def hold():
+            with file_lock(path):
+                holders.append(1)
+                self.assertEqual(len(holders), 1)
+                time.sleep(0.02)
+                holders.pop()
+
+        run_threads(5, hold)
+        self.assertFalse(os.path.exists(path))
+
+    def test_4_aliyun_burst(self):
+        """ 同一个key的并发os_path只从后端下载一次 """
+        device = new_device(VfsDevice('vfs', root_path=self.workspace), latency=0.05)
+        key = 'ab/cd/efghijklmnopqrstuvwxyz.docx'
+        data = os.urandom(1000)
+        device.bucket.put_object(key, data)
+        paths = []
+        run_threads(10, lambda: paths.append(device.os_path(key)))
+        self.assertEqual(device.bucket.requests['get_object'], 1)
+        self.assertEqual(device.bucket.requests['head_object'], 1)
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import shutil
+import hashlib
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+from mdfs.device import StorageDeviceManager
+from mdfs.vfs import VfsDevice, OpenFiles
+
+
+class VfsDeviceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.device = VfsDevice('vfs', root_path=os.path.join(self.workspace, 'vfs'))
+        self.key = 'ab/cd/efghijklmnopqrstuvwxyz.docx'
+        self.data = os.urandom(3 * 1024 * 1024 + 10)
+        session_id = self.device.multiput_new(self.key)
+        self.device.multiput(session_id, self.data)
+        self.device.multiput_save(session_id)
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def test_1_iter_data(self):
+        chunks = list(self.device.iter_data(self.key))
+        self.assertEqual([len(chunk) for chunk in chunks],
+                         [self.device.PART_SIZE] * 3 + [10])
+        self.assertEqual(b''.join(chunks), self.data)
+        self.assertEqual(b''.join(self.device.iter_data(self.key, 100, 5000, chunk_size=1000)),
+                         self.data[100:5100])
+
+    def test_2_manager_iter_data(self):
+        manager = StorageDeviceManager(session_dir=os.path.join(self.workspace, 'sessions'))
+        manager.add(self.device, None)
+        self.assertEqual(b''.join(manager.iter_data('vfs', self.key, offset=5)), self.data[5:])
+
+
+    def test_3_zero_copy_view(self):
+        device = VfsDevice('vfs', root_path=self.device.root_path, zero_copy=True)
+        view = device.get_data(self.key, 10, 100)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view.tobytes(), self.data[10:110])
+        self.assertEqual(bytes(device.get_view(self.key, len(self.data) - 5, 100)),
+                         self.data[-5:])
+        # 重写文件后重新映射
+        session_id = device.multiput_new(self.key)
+        device.multiput(session_id, b'new data')
+        device.multiput_save(session_id)
+        self.assertEqual(bytes(device.get_data(self.key, 0, 3)), b'new')
+
+    def test_4_sendfile(self):
+        server, client = socket.socketpair()
+        received = []
+
+        def receive():
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+
+        thread = threading.Thread(target=receive)
+        thread.start()
+        sent = self.device.sendfile(self.key, server, offset=100, size=2 * 1024 * 1024)
+        server.close()
+        thread.join()
+        client.close()
+        self.assertEqual(sent, 2 * 1024 * 1024)
+        self.assertEqual(b''.join(received), self.data[100:100 + 2 * 1024 * 1024])
+
+    def test_5_copy_strategies(self):
+        os.chmod(self.device.os_path(self.key), 0o640)
+        self.device.copy_data(self.key, 'copy/1')
+        self.assertEqual(self.device.get_data('copy/1'), self.data)
+        self.assertEqual(os.stat(self.device.os_path('copy/1')).st_mode & 0o777, 0o640)
+        self.assertEqual(sum(self.device.copy_counts.values()), 1)
+        # 不支持reflink的文件系统只尝试一次
+        if 'reflink' in self.device.unsupported_copies:
+            self.device.copy_data(self.key, 'copy/2')
+            self.assertEqual(self.device.copy_counts['reflink'], 0)
+
+        device = VfsDevice('vfs', root_path=self.device.root_path, copy_strategy='buffer')
+        device.copy_data(self.key, 'copy/1')
+        self.assertEqual(device.get_data('copy/1'), self.data)
+        self.assertEqual(device.copy_counts['buffer'], 1)
+
+    def test_6_checksum(self):
+        device = VfsDevice('vfs', root_path=self.device.root_path, checksum='md5')
+        session_id = device.multiput_new('sum/1')
+        device.multiput(session_id, b'xxxx')
+        # 从0开始重写，重新计算
+        device.multiput(session_id, b'hello ', 0)
+        device.multiput(session_id, b'world')
+        device.multiput_save(session_id)
+        self.assertEqual(device.stat('sum/1')['hash'], 'md5:' + hashlib.md5(b'hello world').hexdigest())
+        device.copy_data('sum/1', 'sum/2')
+        self.assertEqual(device.stat('sum/2')['hash'], device.stat('sum/1')['hash'])
+
+        # 从中间重写，保存时重新读取计算
+        device = VfsDevice('vfs', root_path=self.device.root_path, checksum='blake2b')
+        session_id = device.multiput_new('sum/3')
+        device.multiput(session_id, b'hello world')
+        device.multiput(session_id, b'W', 6)
+        device.multiput_save(session_id)
+        self.assertEqual(device.stat('sum/3')['hash'],
+                         'blake2b:' + hashlib.blake2b(b'hello World').hexdigest())
+
+        # 被其他程序修改后失效
+        with open(device.os_path('sum/3'), 'ab') as f:
+            f.write(b'!')
+        self.assertIsNone(device.stat('sum/3')['hash'])
+
+    def test_7_open_files_limit(self):
+        open_files = OpenFiles(limit=2)
+        paths = [os.path.join(self.workspace, 'open%d' % i) for i in range(4)]
+        for path in paths:
+            open_files.new_file(path)
+            open_files.append_data(path, b'abc')
+        self.assertEqual(open_files.stats()['open'], 2)
+        self.assertEqual(open_files.stats()['evicted'], 2)
+        # 被关闭的文件再次写入时透明地重新打开
+        for path in paths:
+            self.assertEqual(open_files.get_size(path), 3)
+            open_files.append_data(path, b'def')
+            open_files.append_data(path, b'D', 3)
+        for path in paths:
+            open_files.close_file(path)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'abcDef')
+        stats = open_files.stats()
+        self.assertEqual((stats['open'], stats['files'], stats['opened']), (0, 0, 4))
+        self.assertTrue(stats['reopened'] >= 2)
+
+    def test_8_open_files_concurrent(self):
+        open_files = OpenFiles(limit=3)
+        paths = [os.path.join(self.workspace, 'thread%d' % i) for i in range(8)]
+
+        def write(path):
+            open_files.new_file(path)
+            for i in range(50):
+                open_files.append_data(path, path.encode('utf-8'))
+            open_files.close_file(path, 'fdatasync')
+
+        threads = [threading.Thread(target=write, args=(path,)) for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for path in paths:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), path.encode('utf-8') * 50)
+        self.assertEqual(open_files.stats()['open'], 0)
+
+    def test_9_open_files_reaper(self):
+        open_files = OpenFiles(timeout=0, reap_interval=0.05)
+        path = os.path.join(self.workspace, 'idle')
+        open_files.new_file(path)
+        open_files.append_data(path, b'abc')
+        for i in range(100):
+            if not open_files.is_open(path):
+                break
+            time.sleep(0.05)
+        self.assertFalse(open_files.is_open(path))
+        self.assertEqual(open_files.stats()['reaped'], 1)
+        # 进程重启后续传
+        self.assertEqual(open_files.append_data(path, b'def'), 6)
+        open_files.close_file(path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'abcdef')
+
+    def test_10_fsync(self):
+        device = VfsDevice('vfs', root_path=self.device.root_path, fsync='fsync')
+        session_id = device.multiput_new('sync/1')
+        device.multiput(session_id, b'data')
+        device.multiput_save(session_id)
+        self.assertEqual(device.get_data('sync/1'), b'data')
+        self.assertRaises(ValueError, VfsDevice, 'vfs', root_path=self.device.root_path,
+                          fsync='always')
+
+    def test_11_open_files_reaper_race(self):
+        # 回收线程不停地关闭空闲文件，同时写入，数据不能丢，文件也不能泄漏
+        open_files = OpenFiles(timeout=0, reap_interval=3600)
+        paths = [os.path.join(self.workspace, 'race%d' % i) for i in range(4)]
+        stop = threading.Event()
+
+        def reap():
+            while not stop.is_set():
+                open_files.clean()
+
+        def write(path):
+            open_files.new_file(path)
+            for i in range(2000):
+                open_files.append_data(path, b'%04d' % i)
+
+        # 频繁切换线程，让回收落在查找和加锁之间
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+        reaper = threading.Thread(target=reap)
+        reaper.start()
+        threads = [threading.Thread(target=write, args=(path,)) for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stop.set()
+        reaper.join()
+        for path in paths:
+            open_files.close_file(path)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b''.join(b'%04d' % i for i in range(2000)))
+        stats = open_files.stats()
+        self.assertEqual((stats['open'], stats['files']), (0, 0))
+        self.assertTrue(stats['reaped'] > 0)
+
+    def test_12_sync_after_evict(self):
+        # 被淘汰或回收关闭的文件，保存时也要写到磁盘
+        synced = []
+        fsync = os.fsync
+        def count_fsync(fd):
+            synced.append(fd)
+            fsync(fd)
+        os.fsync = count_fsync
+        self.addCleanup(setattr, os, 'fsync', fsync)
+
+        open_files = OpenFiles(limit=1)
+        paths = [os.path.join(self.workspace, 'sync%d' % i) for i in range(2)]
+        for path in paths:
+            open_files.new_file(path)
+            open_files.append_data(path, b'abc')
+        self.assertEqual(open_files.stats()['evicted'], 1)
+        for path in paths:
+            open_files.close_file(path, 'fsync')
+        self.assertEqual(len(synced), 2)
+
+        open_files = OpenFiles(timeout=0)
+        open_files.new_file(paths[0])
+        open_files.append_data(paths[0], b'def')
+        time.sleep(0.01)
+        open_files.clean()
+        self.assertFalse(open_files.is_open(paths[0]))
+        open_files.close_file(paths[0], 'fsync')
+        self.assertEqual(len(synced), 3)
+
+    def test_13_rewrite_mapped(self):
+        # 还有memoryview在用时改写文件，旧的视图仍然读到旧内容
+        device = VfsDevice('vfs', root_path=self.device.root_path, zero_copy=True)
+        view = device.get_data(self.key, 0, 100)
+        session_id = device.multiput_new(self.key)
+        device.multiput(session_id, b'new data')
+        device.multiput_save(session_id)
+        self.assertEqual(view.tobytes(), self.data[:100])
+        self.assertEqual(bytes(device.get_data(self.key, 0, 3)), b'new')
+
+        session_id = device.multiput_new('ab/cd/other')
+        device.multiput(session_id, b'copied')
+        device.multiput_save(session_id)
+        view = device.get_data(self.key, 0, 8)
+        device.copy_data('ab/cd/other', self.key)
+        self.assertEqual(view.tobytes(), b'new data')
+        self.assertEqual(bytes(device.get_data(self.key, 0, 6)), b'copied')
+        self.assertEqual(sorted(os.listdir(os.path.dirname(device.os_path(self.key)))),
+                         sorted(['other', os.path.basename(self.key)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mdfs.cache import CacheManager
+from mdfs.device import StorageDeviceManager
+from mdfs.vfs import VfsDevice
+
+from mdfs.bench.fakeoss import FakeBucket, new_device
+
+
+class GatedBucket(FakeBucket):
+    """ gate打开前上传阻塞；failures次上传失败 """
+
+    def __init__(self, failures=0, **kwargs):
+        FakeBucket.__init__(self, **kwargs)
+        self.gate = threading.Event()
+        self.gate.set()
+        self.failures = failures
+
+    def init_multipart_upload(self, key, headers=None):
+        self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise IOError('upload failed')
+        return FakeBucket.init_multipart_upload(self, key, headers)
+
+
+class WriteBackTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.journal = os.path.join(self.workspace, 'journal.db')
+        self.key = 'ab/cd/efghijklmnopqrstuvwxyz.docx'
+        self.data = os.urandom(1024 * 1024 + 10)
+        self.devices = []
+
+    def tearDown(self):
+        for device in self.devices:
+            device.bucket.gate.set()
+            device.write_back.stop()
+        shutil.rmtree(self.workspace)
+
+    def new_device(self, bucket=None, cache=None, **kwargs):
+        local_device = VfsDevice('local', root_path=os.path.join(self.workspace, 'local'))
+        device = new_device(local_device, bucket=bucket or GatedBucket(), cache=cache)
+        device.start_write_back(self.journal, **kwargs)
+        self.devices.append(device)
+        return device
+
+    def put(self, device, key, data):
+        session_id = device.multiput_new(key)
+        for i in range(0, len(data), 300000):
+            device.multiput(session_id, data[i:i + 300000])
+        return device.multiput_save(session_id)
+
+    def test_1_local_first(self):
+        device = self.new_device()
+        device.bucket.gate.clear()
+        self.assertEqual(self.put(device, self.key, self.data), self.key)
+        # 上传完成前从本地读
+        self.assertNotIn(self.key, device.bucket.objects)
+        self.assertTrue(device.exists(self.key))
+        self.assertEqual(device.stat(self.key)['file_size'], len(self.data))
+        self.assertEqual(device.get_data(self.key, 10, 5), self.data[10:15])
+        self.assertEqual(b''.join(device.iter_data(self.key)), self.data)
+        self.assertEqual(device.upload_state(self.key)['size'], len(self.data))
+        stats = device.write_back.stats()
+        self.assertEqual((stats['pending'], stats['pending_bytes']), (1, len(self.data)))
+
+        device.bucket.gate.set()
+        self.assertTrue(device.write_back.flush(5))
+        self.assertEqual(device.bucket.objects[self.key][0], self.data)
+        self.assertIsNone(device.upload_state(self.key))
+        stats = device.write_back.stats()
+        self.assertEqual((stats['pending'], stats['uploaded'], stats['uploaded_bytes']),
+                         (0, 1, len(self.data)))
+        self.assertEqual(device.stat(self.key)['file_size'], len(self.data))
+
+    def test_2_retry(self):
+        device = self.new_device(GatedBucket(failures=2), retry_delay=0.01, poll_interval=0.01)
+        self.put(device, self.key, self.data)
+        self.assertTrue(device.write_back.flush(5))
+        self.assertEqual(device.bucket.objects[self.key][0], self.data)
+        self.assertEqual(device.write_back.stats()['errors'], 2)
+
+    def test_3_resume_after_restart(self):
+        device = self.new_device(GatedBucket(failures=1), retry_delay=3600)
+        self.put(device, self.key, self.data)
+        for i in range(500):
+            if device.write_back.stats()['errors']:
+                break
+            threading.Event().wait(0.01)
+        device.write_back.stop()
+        self.devices.remove(device)
+        self.assertEqual(device.upload_state(self.key)['attempts'], 1)
+
+        # 重启后立即重试，不等重试时间
+        device = self.new_device()
+        self.assertTrue(device.write_back.flush(5))
+        self.assertEqual(device.bucket.objects[self.key][0], self.data)
+
+    def test_4_remove_and_move_pending(self):
+        device = self.new_device()
+        device.bucket.gate.clear()
+        self.put(device, 'a/1', b'one')
+        self.put(device, 'a/2', b'two')
+        self.put(device, 'a/3', b'three')
+        device.move('a/1', 'b/1')
+        device.copy_data('a/2', 'b/2')
+        device.remove('a/2')
+        device.rmdir('a/')
+        self.assertEqual(device.get_data('b/1'), b'one')
+        self.assertEqual(device.stat('b/2')['file_size'], 3)
+        device.bucket.gate.set()
+        self.assertTrue(device.write_back.flush(5))
+        self.assertEqual(sorted(device.bucket.objects), ['b/1', 'b/2'])
+        self.assertEqual(device.bucket.objects['b/2'][0], b'two')
+
+    def test_5_pinned_in_cache(self):
+        cache = CacheManager(VfsDevice('local', root_path=os.path.join(self.workspace, 'local')),
+                             max_files=1)
+        device = self.new_device(cache=cache)
+        device.bucket.gate.clear()
+        self.put(device, 'a/1', b'one')
+        self.put(device, 'a/2', b'two')
+        self.assertEqual(cache.evict(), 0)
+        device.bucket.gate.set()
+        self.assertTrue(device.write_back.flush(5))
+        self.assertEqual(cache.evict(), 1)
+
+    def test_6_manager_stats(self):
+        device = self.new_device()
+        device.bucket.gate.clear()
+        manager = StorageDeviceManager(session_dir=os.path.join(self.workspace, 'sessions'))
+        manager.add(device, None)
+        # 丢弃其它测试留在当前线程中未提交的写入
+        manager._t_pop()
+        manager.put_data('aliyun_fake', self.key, self.data)
+        manager.commit()
+        self.assertEqual(manager.stats()['aliyun_fake']['write_back']['pending'], 1)
+
+    def test_7_rewrite_during_upload(self):
+        # 上传完成、标记完成前，文件被删除后重写为同样大小的新内容
+        device = self.new_device(retry_delay=3600, poll_interval=0.01)
+        new_data = os.urandom(len(self.data))
+        upload_local = device._upload_local
+        rewritten = threading.Event()
+
+        def rewrite_during_upload(key):
+            size = upload_local(key)
+            if not rewritten.is_set():
+                device.remove(key)
+                self.put(device, key, new_data)
+                rewritten.set()
+            return size
+
+        device._upload_local = rewrite_during_upload
+        self.put(device, self.key, self.data)
+        self.assertTrue(rewritten.wait(5))
+        self.assertTrue(device.write_back.flush(5))
+        self.assertEqual(device.bucket.objects[self.key][0], new_data)
+
+        # 上传期间本地文件被改写但还没有保存，不能标记为完成
+        journal = device.write_back.journal
+        journal.add('a/1', 3, 1)
+        version = journal.get('a/1')['version']
+        self.assertFalse(journal.done('a/1', version, 2))
+        self.assertTrue(journal.done('a/1', version, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()